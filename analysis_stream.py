@@ -0,0 +1,25 @@
+# 2020/06 BuRnCycL
+# One long-lived analysis stream shared by every visualization. Spectrum processing state (rolling smoothing and peak scaling)
+# carries across visualization switches, and each spectrum is published once to any listeners (e.g. beat detection, network).
+
+
+class AnalysisStream:
+    def __init__(self, spectra):
+        self.spectra = spectra # Iterator of processed audio frames, e.g. BlinkStickViz.led_data().
+        self.listeners = [] # Called as listener(spectrum, sequence) for every spectrum, before it's rendered.
+        self.sequence = 0
+        self.spectrum = None # Latest spectrum. Note: Reused (overwritten) by the next one.
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Next spectrum, or None once the audio source has ended.
+    def next(self):
+        spectrum = next(self.spectra, None)
+        if spectrum is None:
+            return(None)
+        self.sequence += 1
+        self.spectrum = spectrum
+        for listener in self.listeners:
+            listener(spectrum, self.sequence)
+        return(spectrum)
@@ -0,0 +1,292 @@
+# 2020/06 BuRnCycL
+# Callback driven audio capture. PyAudio's callback thread writes int16 samples into a preallocated ring buffer,
+# and the analysis side reads the most recent window from it. A slow render no longer drops audio, and overflows are counted.
+# Windows can overlap: with a hop smaller than the window, each window is the newest hop of samples plus the end of the one before,
+# so the spectrum updates every hop (e.g. 5ms) while a long window keeps its bass resolution.
+
+import numpy as np
+from time import sleep, monotonic
+
+
+# PortAudio constants, same values as pyaudio.paContinue and pyaudio.paInputOverflow. Avoids importing pyaudio here.
+PA_CONTINUE = 0
+PA_INPUT_OVERFLOW = 0x2
+
+
+class CaptureStats:
+    def __init__(self):
+        self.overflows = 0 # PyAudio reported input overflow, or the reader fell so far behind the ring wrapped over it.
+        self.underruns = 0 # The reader had to wait for audio.
+        self.skipped = 0 # Windows never analyzed because a newer one was already available.
+
+
+class SampleRing:
+    def __init__(self, capacity, channels):
+        self.capacity = int(capacity) # In frames (one sample per channel).
+        self.channels = int(channels)
+        self.buffer = np.zeros((self.capacity, self.channels), dtype=np.int16)
+        self.written = 0 # Total frames ever written. Single writer, so readers can use it without a lock.
+
+    def write(self, data):
+        frames = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+        count = len(frames)
+        if count >= self.capacity: # Only the tail fits.
+            frames = frames[-self.capacity:]
+        start = (self.written + count - len(frames)) % self.capacity
+        first = min(len(frames), self.capacity - start)
+        self.buffer[start:start+first] = frames[:first]
+        self.buffer[:len(frames)-first] = frames[first:]
+        self.written += count # Published after the copy, so a reader never sees frames that aren't there yet.
+
+    # Deinterleave the count frames ending at end into the float arrays left and right (right is ignored for mono).
+    def read(self, end, count, left, right):
+        start = (end - count) % self.capacity
+        first = min(count, self.capacity - start)
+        left[:first] = self.buffer[start:start+first, 0]
+        left[first:] = self.buffer[:count-first, 0]
+        if self.channels > 1:
+            right[:first] = self.buffer[start:start+first, 1]
+            right[first:] = self.buffer[:count-first, 1]
+
+
+class CallbackCapture:
+    def __init__(self, rate, channels, num_samples, capacity_windows=8, hop=None):
+        self.rate = int(rate)
+        self.channels = int(channels)
+        self.num_samples = int(num_samples)
+        self.hop = int(hop or num_samples) # New frames needed before the next window. Windows overlap when it's less than num_samples.
+        self.ring = SampleRing(self.num_samples*capacity_windows, self.channels)
+        self.stats = CaptureStats()
+        self.left = np.zeros(self.num_samples)
+        # Mono devices feed the same samples to both sides, so the spectrum is scaled like a stereo one.
+        self.right = np.zeros(self.num_samples) if self.channels > 1 else self.left
+
+    # Runs on PyAudio's thread. Keep it short.
+    def callback(self, in_data, frame_count, time_info, status_flags):
+        if status_flags & PA_INPUT_OVERFLOW:
+            self.stats.overflows += 1
+        self.ring.write(in_data)
+        return(None, PA_CONTINUE)
+
+    # Same shape as BlinkStickViz.read_audio: yields (left, right) float arrays, one new window (every hop frames) at a time.
+    # Note: The same two arrays are reused (and overwritten) every window.
+    def windows(self):
+        consumed = 0
+        while True:
+            available = self.ring.written - consumed
+            if available < self.hop:
+                self.stats.underruns += 1
+                while available < self.hop:
+                    sleep((self.hop - available)/self.rate)
+                    available = self.ring.written - consumed
+            end = self.ring.written
+            available = end - consumed
+            if available > self.ring.capacity:
+                self.stats.overflows += 1
+            if available >= 2*self.hop: # Fell behind. Jump to the freshest window rather than queueing.
+                self.stats.skipped += available//self.hop - 1
+            self.ring.read(end, self.num_samples, self.left, self.right)
+            if self.ring.written - end > self.ring.capacity - self.num_samples:
+                self.stats.overflows += 1 # The writer lapped us mid-read.
+            consumed = end
+            yield self.left, self.right
+
+
+# Overlapping windows of num_samples from a stream of shorter (left, right) blocks, e.g. one hop at a time.
+# Blocks are written twice into a ring of twice the window, so the newest window is always one contiguous view. No shifting.
+# Note: The same two views are yielded every window, and overwritten by the next block.
+class SlidingWindow:
+    def __init__(self, num_samples):
+        self.num_samples = int(num_samples)
+        self.ring = np.zeros((2, self.num_samples*2)) # Left and right. Starts out as silence.
+        self.head = 0 # Where the next sample goes. The newest window starts here.
+
+    def push(self, left, right):
+        count = min(len(left), self.num_samples) # Longer blocks (e.g. catching up) only keep their tail.
+        index = (self.head + np.arange(count)) % self.num_samples
+        for channel, samples in enumerate((left, right)):
+            self.ring[channel, index] = samples[len(samples) - count:]
+            self.ring[channel, index + self.num_samples] = samples[len(samples) - count:]
+        self.head = (self.head + count) % self.num_samples
+        return(self.ring[0, self.head:self.head + self.num_samples], self.ring[1, self.head:self.head + self.num_samples])
+
+def sliding_windows(blocks, num_samples):
+    window = SlidingWindow(num_samples)
+    for left, right in blocks:
+        yield window.push(left, right)
+
+
+# Audio sources. Anything with a rate attribute and a windows(num_samples, hop=None) generator yielding (left, right) float arrays
+# can feed BlinkStickViz, so it runs (and can be benchmarked) without a microphone. hop defaults to num_samples (windows don't overlap).
+
+# Microphone (or any PyAudio input device). Blocking reads by default, or callback mode into a SampleRing.
+class PyAudioSource:
+    def __init__(self, rate, channels, chunk, device=None, callback=False):
+        import pyaudio as pa # Imported here, so the other sources work without PyAudio installed.
+        self.rate = int(rate)
+        self.channels = int(channels)
+        self.chunk = int(chunk)
+        self.device = device
+        self.callback = callback
+        self.paud = pa.PyAudio()
+        self.format = pa.paInt16
+        self.capture = None # CallbackCapture, when in callback mode. Holds overflow/underrun counters.
+        self.skipped = 0 # Stale windows discarded in blocking mode.
+
+    def input_device(self, stream_callback=None): # i.e. Microphone
+        if self.device is not None: # Use non-default device.
+            audio_stream = self.paud.open(
+                format=self.format,
+                channels=self.channels,
+                rate=self.rate,
+                frames_per_buffer=self.chunk,
+                input= True,
+                input_device_index=int(self.device),
+                stream_callback=stream_callback,
+                )
+        else: # Otherwise, use the default.
+            audio_stream = self.paud.open(
+                format=self.format,
+                channels=self.channels,
+                rate=self.rate,
+                frames_per_buffer=self.chunk,
+                input= True,
+                stream_callback=stream_callback,
+                )
+        return(audio_stream)
+
+    def windows(self, num_samples, hop=None):
+        if self.callback == True:
+            self.capture = CallbackCapture(self.rate, self.channels, num_samples, hop=hop)
+            self.audio_stream = self.input_device(stream_callback=self.capture.callback)
+            return(self.capture.windows()) # Read the most recent window from the ring buffer.
+        self.audio_stream = self.input_device()
+        if hop is not None and hop != num_samples:
+            return(sliding_windows(self.read_audio(self.audio_stream, hop, keep_stale=True), num_samples))
+        return(self.read_audio(self.audio_stream, num_samples))
+
+    # Convert the audio data to numbers, num_samples at a time.
+    # keep_stale returns stale audio along with the newest, for SlidingWindow, which keeps as much of the tail as the window needs.
+    def read_audio(self, audio_stream, num_samples, keep_stale=False):
+        while True:
+            # If we fell behind, drop to the freshest window rather than analyzing stale audio.
+            stale = audio_stream.get_read_available()//num_samples - 1
+            count = num_samples
+            if stale > 0:
+                self.skipped += stale
+                if keep_stale:
+                    count = num_samples*(stale + 1) # Read it all at once.
+                else:
+                    audio_stream.read(stale*num_samples, exception_on_overflow=False)
+            # Read all the input data.
+            samples = audio_stream.read(count, exception_on_overflow=False)
+            # Convert input data to numbers
+            samples = np.frombuffer(samples, dtype=np.int16).astype(np.float64)
+            if self.channels == 1: # Mono. Feed the same samples to both sides.
+                yield samples, samples
+            else:
+                samples_l = samples[::self.channels]
+                samples_r = samples[1::self.channels]
+                yield samples_l, samples_r
+
+
+# 16-bit PCM WAV file. With realtime=True windows are paced to the file's sample rate, like a live input.
+class WavSource:
+    def __init__(self, filename, loop=False, realtime=False):
+        import wave
+        self.wav = wave.open(filename, 'rb')
+        if self.wav.getsampwidth() != 2:
+            raise ValueError('Only 16-bit PCM WAV files are supported: {}'.format(filename))
+        self.rate = self.wav.getframerate()
+        self.channels = self.wav.getnchannels()
+        self.loop = loop
+        self.realtime = realtime
+
+    def windows(self, num_samples, hop=None):
+        if hop is not None and hop != num_samples: # Overlapping windows, read a hop at a time.
+            return(sliding_windows(self.blocks(hop), num_samples))
+        return(self.blocks(num_samples))
+
+    def blocks(self, num_samples):
+        left = np.zeros(num_samples)
+        right = np.zeros(num_samples) if self.channels > 1 else left
+        started = monotonic()
+        played = 0
+        while True:
+            data = self.wav.readframes(num_samples)
+            if len(data) == 0:
+                if not self.loop:
+                    return
+                self.wav.rewind()
+                continue
+            frames = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+            left[:len(frames)] = frames[:, 0]
+            left[len(frames):] = 0 # Last window of the file is zero padded.
+            if self.channels > 1:
+                right[:len(frames)] = frames[:, 1]
+                right[len(frames):] = 0
+            if self.realtime:
+                played += num_samples
+                sleep(max(0, played/self.rate - (monotonic()-started)))
+            yield left, right
+
+
+# Deterministic test signals. kind: sweep (log sine sweep 20Hz-20kHz), noise (white), kick (decaying bass thump on every beat),
+# click (5ms tick on every beat, silence in between, for measuring onset latency), or mix.
+class SyntheticSource:
+    def __init__(self, rate=44100, kind='mix', seed=0, amplitude=8000, period=4.0, bpm=120, realtime=False):
+        self.rate = int(rate)
+        self.kind = kind
+        self.seed = seed
+        self.amplitude = amplitude
+        self.period = period # Seconds per sweep.
+        self.bpm = bpm
+        self.realtime = realtime
+
+    def sweep(self, t):
+        position = (t % self.period) / self.period
+        # Phase of an exponential sweep from 20Hz to 20kHz over self.period.
+        ratio = np.log(20000/20.0)
+        phase = 2*np.pi*20*self.period/ratio*(np.exp(position*ratio)-1)
+        return(np.sin(phase))
+
+    def kick(self, t):
+        since_beat = t % (60.0/self.bpm)
+        return(np.sin(2*np.pi*55*since_beat) * np.exp(-since_beat*25))
+
+    def click(self, t):
+        since_beat = t % (60.0/self.bpm)
+        return(np.sin(2*np.pi*1000*since_beat) * np.exp(-since_beat*200))
+
+    def windows(self, num_samples, hop=None):
+        if hop is not None and hop != num_samples: # Overlapping windows, generated a hop at a time.
+            return(sliding_windows(self.blocks(hop), num_samples))
+        return(self.blocks(num_samples))
+
+    def blocks(self, num_samples):
+        rng = np.random.default_rng(self.seed)
+        left = np.zeros(num_samples)
+        right = np.zeros(num_samples)
+        index = np.arange(num_samples)
+        start = 0
+        started = monotonic()
+        while True:
+            t = (start + index) / self.rate
+            if self.kind == 'sweep':
+                signal = self.sweep(t)
+            elif self.kind == 'noise':
+                signal = rng.uniform(-1, 1, num_samples)
+            elif self.kind == 'kick':
+                signal = self.kick(t)
+            elif self.kind == 'click':
+                signal = self.click(t)
+            else:
+                signal = (self.sweep(t) + self.kick(t)*2 + rng.uniform(-.25, .25, num_samples))/3
+            np.multiply(signal, self.amplitude, out=left)
+            np.rint(left, out=left) # Same values an int16 input would produce.
+            np.multiply(left, .8, out=right) # Slightly quieter right channel, so the two aren't identical.
+            np.rint(right, out=right)
+            start += num_samples
+            if self.realtime:
+                sleep(max(0, start/self.rate - (monotonic()-started)))
+            yield left, right
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# 2020/06 BuRnCycL
+# Offline batch rendering. Turns a whole WAV file into a show file (see show_file.py) ahead of time, much faster than real time,
+# for pre-produced events. Play it back with: python3 visualizer.py --replay show.bsv
+# Audio is read a chunk of windows at a time. Each chunk is one strided view over the samples (no copies per window), one rfft call,
+# one matrix product, and peak scaling and smoothing vectorized along the time axis. Their state carries from chunk to chunk, so
+# memory stays the same for an hour long file as for a song.
+# Spectra match SpectrumEngine fed the same file through WavSource, frame for frame (to floating point rounding).
+# Usage: python3 batch_render.py song.wav show.bsv [--mode pulse] [--loop] [--ledcount 32] [--scale mel] [--fft-size 4096 --hop 220 --hann]
+
+import argparse, sys, wave
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from notes_scaled_nosaturation import SpectrumEngine
+from renderers import VISUALIZATIONS
+from show_file import ShowRecorder
+
+
+CHUNK_FRAMES = 1024 # Windows per chunk. About 24s of audio at 44100Hz, and ~40MB of working buffers at 1024 samples per window.
+
+
+# [frames x size] view of samples, one row every hop samples. Rows share memory with samples.
+def strided_windows(samples, size, hop):
+    frames = 1 + (samples.shape[-1] - size)//hop
+    return(as_strided(samples, shape=samples.shape[:-1] + (frames, size), strides=samples.strides[:-1] + (samples.strides[-1]*hop, samples.strides[-1]), writeable=False))
+
+
+# SpectrumEngine over a whole chunk of windows at once. Takes the same arguments, and uses its precomputed ear weighting and noise floor.
+class BatchSpectrum:
+    def __init__(self, num_leds, num_samples, sample_rate, sensitivity, **kwargs):
+        self.engine = SpectrumEngine(num_leds, num_samples, sample_rate, sensitivity, **kwargs)
+        self.avg_peak = 0.0 # rolling_scale_to_max state, carried between chunks.
+        self.smooth = None # rolling_smooth state. Last frame of the previous chunk.
+
+    # windows: [channels (1 or 2) x frames x num_samples]. Returns [frames x num_leds].
+    def update(self, windows):
+        engine = self.engine
+        if engine.hann is not None:
+            windows = windows*engine.hann
+        magnitudes = np.abs(np.fft.rfft(windows, axis=-1)[..., :engine.num_bins])
+        bins = magnitudes[0] + magnitudes[-1] # Mono counts its one channel twice, like WavSource passing the same window as left and right.
+        if engine.weights is None:
+            notes = bins if engine.num_bins == engine.num_leds else np.pad(bins, ((0, 0), (0, engine.num_leds - engine.num_bins))) # LEDs past the last bin stay dark.
+            notes[:, 1:] *= 2 # Folds in the mirrored half of the full complex FFT.
+            nonzero = notes.any(axis=1)
+            notes *= engine.multipliers
+        else:
+            nonzero = bins.any(axis=1)
+            notes = bins @ engine.weights.T
+        notes[nonzero] += engine.noise_floor
+        self.scale_to_max(notes)
+        np.power(notes, engine.sensitivity, out=notes)
+        self.rolling_smooth(notes)
+        return(notes)
+
+    # Divides every frame by the rolling peak. With the default falloff of 1 that's a running maximum.
+    def scale_to_max(self, notes):
+        peaks = notes.max(axis=1)
+        if self.engine.scale_falloff == 1:
+            avg_peaks = np.maximum.accumulate(np.concatenate(([self.avg_peak], peaks)))[1:]
+        else: # Data dependent recursion. One scalar per frame, so still cheap.
+            avg_peaks = np.empty_like(peaks)
+            avg_peak = self.avg_peak
+            for i, peak in enumerate(peaks):
+                if peak > avg_peak:
+                    avg_peak = peak
+                else:
+                    avg_peak = avg_peak*self.engine.scale_falloff + peak*(1 - self.engine.scale_falloff)
+                avg_peaks[i] = avg_peak
+        self.avg_peak = avg_peaks[-1]
+        avg_peaks[avg_peaks == 0] = 1 # Silence so far is left as is.
+        notes /= avg_peaks[:, None]
+
+    # smooth[t] = falloff*smooth[t-1] + (1-falloff)*notes[t], in place. A scan in log2(frames) vector steps instead of a loop over
+    # frames: after the step at distance d, each frame includes the previous 2d frames' share. Stops once falloff**d underflows.
+    def rolling_smooth(self, notes):
+        falloff = self.engine.smooth_falloff
+        first = notes[0].copy() # The very first frame is taken as is.
+        notes *= (1 - falloff)
+        if self.smooth is None:
+            notes[0] = first
+        else:
+            notes[0] += self.smooth*falloff
+        distance, weight = 1, falloff
+        while distance < len(notes) and weight != 0:
+            notes[distance:] += weight*notes[:-distance] # Right side is evaluated in full first, so it reads the previous step.
+            distance *= 2
+            weight *= weight
+        self.smooth = notes[-1].copy()
+
+
+# Chunks of [channels x frames x num_samples] windows, one every hop samples, from a 16-bit PCM WAV file. Like WavSource (and its
+# SlidingWindow with a hop), the last hop is zero padded and overlapping windows start out over silence. Each chunk keeps the end of
+# the one before, so windows overlap across chunks too.
+def wav_chunks(filename, num_samples, chunk_frames=CHUNK_FRAMES, hop=None):
+    hop = hop or num_samples
+    wav = wave.open(filename, 'rb')
+    if wav.getsampwidth() != 2:
+        raise ValueError('Only 16-bit PCM WAV files are supported: {}'.format(filename))
+    channels = wav.getnchannels()
+    tail = np.zeros((min(channels, 2), num_samples - hop))
+    while True:
+        data = wav.readframes(hop*chunk_frames)
+        if len(data) == 0:
+            return
+        samples = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)[:, :2].T.astype(np.float64)
+        padding = -samples.shape[1] % hop
+        samples = np.concatenate((tail, samples, np.zeros((len(samples), padding))), axis=1)
+        tail = samples[:, samples.shape[1] - tail.shape[1]:]
+        yield strided_windows(samples, num_samples, hop)
+
+
+# Renders filename to a show file. Returns (frames, seconds of audio).
+def render(filename, output, mode='pulse', loop=False, led_count=32, sensitivity=1.3, num_samples=1024, hop=None, hann=False, scale=None, min_freq=40, max_freq=16000, chunk_frames=CHUNK_FRAMES):
+    hop = hop or num_samples
+    with wave.open(filename, 'rb') as wav:
+        rate = wav.getframerate()
+    spectra = BatchSpectrum(led_count, num_samples, rate, sensitivity, scale=scale, min_freq=min_freq, max_freq=max_freq, hann=hann)
+    renderer = VISUALIZATIONS[mode](led_count, loop)
+    recorder = ShowRecorder(output, led_count, fps=rate/hop)
+    frame = np.zeros(led_count) # Renderers get one reused buffer, like the live spectrum stream (flash keeps a reference to it).
+    frames = 0
+    for windows in wav_chunks(filename, num_samples, chunk_frames, hop=hop):
+        for spectrum in spectra.update(windows):
+            frame[:] = spectrum
+            recorder.write(renderer.render(frame), timestamp=frames*hop/rate) # Audio time, not render time.
+            frames += 1
+    recorder.close()
+    return(frames, frames*hop/rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a WAV file to a show file ahead of time. Play it with: visualizer.py --replay FILE')
+    parser.add_argument('wav', help='16-bit PCM WAV file')
+    parser.add_argument('output', help='Show file to write')
+    parser.add_argument('-m', '--mode', help='Visualization (Default: pulse)', default='pulse', choices=sorted(VISUALIZATIONS))
+    parser.add_argument('-l', '--loop', help='Pulse from both ends of the strip (Default: False)', default=False, action='store_true')
+    parser.add_argument('-lc', '--ledcount', help='LED Count to render for (Default: 32)', default=32, type=int)
+    parser.add_argument('-s', '--sensitivity', help='Sensitivity to Sound (Default: 1.3)', default=1.3, type=float)
+    parser.add_argument('-fs', '--fft-size', help='FFT window in samples (Default: 1024)', default=1024, type=int)
+    parser.add_argument('-hp', '--hop', help='Samples between windows (Default: the FFT size, i.e. no overlap)', default=None, type=int)
+    parser.add_argument('-hn', '--hann', help='Taper windows with a Hann window (Default: False)', default=False, action='store_true')
+    parser.add_argument('-sc', '--scale', help='Frequency to LED mapping (Default: one FFT bin per LED)', default=None, choices=['linear', 'log', 'mel'])
+    parser.add_argument('-fmin', '--min-freq', help='Lowest frequency shown with --scale (Default: 40)', default=40, type=float)
+    parser.add_argument('-fmax', '--max-freq', help='Highest frequency shown with --scale (Default: 16000)', default=16000, type=float)
+    args = parser.parse_args()
+    if not 0 <= args.min_freq < args.max_freq:
+        print('ERROR - Minimum frequency ({}Hz) must be at least 0 and below the Maximum frequency ({}Hz).'.format(args.min_freq, args.max_freq))
+        sys.exit(1)
+    try:
+        frames, seconds = render(args.wav, args.output, mode=args.mode, loop=args.loop, led_count=args.ledcount, sensitivity=args.sensitivity,
+                                 num_samples=args.fft_size, hop=args.hop, hann=args.hann, scale=args.scale, min_freq=args.min_freq, max_freq=args.max_freq)
+    except (ValueError, OSError, wave.Error) as e:
+        print('ERROR - Unable to render {} - {}'.format(args.wav, e))
+        sys.exit(1)
+    print('Rendered {} frames ({:.1f}s of audio) to {}'.format(frames, seconds, args.output))
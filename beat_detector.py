@@ -0,0 +1,134 @@
+# 2020/06 BuRnCycL
+# Streaming beat detection from the spectrum the visualizer already computes. Runs as the first analysis stream listener, so every
+# later listener (e.g. spectrum transmit) and the render loop see the same beat flag and BPM for the frame.
+#   Onsets - Spectral flux (how much the spectrum rose since the last frame) above an adaptive threshold: the mean plus a few standard
+#            deviations of recent flux, kept as running sums over a fixed ring, so each frame costs the same however long it runs.
+#   Tempo  - Median interval between the last few onsets, folded into min_bpm-max_bpm (so off-beats and missed beats still count).
+#   Beats  - Onsets at least most of a beat after the previous beat. Off-beat onsets (e.g. hi-hats) are onsets, not beats.
+
+import numpy as np
+from time import monotonic
+
+
+HISTORY = 16 # Frames of flux for the threshold. See history_for().
+HISTORY_SECONDS = .35 # A short history follows changes in the music (e.g. a sweep or a build up) quickly. Tuned on benchmark.py beat.
+TEMPO_HISTORY = 16 # Onsets kept for the tempo estimate.
+PHRASE = 16 # Beats per phrase. Four bars of 4/4.
+
+
+# Threshold history for a frame rate (frames or hops per second).
+def history_for(frame_rate, seconds=HISTORY_SECONDS):
+    return(max(HISTORY, int(frame_rate*seconds)))
+
+
+class BeatDetector:
+    def __init__(self, history=HISTORY, sensitivity=1.5, floor=.05, min_interval=.1, tempo_history=TEMPO_HISTORY, min_bpm=60, max_bpm=180, phrase=PHRASE):
+        self.history = np.zeros(int(history)) # Ring of recent flux values.
+        self.index = 0
+        self.count = 0
+        self.flux_sum = 0.0 # Running sums over the ring, for the threshold's mean and variance.
+        self.flux_squares = 0.0
+        self.sensitivity = sensitivity # Standard deviations above the mean flux for an onset.
+        self.floor = floor # Minimum flux for an onset, so near silence doesn't trigger.
+        self.min_interval = min_interval # Seconds between onsets.
+        self.onset_times = np.zeros(int(tempo_history))
+        self.onsets = 0 # Total onsets. Also counts onset_times.
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.phrase = phrase
+        self.previous = None # Last spectrum. Flux is measured against it.
+        self.rise = None
+        self.armed = True # An onset needs the flux to fall back below the threshold first.
+        # Published state, for the current frame.
+        self.onset = False
+        self.beat = False
+        self.bpm = 0.0 # 0 until a few onsets have been seen.
+        self.beats = 0 # Total beats. See phrase_boundary().
+        self.last_beat = None
+        self.flux = 0.0
+        self.threshold = 0.0
+
+    # spectrum is the frame's processed spectrum. now is in seconds (Default: monotonic()). beat, when given, is a beat decided
+    # elsewhere (e.g. the transmit node's, received with the spectrum) and replaces onset detection. Tempo is still tracked.
+    def update(self, spectrum, now=None, beat=None):
+        now = monotonic() if now is None else now
+        if beat is None:
+            self.onset = self.detect(spectrum, now)
+        else:
+            self.onset = bool(beat)
+        self.beat = False
+        if self.onset:
+            self.onset_times[self.onsets % len(self.onset_times)] = now
+            self.onsets += 1
+            self.estimate_tempo()
+            if beat is not None or self.bpm == 0 or self.last_beat is None or now - self.last_beat >= .6*60/self.bpm:
+                self.beat = True
+                self.beats += 1
+                self.last_beat = now
+        return(self.beat)
+
+    def detect(self, spectrum, now):
+        if self.previous is None or len(self.previous) != len(spectrum):
+            self.previous = np.array(spectrum, dtype=np.float64)
+            self.rise = np.zeros(len(spectrum))
+            return(False)
+        np.subtract(spectrum, self.previous, out=self.rise)
+        np.maximum(self.rise, 0, out=self.rise)
+        self.previous[:] = spectrum
+        flux = self.flux = float(self.rise.sum())
+        if self.count > 0:
+            mean = self.flux_sum/self.count
+            variance = max(self.flux_squares/self.count - mean*mean, 0.0)
+            self.threshold = mean + self.sensitivity*variance**.5 + self.floor
+        else:
+            self.threshold = self.floor
+        onset = False
+        if flux > self.threshold:
+            if self.armed and (self.onsets == 0 or now - self.onset_times[(self.onsets - 1) % len(self.onset_times)] >= self.min_interval):
+                onset = True
+            self.armed = False
+        else:
+            self.armed = True
+        self.add_flux(flux)
+        return(onset)
+
+    def add_flux(self, flux):
+        oldest = self.history[self.index]
+        self.history[self.index] = flux
+        self.index = (self.index + 1) % len(self.history)
+        if self.count < len(self.history):
+            self.count += 1
+        else:
+            self.flux_sum -= oldest
+            self.flux_squares -= oldest*oldest
+        self.flux_sum += flux
+        self.flux_squares += flux*flux
+        if self.index == 0: # Once per lap, recompute the sums so rounding doesn't build up.
+            self.flux_sum = float(self.history.sum())
+            self.flux_squares = float(np.dot(self.history, self.history))
+
+    # Called once per onset. At most tempo_history intervals, so constant cost.
+    def estimate_tempo(self):
+        count = min(self.onsets, len(self.onset_times))
+        if count < 4:
+            return
+        times = np.sort(self.onset_times[:count]) if self.onsets > len(self.onset_times) else self.onset_times[:count]
+        intervals = np.diff(times)
+        shortest, longest = 60/self.max_bpm, 60/self.min_bpm
+        intervals = intervals[intervals > 0]
+        while len(intervals) > 0 and intervals.min() < shortest: # Off-beats: double.
+            intervals[intervals < shortest] *= 2
+        while len(intervals) > 0 and intervals.max() > longest: # Missed beats: halve.
+            intervals[intervals > longest] /= 2
+        if len(intervals) > 0:
+            self.bpm = 60/np.median(intervals)
+
+    # True on a beat that starts a phrase.
+    def phrase_boundary(self):
+        return(self.beat and (self.beats - 1) % self.phrase == 0)
+
+    def snapshot(self):
+        return({'bpm': self.bpm, 'beats': self.beats, 'onsets': self.onsets, 'flux': self.flux, 'threshold': self.threshold})
+
+    def __str__(self):
+        return('BPM: {:.1f}, Beats: {}, Onsets: {}'.format(self.bpm, self.beats, self.onsets))
@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the visualizer hot paths. Runs without a microphone or Blinkstick attached.
+# Usage: python3 benchmark.py spectrum|wire|render|multiprocess|transmit|receiver|batch|latency|beat|writes
+
+
+import argparse, sys, pickle, resource, tracemalloc, subprocess, os, wave, tempfile, io, contextlib
+import multiprocessing as mp
+from time import perf_counter, monotonic, process_time, sleep
+from socket import socket, AF_INET, SOCK_DGRAM
+import numpy as np
+import notes_scaled_nosaturation as nsn
+from renderers import PulseRenderer, FlashRenderer
+import wire_protocol
+from audio_capture import SyntheticSource, WavSource
+from device_output import NullSink, DeviceWorker, correction_table
+import multiprocess_pipeline
+from multiprocess_pipeline import SharedRing, RingNotifier
+from transport import UnicastTransport, MulticastTransport
+import batch_render
+from beat_detector import BeatDetector, history_for
+from show_file import ShowFile
+
+
+def synthetic_windows(frames, num_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_samples)
+    windows = []
+    for i in range(frames):
+        tone = 8000*np.sin(2*np.pi*(20+i%200)*t/num_samples)
+        l = tone + rng.normal(0, 1000, num_samples)
+        r = tone*.5 + rng.normal(0, 1000, num_samples)
+        windows.append((np.round(l), np.round(r)))
+    return(windows)
+
+# The original generator chain, kept as the reference implementation for process().
+def reference_process(audio_stream, num_leds, num_samples, sample_rate, sensitivity):
+    frequencies = [float(sample_rate*i)/num_samples for i in range(num_leds)]
+    human_ear_multipliers = np.array([nsn.human_hearing_multiplier(f) for f in frequencies])
+    notes = nsn.fft(audio_stream)
+    notes = nsn.scale_samples(notes, num_leds)
+    notes = nsn.add_white_noise(notes, amount=2000)
+    notes = nsn.schur(notes, human_ear_multipliers)
+    notes = nsn.rolling_scale_to_max(notes, falloff=1)
+    notes = nsn.exaggerate(notes, exponent=sensitivity)
+    notes = nsn.rolling_smooth(notes, falloff=.6)
+    return(notes)
+
+def time_stream(stream, frames):
+    start = perf_counter()
+    for _ in range(frames):
+        next(stream)
+    return(frames/(perf_counter()-start))
+
+def bench_spectrum(args):
+    windows = synthetic_windows(args.frames, args.samples)
+    # Correctness first. Copy each frame, as both chains reuse their output array.
+    reference = [f.copy() for f in reference_process(iter(windows), args.leds, args.samples, args.rate, args.sensitivity)]
+    engine = [f.copy() for f in nsn.process(iter(windows), args.leds, args.samples, args.rate, args.sensitivity)]
+    max_error = max(np.max(np.abs(a-b)) for a, b in zip(reference, engine))
+    print('Max absolute difference vs reference: {:.3g}'.format(max_error))
+    if max_error > 1e-9:
+        print('ERROR - SpectrumEngine output does not match the reference chain.')
+        sys.exit(1)
+
+    before = time_stream(reference_process(iter(windows), args.leds, args.samples, args.rate, args.sensitivity), args.frames)
+    after = time_stream(nsn.process(iter(windows), args.leds, args.samples, args.rate, args.sensitivity), args.frames)
+    print('Reference chain: {:10.1f} frames/sec'.format(before))
+    print('SpectrumEngine:  {:10.1f} frames/sec ({:.2f}x)'.format(after, after/before))
+    for scale in ('linear', 'log', 'mel'): # Band mapped output differs from the reference by design, so only timed.
+        engine = nsn.SpectrumEngine(args.leds, args.samples, args.rate, args.sensitivity, scale=scale)
+        print('SpectrumEngine ({}): {:10.1f} frames/sec'.format(scale, time_stream(engine.stream(iter(windows)), args.frames)))
+
+# Realistic LED frames: each renderer driven by the synthetic audio.
+def rendered_frames(frames, led_count, samples=2048):
+    windows = synthetic_windows(frames, samples)
+    result = []
+    for renderer in (PulseRenderer(led_count, loop=True), FlashRenderer(led_count)):
+        for frame in nsn.process(iter(windows), led_count, samples, 44100, 1.3):
+            result.append(renderer.render(frame).copy())
+    return(result)
+
+def time_per_frame(function, frames):
+    start = perf_counter()
+    for frame in frames:
+        function(frame)
+    return((perf_counter()-start)/len(frames)*1000000)
+
+def bench_wire(args):
+    print('{:>6} {:>8} {:>12} {:>12} {:>12}'.format('LEDs', 'format', 'encode us', 'decode us', 'bytes/frame'))
+    for led_count in args.leds:
+        frames = rendered_frames(args.frames, led_count)
+        # Baseline: the old pickled list of ints.
+        pickled = [pickle.dumps(f.tolist()) for f in frames]
+        encode = time_per_frame(lambda f: pickle.dumps(f.tolist()), frames)
+        decode = time_per_frame(pickle.loads, pickled)
+        print('{:>6} {:>8} {:>12.2f} {:>12.2f} {:>12.1f}'.format(led_count, 'pickle', encode, decode, np.mean([len(d) for d in pickled])))
+        for name in ('raw', 'rle', 'delta'):
+            encoder = wire_protocol.FrameEncoder(encoding=wire_protocol.ENCODINGS[name])
+            datagrams = [encoder.encode(f) for f in frames]
+            encoder = wire_protocol.FrameEncoder(encoding=wire_protocol.ENCODINGS[name])
+            encode = time_per_frame(encoder.encode, frames)
+            decoder = wire_protocol.FrameDecoder()
+            decoded = [decoder.decode(wire_protocol.unpack(d)) for d in datagrams]
+            if any(not np.array_equal(a, b) for a, b in zip(frames, decoded)):
+                print('ERROR - {} encoding does not round trip.'.format(name))
+                sys.exit(1)
+            decoder = wire_protocol.FrameDecoder()
+            decode = time_per_frame(lambda d: decoder.decode(wire_protocol.unpack(d)), datagrams)
+            print('{:>6} {:>8} {:>12.2f} {:>12.2f} {:>12.1f}'.format(led_count, name, encode, decode, np.mean([len(d) for d in datagrams])))
+        # --transmit-spectrum sends the analyzed bands instead, however long the strip. Band values are stand-ins, sizes don't depend on them.
+        spectra = [nsn.resample_bands(f[:led_count]/255.0, args.bands) for f in frames]
+        for name, encoding in sorted(wire_protocol.SPECTRUM_ENCODINGS.items()):
+            encoder = wire_protocol.SpectrumEncoder(encoding=encoding)
+            datagrams = [encoder.encode(s) for s in spectra]
+            encode = time_per_frame(encoder.encode, spectra)
+            decode = time_per_frame(lambda d: wire_protocol.decode_spectrum(wire_protocol.unpack(d)), datagrams)
+            print('{:>6} {:>8} {:>12.2f} {:>12.2f} {:>12.1f}'.format(led_count, name, encode, decode, np.mean([len(d) for d in datagrams])))
+
+# Smallest power of two window that has at least one FFT bin per LED (SpectrumEngine needs num_leds <= num_samples/2).
+def window_for(led_count, minimum=1024):
+    num_samples = minimum
+    while num_samples < led_count*2:
+        num_samples *= 2
+    return(num_samples)
+
+# Runs stage(item) for every item and returns (us/frame, peak bytes allocated by Python during the run).
+# Timed and traced in separate passes, as tracemalloc slows everything down.
+def measure_stage(stage, items):
+    start = perf_counter()
+    for item in items:
+        stage(item)
+    elapsed = perf_counter() - start
+    tracemalloc.start()
+    for item in items:
+        stage(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return(elapsed/len(items)*1000000, peak)
+
+def bench_render(args):
+    print('{:>6} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}'.format('LEDs', 'window', 'process', 'pulse', 'flash', 'send', 'max FPS', 'peak alloc'))
+    for led_count in args.leds:
+        num_samples = window_for(led_count)
+        source = SyntheticSource(rate=args.rate, kind=args.signal)
+        windows = source.windows(num_samples)
+        audio = [tuple(a.copy() for a in next(windows)) for _ in range(args.frames)]
+        engine = nsn.SpectrumEngine(led_count, num_samples, args.rate, 1.3)
+        spectra = [engine.update(l, r).copy() for l, r in audio] # Renderers get real spectra, but measured separately.
+        engine.reset()
+        pulse, flash, sink = PulseRenderer(led_count, loop=True), FlashRenderer(led_count), NullSink()
+        frames = [pulse.render(f).copy() for f in spectra]
+        process_us, process_peak = measure_stage(lambda a: engine.update(*a), audio)
+        pulse_us, pulse_peak = measure_stage(pulse.render, spectra)
+        flash_us, flash_peak = measure_stage(lambda f: flash.render(f.copy()), spectra) # Flash writes to its input on silence.
+        send_us, send_peak = measure_stage(sink.send, frames)
+        slowest = process_us + max(pulse_us, flash_us) + send_us
+        print('{:>6} {:>8} {:>8.1f}us {:>8.1f}us {:>8.1f}us {:>8.1f}us {:>10.0f} {:>10.1f}KB'.format(led_count, num_samples, process_us, pulse_us, flash_us, send_us,
+            1000000/slowest, max(process_peak, pulse_peak, flash_peak, send_peak)/1024))
+    print('Max RSS: {:.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
+
+# Stages of the pipeline, as used by both the single and multi-process runs. Sources run unpaced, i.e. as fast as possible.
+def pipeline_stages(led_count, rate=44100):
+    num_samples = window_for(led_count)
+    windows = SyntheticSource(rate=rate, kind='mix').windows(num_samples)
+    engine = nsn.SpectrumEngine(led_count, num_samples, rate, 1.3)
+    renderer = FlashRenderer(led_count)
+    return(windows, engine, renderer)
+
+def latency_summary(frames, latencies, elapsed):
+    latencies = np.array(latencies)*1000
+    return(frames/elapsed, np.median(latencies) if len(latencies) else 0.0, np.percentile(latencies, 99) if len(latencies) else 0.0)
+
+def single_process(led_count, duration):
+    windows, engine, renderer = pipeline_stages(led_count)
+    sink = NullSink()
+    latencies = []
+    start = monotonic()
+    while monotonic() - start < duration:
+        captured = monotonic()
+        spectrum = engine.update(*next(windows))
+        sink.send(renderer.render(spectrum))
+        latencies.append(monotonic() - captured)
+    return(latency_summary(sink.frames, latencies, monotonic() - start))
+
+def capture_stage(led_count, spectra_name, stop, notifier):
+    windows, engine, _ = pipeline_stages(led_count)
+    spectra = SharedRing(led_count, name=spectra_name, notifier=notifier)
+    while not stop.is_set():
+        captured = monotonic()
+        spectra.publish(engine.update(*next(windows)), captured)
+
+def render_stage(led_count, spectra_name, frames_name, stop, spectra_notifier, frames_notifier):
+    _, _, renderer = pipeline_stages(led_count)
+    spectra = SharedRing(led_count, name=spectra_name, notifier=spectra_notifier)
+    frames = SharedRing(led_count*3, dtype=np.uint8, name=frames_name, notifier=frames_notifier)
+    for spectrum, captured in spectra.reader(stop):
+        frames.publish(renderer.render(spectrum.copy()), captured) # Flash writes to its input on silence.
+
+def multi_process(led_count, duration):
+    context = mp.get_context('fork')
+    stop = context.Event()
+    spectra, frames = SharedRing(led_count, notifier=RingNotifier()), SharedRing(led_count*3, dtype=np.uint8, notifier=RingNotifier())
+    processes = [context.Process(target=capture_stage, args=(led_count, spectra.shm.name, stop, spectra.notifier)),
+                 context.Process(target=render_stage, args=(led_count, spectra.shm.name, frames.shm.name, stop, spectra.notifier, frames.notifier))]
+    for process in processes:
+        process.start()
+    sink = NullSink() # Output stage runs here.
+    latencies = []
+    start = monotonic()
+    for frame, captured in frames.reader(timeout=duration):
+        sink.send(frame)
+        latencies.append(monotonic() - captured)
+        if monotonic() - start > duration:
+            break
+    elapsed = monotonic() - start
+    stop.set()
+    for process in processes:
+        process.join()
+    frames.close()
+    spectra.close()
+    return(latency_summary(sink.frames, latencies, elapsed))
+
+# Stands in for BlinkStickViz in multiprocess_pipeline.run(). Synthetic spectra, a render process that stops after frames frames,
+# and an output process that reports the length of the last frame it got.
+class PipelineViz:
+    frames = 20
+    shown = mp.get_context('fork').Value('i', 0)
+
+    def __init__(self, led_count=32, spectra=None, sink=None, **kwargs):
+        self.led_count = led_count
+        self.spectra = spectra
+        self.sink = sink
+
+    def led_data(self):
+        while True:
+            sleep(.001)
+            yield np.random.rand(self.led_count)
+
+    def main(self, modes):
+        for _, spectrum in zip(range(self.frames), self.spectra):
+            self.sink.send((spectrum*255).astype(np.uint8).repeat(3))
+
+    def send_to_stick(self, frame):
+        self.shown.value = len(frame)
+
+    def close(self):
+        pass
+
+# run() with the LED count as a string, as --ledcount once came from the command line. Rings must be sized for 64 LEDs, not '64'*3.
+def check_led_count(led_count='64'):
+    sizes = []
+    class SizedRing(SharedRing):
+        def __init__(self, capacity, *args, **kwargs):
+            sizes.append(capacity)
+            super().__init__(capacity, *args, **kwargs)
+    multiprocess_pipeline.SharedRing = SizedRing
+    try:
+        with contextlib.redirect_stdout(io.StringIO()): # run() reports the render process stopping as an error.
+            multiprocess_pipeline.run(PipelineViz, {'led_count': led_count}, ['pulse'])
+    finally:
+        multiprocess_pipeline.SharedRing = SharedRing
+    expected = [int(led_count), int(led_count)*3]
+    print('run() with LED count {!r}: ring sizes {}, output frame {} bytes'.format(led_count, sizes, PipelineViz.shown.value))
+    if sizes != expected or PipelineViz.shown.value != expected[1]:
+        print('ERROR - Expected ring sizes {} and {} byte frames.'.format(expected, expected[1]))
+        sys.exit(1)
+
+def bench_multiprocess(args):
+    check_led_count()
+    print('CPU cores: {}{}'.format(os.cpu_count(), '. With one core the processes take turns, so multi-process can only add hand off cost.' if os.cpu_count() == 1 else ''))
+    print('{:>6} {:>8} {:>12} {:>14} {:>14}'.format('LEDs', 'mode', 'frames/sec', 'latency p50', 'latency p99'))
+    for led_count in args.leds:
+        for name, run in (('single', single_process), ('multi', multi_process)):
+            fps, p50, p99 = run(led_count, args.duration)
+            print('{:>6} {:>8} {:>12.0f} {:>12.2f}ms {:>12.2f}ms'.format(led_count, name, fps, p50, p99))
+
+
+# The original udp_transmit: a new socket per node per frame. Closed here, so the benchmark doesn't run out of file descriptors.
+class SocketPerNode:
+    def __init__(self, port):
+        self.port = port
+
+    def send(self, data, nodes):
+        for node in nodes:
+            transmit_socket = socket(AF_INET, SOCK_DGRAM)
+            transmit_socket.sendto(data, (node, self.port))
+            transmit_socket.close()
+
+# Transmit CPU time per frame by receive node count. Everything goes to a local discard socket, and multicast uses TTL 0 so it never leaves this host.
+def bench_transmit(args):
+    sink = socket(AF_INET, SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    port = sink.getsockname()[1]
+    data = wire_protocol.FrameEncoder().encode(rendered_frames(1, args.leds)[0])
+    print('{:>6} {:>10} {:>14} {:>14}'.format('nodes', 'transport', 'CPU us/frame', 'sends/frame'))
+    for node_count in args.nodes:
+        nodes = ['127.0.0.1']*node_count
+        for name, transport in (('per-node', SocketPerNode(port)), ('unicast', UnicastTransport(port)), ('multicast', MulticastTransport(port, ttl=0))):
+            transport.send(data, nodes) # Warm up (route lookup).
+            start = process_time()
+            for i in range(args.frames):
+                transport.send(data, nodes)
+            elapsed = process_time() - start
+            sends = 1 if name == 'multicast' else node_count
+            print('{:>6} {:>10} {:>14.1f} {:>14}'.format(node_count, name, elapsed/args.frames*1000000, sends))
+            if hasattr(transport, 'close'):
+                transport.close()
+    sink.close()
+
+
+# What the original visualizer.py did before receiving anything: import pyaudio, numpy, blinkstick, netifaces, and the spectrum code,
+# and open PyAudio in BlinkStickViz.__init__. Modules not installed here are skipped and listed on stderr, so the figure is then a lower bound.
+ORIGINAL_RECEIVE = '''missing = []
+for module in ('pyaudio', 'numpy', 'blinkstick.blinkstick', 'netifaces', 'notes_scaled_nosaturation', 'colorsys', 'random', 'pickle', 'argparse', 'socket', 'threading'):
+    try:
+        __import__(module)
+    except ImportError:
+        missing.append(module)
+if 'pyaudio' not in missing:
+    import pyaudio; pyaudio.PyAudio()
+if missing:
+    sys.stderr.write('without ' + ', '.join(missing))'''
+
+# Receive node start up, each in a fresh interpreter: imports and setup up to the point it would open its sockets. No Blinkstick needed.
+STARTUP_CASES = (
+    ('python', 'pass'),
+    ('original --receive', ORIGINAL_RECEIVE),
+    ('visualizer.py --receive', 'import visualizer; from device_output import NullSink; '
+        'viz = visualizer.BlinkStickViz(sensitivity=1.3, rate=44100, chunk=1024, channels=2, max_int=15, min_int=5, transmit=False, receive=True, '
+        'network_interface="eth0", inputonly=False, led_count=32, sink=NullSink()); '
+        'import receiver; receiver.ReceiveNode(viz.led_count)'),
+    ('receiver.py', 'import receiver; receiver.ReceiveNode(32)'),
+    )
+
+# Peak RSS in KB. ru_maxrss survives exec on Linux, so a child would report this benchmark's own peak. VmHWM starts over with the new program.
+PEAK_RSS = '''def peak_rss():
+    try:
+        with open('/proc/self/status') as status:
+            return(next(int(line.split()[1]) for line in status if line.startswith('VmHWM:')))
+    except (OSError, StopIteration):
+        import resource
+        return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'''
+
+def startup(code):
+    script = '{}\nimport sys; from time import perf_counter; start = perf_counter()\n{}\nprint(perf_counter() - start, peak_rss())'.format(PEAK_RSS, code)
+    start = perf_counter()
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    total = perf_counter() - start
+    if result.returncode != 0:
+        return(None, None, None, result.stderr.strip().splitlines()[-1], None)
+    setup, rss = result.stdout.split()[-2:]
+    return(total, float(setup), int(rss), None, result.stderr.strip() or None)
+
+def bench_receiver(args):
+    print('{:>24} {:>12} {:>12} {:>10}'.format('start up', 'total ms', 'setup ms', 'max RSS MB'))
+    for name, code in STARTUP_CASES:
+        runs = [startup(code) for i in range(args.runs)]
+        error = runs[0][3]
+        if error is not None:
+            print('{:>24} skipped - {}'.format(name, error))
+            continue
+        total, setup, rss = (np.median([run[i] for run in runs]) for i in range(3))
+        note = '  ({})'.format(runs[0][4]) if runs[0][4] else ''
+        print('{:>24} {:>12.1f} {:>12.1f} {:>10.1f}{}'.format(name, total*1000, setup*1000, rss/1024, note))
+
+
+# Synthetic stereo 16-bit WAV of the given length, written a window at a time.
+def write_wav(filename, seconds, rate=44100, num_samples=1024):
+    windows = SyntheticSource(rate=rate, kind='mix').windows(num_samples)
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        for _ in range(int(seconds*rate/num_samples)):
+            l, r = next(windows)
+            wav.writeframes(np.stack((l, r), axis=1).clip(-32768, 32767).astype('<i2').tobytes())
+
+# Runs function() once timed, and once under tracemalloc for its peak Python allocation. Returns (result, seconds, peak bytes).
+def timed_and_traced(function):
+    start = perf_counter()
+    result = function()
+    elapsed = perf_counter() - start
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return(result, elapsed, peak)
+
+def bench_batch(args):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'batch.wav')
+        write_wav(filename, args.seconds, rate=args.rate)
+        def streaming():
+            engine = nsn.SpectrumEngine(args.leds, 1024, args.rate, 1.3)
+            return([engine.update(l, r).copy() for l, r in WavSource(filename).windows(1024)])
+        def batch():
+            spectra = batch_render.BatchSpectrum(args.leds, 1024, args.rate, 1.3)
+            return(np.concatenate([spectra.update(windows) for windows in batch_render.wav_chunks(filename, 1024)]))
+        def batch_unkept(): # What a long render holds: one chunk at a time.
+            spectra = batch_render.BatchSpectrum(args.leds, 1024, args.rate, 1.3)
+            for windows in batch_render.wav_chunks(filename, 1024):
+                spectra.update(windows)
+        reference, streaming_time, streaming_peak = timed_and_traced(streaming)
+        spectra, batch_time, _ = timed_and_traced(batch)
+        _, chunked_time, chunked_peak = timed_and_traced(batch_unkept)
+        max_error = np.max(np.abs(np.array(reference) - spectra)) if len(reference) == len(spectra) else float('inf')
+        print('{} frames ({:.0f}s of audio, {} LEDs). Max absolute difference batch vs streaming: {:.3g}'.format(len(spectra), args.seconds, args.leds, max_error))
+        if max_error > 1e-9:
+            print('ERROR - Batch spectra do not match the streaming SpectrumEngine.')
+            sys.exit(1)
+        start = perf_counter()
+        batch_render.render(filename, os.path.join(directory, 'batch.bsv'), led_count=args.leds)
+        render_time = perf_counter() - start
+        print('{:>28} {:>12} {:>14}'.format('', 'x real time', 'peak alloc'))
+        print('{:>28} {:>12.0f} {:>12.1f}MB'.format('streaming SpectrumEngine', args.seconds/streaming_time, streaming_peak/1048576))
+        print('{:>28} {:>12.0f} {:>14}'.format('batch spectra', args.seconds/chunked_time, '{:.1f}MB'.format(chunked_peak/1048576)))
+        print('{:>28} {:>12.0f} {:>14}'.format('batch render to show file', args.seconds/render_time, ''))
+
+
+# Onset to LED delay on a click track, per FFT size and hop. Each frame is shown once its window's last sample has arrived, plus the time to
+# process and render it (measured). A click counts as shown at the first frame where the pulse's newest LED reaches half its brightest
+# for that click. Leaves out audio driver buffering beyond one hop and the USB write.
+def onset_delays(fft_size, hop, hann, seconds, leds=32, rate=44100, bpm=97):
+    source = SyntheticSource(rate=rate, kind='click', bpm=bpm) # 97 BPM, so clicks land all over the hop grid.
+    windows = source.windows(fft_size, hop=hop if hop != fft_size else None)
+    engine = nsn.SpectrumEngine(leds, fft_size, rate, 1.3, hann=hann)
+    renderer = PulseRenderer(leds)
+    frames = int(seconds*rate/hop)
+    brightness = np.zeros(frames)
+    start = perf_counter()
+    for i in range(frames):
+        l, r = next(windows)
+        brightness[i] = renderer.render(engine.update(l, r))[:3].max()
+    compute = (perf_counter() - start)/frames
+    shown = (np.arange(frames) + 1)*hop/rate + compute # When each frame could be on the LEDs.
+    beat = 60.0/bpm
+    delays = []
+    for onset in np.arange(beat, shown[-1] - beat, beat): # The first click is at 0, before any window.
+        period = (shown >= onset) & (shown < onset + beat)
+        lit = np.flatnonzero(period & (brightness >= brightness[period].max()/2))
+        if len(lit) > 0:
+            delays.append(shown[lit[0]] - onset)
+    return(np.array(delays), compute)
+
+def bench_latency(args):
+    print('{:>6} {:>6} {:>6} {:>10} {:>10} {:>12} {:>12} {:>10}'.format('FFT', 'hop', 'hann', 'update', 'bass res', 'delay avg', 'delay max', 'us/frame'))
+    for config in args.configs:
+        fft_size, hop = (int(value) for value in config.split(':'))
+        for hann in (False, True):
+            delays, compute = onset_delays(fft_size, hop, hann, args.seconds, rate=args.rate)
+            print('{:>6} {:>6} {:>6} {:>8.1f}ms {:>8.1f}Hz {:>10.1f}ms {:>10.1f}ms {:>10.1f}'.format(fft_size, hop, 'yes' if hann else 'no', hop/args.rate*1000,
+                args.rate/fft_size, delays.mean()*1000, delays.max()*1000, compute*1000000))
+
+
+# Beat detection on a synthetic track at a known tempo, in audio time. Returns (recall, precision, BPM, us/frame detecting, us/frame spectrum).
+# A true beat is found if a beat is detected within tolerance after it, and a detected beat is right if it's within tolerance after a true one.
+def beat_accuracy(kind, bpm, fft_size, hop, seconds, leds=32, rate=44100, tolerance=.07):
+    windows = SyntheticSource(rate=rate, kind=kind, bpm=bpm).windows(fft_size, hop=hop if hop != fft_size else None)
+    engine = nsn.SpectrumEngine(leds, fft_size, rate, 1.3)
+    frames = int(seconds*rate/hop)
+    spectra = [engine.update(*next(windows)).copy() for _ in range(frames)]
+    times = (np.arange(frames) + 1)*hop/rate
+    detector = BeatDetector(history=history_for(rate/hop))
+    start = perf_counter()
+    beats = times[[detector.update(spectrum, now=now) for spectrum, now in zip(spectra, times)]]
+    detect_us = (perf_counter() - start)/frames*1000000
+    engine.reset()
+    spectrum_us = time_per_frame(lambda a: engine.update(*a), [next(windows) for _ in range(200)])
+    truth = np.arange(60.0/bpm, seconds - tolerance, 60.0/bpm) # The click at 0 is before the first window.
+    found = sum(np.any((beats >= onset) & (beats <= onset + tolerance)) for onset in truth)
+    right = sum(np.any((truth <= beat) & (truth >= beat - tolerance)) for beat in beats)
+    return(found/len(truth), right/max(len(beats), 1), detector.bpm, detect_us, spectrum_us)
+
+def bench_beat(args):
+    print('{:>6} {:>5} {:>10} {:>8} {:>10} {:>8} {:>14} {:>16}'.format('signal', 'BPM', 'FFT:hop', 'recall', 'precision', 'BPM est', 'detect us/frame', 'spectrum us/frame'))
+    failed = False
+    for kind in ('click', 'kick', 'mix'):
+        for bpm in args.bpm:
+            for config in args.configs:
+                fft_size, hop = (int(value) for value in config.split(':'))
+                recall, precision, estimate, detect_us, spectrum_us = beat_accuracy(kind, bpm, fft_size, hop, args.seconds)
+                print('{:>6} {:>5} {:>10} {:>8.2f} {:>10.2f} {:>8.1f} {:>14.1f} {:>16.1f}'.format(kind, bpm, config, recall, precision, estimate, detect_us, spectrum_us))
+                if kind != 'mix' and (recall < .9 or precision < .9 or abs(estimate - bpm) > bpm*.05): # mix's sweep makes flux of its own. Shown, not checked.
+                    failed = True
+    if failed:
+        print('ERROR - Beat detection missed the click/kick track accuracy targets (90% recall and precision, BPM within 5%).')
+        sys.exit(1)
+
+# Stands in for a Blinkstick. Builds the same report as blinkstick's set_led_data (a Python loop over the bytes), minus the USB transfer.
+class FakeStick:
+    def __init__(self, led_count):
+        self.led_count = led_count
+
+    def get_serial(self):
+        return('BS000000-3.0')
+
+    def get_led_count(self):
+        return(self.led_count)
+
+    def set_led_data(self, channel, data):
+        report = [0, channel]
+        for i in range(0, self.led_count*3):
+            report.append(data[i] if len(data) > i else 0)
+        return(bytes(bytearray(report)))
+
+# Pulse frames for seconds of a synthetic signal and then silence seconds (e.g. a break), one per 1024 sample window.
+def track_frames(kind, seconds, silence, leds, rate=44100, num_samples=1024):
+    windows = SyntheticSource(rate=rate, kind=kind).windows(num_samples)
+    quiet = (np.zeros(num_samples), np.zeros(num_samples))
+    engine = nsn.SpectrumEngine(leds, num_samples, rate, 1.3)
+    renderer = PulseRenderer(leds, loop=True)
+    count, quiet_count = int(seconds*rate/num_samples), int(silence*rate/num_samples)
+    return([bytes(renderer.render(engine.update(*(next(windows) if i < count else quiet)))) for i in range(count + quiet_count)], rate/num_samples)
+
+def bench_writes(args):
+    print('{:>6} {:>9} {:>6} {:>7} {:>9} {:>10} {:>11} {:>13} {:>15}'.format('signal', 'threshold', 'gamma', 'frames', 'written', 'skipped', 'keepalives', 'bytes written', 'compare us/frame'))
+    for kind in args.signals:
+        frames, fps = track_frames(kind, args.seconds, args.silence, args.leds)
+        for gamma in args.gamma:
+            for threshold in args.thresholds:
+                worker = DeviceWorker(FakeStick(args.leds), table=correction_table(args.brightness, gamma), threshold=threshold, keepalive=args.keepalive)
+                compare = 0.0
+                for i, data in enumerate(frames):
+                    now = i/fps # Audio time, so keepalives fall where they would live.
+                    start = perf_counter()
+                    frame = worker.prepare(data, now=now)
+                    compare += perf_counter() - start
+                    if frame is not None:
+                        worker.write(frame, now=now)
+                stats = worker.stats
+                print('{:>6} {:>9} {:>6} {:>7} {:>8.1f}% {:>10} {:>11} {:>13} {:>15.1f}'.format(kind, threshold, gamma, len(frames), stats.writes/len(frames)*100,
+                      stats.skipped, stats.keepalives, stats.bytes_written, compare/len(frames)*1000000))
+    stick = FakeStick(args.leds)
+    write_us = time_per_frame(lambda data: stick.set_led_data(0, data), frames)
+    print('set_led_data report building alone: {:.1f} us/frame, before the USB transfer itself.'.format(write_us))
+
+
+
+# Records a show on synthetic audio and interrupts it after --frames frames, as Ctrl-C would, from send_to_stick just after the frame is recorded.
+# The last frame sent is printed, and has to be the show file's final frame: close() on the way out writes what the recorder still buffers.
+RECORD_DRIVER = '''import sys, visualizer, multiprocess_pipeline
+from audio_capture import SyntheticSource
+filename, frames, processes = sys.argv[1], int(sys.argv[2]), sys.argv[3] == 'multi'
+class InterruptedViz(visualizer.BlinkStickViz):
+    sent = 0
+    def send_to_stick(self, data):
+        super().send_to_stick(data)
+        if self.recorder is None: # Multi-process mode's render process. Only the output process records.
+            return
+        self.sent += 1
+        if self.sent == frames:
+            print('final', bytes(data).hex(), flush=True)
+            raise KeyboardInterrupt
+kwargs = dict(sensitivity=1.3, rate=44100, chunk=1024, channels=2, max_int=15, min_int=5, transmit=False, receive=False, network_interface='lo',
+              inputonly=True, led_count=32, source=SyntheticSource(kind='mix', realtime=True), record=filename)
+if processes:
+    multiprocess_pipeline.run(InterruptedViz, kwargs, ['pulse'])
+else:
+    InterruptedViz(**kwargs).main(['pulse'])'''
+
+def bench_record(args):
+    print('{:>8} {:>8} {:>9} {:>12}'.format('mode', 'sent', 'recorded', 'final frame'))
+    failed = False
+    for mode in ('single', 'multi'):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'interrupted.show')
+            result = subprocess.run([sys.executable, '-c', RECORD_DRIVER, filename, str(args.frames), mode], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), timeout=60)
+            final = [line.split()[1] for line in result.stdout.splitlines() if line.startswith('final ')]
+            show = ShowFile(filename)
+            matches = len(final) == 1 and len(show) == args.frames and show.frame(len(show) - 1).tobytes().hex() == final[0]
+            print('{:>8} {:>8} {:>9} {:>12}'.format(mode, args.frames, len(show), 'matches' if matches else 'DIFFERS'))
+            failed = failed or not matches
+    if failed:
+        print('ERROR - The show file does not end with the last frame sent before the interrupt.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    spectrum = subparsers.add_parser('spectrum', help='notes_scaled_nosaturation.process vs the original generator chain.')
+    spectrum.add_argument('-f', '--frames', type=int, default=2000)
+    spectrum.add_argument('-l', '--leds', type=int, default=32)
+    spectrum.add_argument('-n', '--samples', type=int, default=1024)
+    spectrum.add_argument('-r', '--rate', type=int, default=44100)
+    spectrum.add_argument('-s', '--sensitivity', type=float, default=1.3)
+    spectrum.set_defaults(func=bench_spectrum)
+    wire = subparsers.add_parser('wire', help='Binary wire protocol encode/decode cost and bytes per frame vs pickle, and spectrum transmit.')
+    wire.add_argument('-f', '--frames', type=int, default=500)
+    wire.add_argument('-l', '--leds', type=int, nargs='+', default=[32, 144, 600])
+    wire.add_argument('-b', '--bands', type=int, default=32, help='Bands per spectrum, as with --transmit-spectrum.')
+    wire.set_defaults(func=bench_wire)
+    render = subparsers.add_parser('render', help='Per-stage us/frame, max sustainable FPS, and memory of process, pulse, and flash on synthetic audio.')
+    render.add_argument('-f', '--frames', type=int, default=1000)
+    render.add_argument('-l', '--leds', type=int, nargs='+', default=[32, 144, 600])
+    render.add_argument('-r', '--rate', type=int, default=44100)
+    render.add_argument('-sg', '--signal', default='mix', choices=['sweep', 'noise', 'kick', 'click', 'mix'])
+    render.set_defaults(func=bench_render)
+    multiprocess = subparsers.add_parser('multiprocess', help='Throughput and capture to output latency, single process vs capture/render/output in separate processes.')
+    multiprocess.add_argument('-d', '--duration', type=float, default=3)
+    multiprocess.add_argument('-l', '--leds', type=int, nargs='+', default=[32, 600])
+    multiprocess.set_defaults(func=bench_multiprocess)
+    transmit = subparsers.add_parser('transmit', help='UDP transmit CPU time per frame vs receive node count: socket per node, shared unicast socket, multicast.')
+    transmit.add_argument('-f', '--frames', type=int, default=200)
+    transmit.add_argument('-l', '--leds', type=int, default=32)
+    transmit.add_argument('-n', '--nodes', type=int, nargs='+', default=[1, 8, 32, 64])
+    transmit.set_defaults(func=bench_transmit)
+    receiver = subparsers.add_parser('receiver', help='Receive node start up time and memory: the original visualizer, visualizer.py --receive, and receiver.py.')
+    receiver.add_argument('-r', '--runs', type=int, default=5)
+    receiver.set_defaults(func=bench_receiver)
+    batch = subparsers.add_parser('batch', help='Offline batch render (batch_render.py) vs streaming SpectrumEngine on a WAV file: match, speed, and memory.')
+    batch.add_argument('-s', '--seconds', type=float, default=300)
+    batch.add_argument('-l', '--leds', type=int, default=32)
+    batch.add_argument('-r', '--rate', type=int, default=44100)
+    batch.set_defaults(func=bench_batch)
+    latency = subparsers.add_parser('latency', help='Onset to LED delay on a synthetic click track, by FFT size and hop (overlapping windows).')
+    latency.add_argument('-c', '--configs', nargs='+', default=['1024:1024', '1024:256', '2048:220', '4096:220'], help='FFT_SIZE:HOP pairs.')
+    latency.add_argument('-s', '--seconds', type=float, default=30)
+    latency.add_argument('-r', '--rate', type=int, default=44100)
+    latency.set_defaults(func=bench_latency)
+    beat = subparsers.add_parser('beat', help='Beat detection accuracy on synthetic click/kick tracks, tempo estimate, and cost per frame.')
+    beat.add_argument('-b', '--bpm', type=int, nargs='+', default=[90, 120, 140])
+    beat.add_argument('-c', '--configs', nargs='+', default=['1024:1024', '2048:220'], help='FFT_SIZE:HOP pairs.')
+    beat.add_argument('-s', '--seconds', type=float, default=30)
+    beat.set_defaults(func=bench_beat)
+    writes = subparsers.add_parser('writes', help='Blinkstick writes skipped by change detection (device_output.DeviceWorker) on synthetic tracks ending in silence, and what the check costs.')
+    writes.add_argument('-sg', '--signals', nargs='+', default=['kick', 'mix'], choices=['sweep', 'noise', 'kick', 'click', 'mix'])
+    writes.add_argument('-s', '--seconds', type=float, default=60, help='Seconds of signal, followed by --silence seconds of silence.')
+    writes.add_argument('-q', '--silence', type=float, default=15)
+    writes.add_argument('-l', '--leds', type=int, default=32)
+    writes.add_argument('-t', '--thresholds', type=int, nargs='+', default=[0, 2, 4, 8])
+    writes.add_argument('-g', '--gamma', type=float, nargs='+', default=[1.0, 2.2])
+    writes.add_argument('-b', '--brightness', type=float, default=1.0)
+    writes.add_argument('-k', '--keepalive', type=float, default=1.0)
+    writes.set_defaults(func=bench_writes)
+    record = subparsers.add_parser('record', help='Interrupts a recording (single and multi-process) and checks the show file ends with the last frame sent.')
+    record.add_argument('-f', '--frames', type=int, default=75, help='Frames before the interrupt. Not a multiple of the recorder flush interval (50).')
+    record.set_defaults(func=bench_record)
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(0)
+    args.func(args)
@@ -0,0 +1,43 @@
+# 2020/06 BuRnCycL
+# NTP-style clock sync between a receive node and the transmit node, over the same UDP sockets as the frames.
+# Each exchange gives the offset of the transmit node's clock from ours and the round trip delay:
+#   offset = ((t1 - t0) + (t2 - t3))/2    delay = (t3 - t0) - (t2 - t1)
+# Wi-Fi delay is asymmetric at times, so like NTP the offset comes from the lowest delay exchange of the last few.
+
+from collections import deque
+from time import time
+import wire_protocol
+
+
+class ClockSync:
+    def __init__(self, samples=8):
+        self.samples = deque(maxlen=samples) # (offset, delay) in seconds.
+        self.offset = None # Transmit node clock minus ours, in seconds. None until the first exchange.
+        self.delay = 0.0
+        self.jitter = 0.0 # RMS spread of recent offsets around the chosen one.
+        self.exchanges = 0
+
+    def synced(self):
+        return(self.offset is not None)
+
+    # Receive side. Takes the SYNC_REPLY message and when it arrived (seconds).
+    def update(self, message, received_at=None):
+        t3 = time() if received_at is None else received_at
+        t0, t1, t2 = (t/1000000 for t in wire_protocol.SYNC_TIMES.unpack_from(message.payload))
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0: # Reply to a request from before a clock step. Useless.
+            return
+        self.samples.append((((t1 - t0) + (t2 - t3))/2, delay))
+        self.offset, self.delay = min(self.samples, key=lambda sample: sample[1])
+        self.jitter = (sum((offset - self.offset)**2 for offset, delay in self.samples)/len(self.samples))**.5
+        self.exchanges += 1
+
+    # Transmit node time (seconds) to ours.
+    def local_time(self, remote_time):
+        return(remote_time - self.offset)
+
+    def snapshot(self):
+        return({'offset': self.offset or 0.0, 'delay': self.delay, 'jitter': self.jitter, 'exchanges': self.exchanges})
+
+    def __str__(self):
+        return('Offset: {:.1f}ms, Delay: {:.1f}ms, Jitter: {:.1f}ms'.format((self.offset or 0.0)*1000, self.delay*1000, self.jitter*1000))
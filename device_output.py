@@ -0,0 +1,250 @@
+# 2020/06 BuRnCycL
+# Parallel Blinkstick output. One worker thread per device, each with a single-slot mailbox where the newest frame
+# replaces any frame still pending. A slow or failing device never holds up the others, and reconnects in the background.
+# USB writes are the most expensive part of a frame, so each worker keeps the last frame it wrote and skips frames that match it
+# (silence, a held color), or that are within threshold of it on every channel. A keepalive write still goes out every so often.
+# Brightness and gamma are one 256 entry table, looked up in the same pass that compares against the last frame.
+
+import sys
+import numpy as np
+from threading import Condition, Thread
+from time import monotonic, sleep
+import metrics
+from layout import DeviceLayout
+
+
+class DeviceStats:
+    def __init__(self):
+        self.writes = 0
+        self.skipped = 0 # Frames not written, as they matched (or were within threshold of) the last frame written.
+        self.keepalives = 0 # Unchanged frames written anyway, as the keepalive interval was up.
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.coalesced = 0 # Frames replaced by a newer frame before they were written.
+        self.errors = 0
+        self.reconnects = 0
+        self.write_time_total = 0.0 # Seconds spent in set_led_data.
+        self.write_time_max = 0.0
+
+    def snapshot(self):
+        stats = dict(vars(self))
+        stats['write_time_avg'] = self.write_time_total/self.writes if self.writes else 0.0
+        del stats['write_time_total']
+        return(stats)
+
+
+# Output value for each channel value (0-255), scaled by brightness (0-1) and gamma corrected. None when it would change nothing.
+def correction_table(brightness=1.0, gamma=1.0):
+    if brightness == 1 and gamma == 1:
+        return(None)
+    table = 255*min(max(brightness, 0.0), 1.0)*(np.arange(256)/255)**gamma
+    return(np.round(table).astype(np.uint8))
+
+
+class DeviceWorker:
+    def __init__(self, stick, layout=None, reconnect_interval=1, table=None, threshold=0, keepalive=1.0):
+        self.stick = stick
+        self.serial = stick.get_serial() # Used to find the same device again after a USB error.
+        self.layout = layout # Maps the canonical frame onto this device. None sends it as is.
+        self.reconnect_interval = reconnect_interval
+        self.table = table # See correction_table(). None sends channel values as is.
+        self.threshold = threshold # Largest change on any channel that's still skipped. 0 only skips identical frames.
+        self.keepalive = keepalive # Seconds an unchanged frame is skipped for before it's written anyway. 0 writes every frame.
+        self.last = None # Last frame written, after the table. None until the first write, and after an error.
+        self.last_write = 0.0
+        self.high = None # Scratch buffers for threshold, the size of a frame.
+        self.difference = None
+        self.condition = Condition()
+        self.pending = None
+        self.running = False
+        self.stats = DeviceStats()
+
+    def start(self):
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    # Returns True if a frame was still pending, i.e. the device isn't keeping up.
+    def submit(self, data):
+        with self.condition:
+            coalesced = self.pending is not None
+            if coalesced:
+                self.stats.coalesced += 1
+            self.pending = data
+            self.condition.notify()
+        return(coalesced)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                data, self.pending = self.pending, None
+            frame = self.prepare(data)
+            if frame is not None:
+                self.write(frame)
+
+    # Frame to write (a uint8 array), or None to skip it. now is in seconds (Default: monotonic()).
+    def prepare(self, data, now=None):
+        frame = np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else np.asarray(data, dtype=np.uint8).reshape(-1)
+        size = len(frame)
+        if self.high is None or len(self.high) != size:
+            self.high = np.empty(size, dtype=np.uint8)
+            self.difference = np.empty(size, dtype=np.uint8)
+            self.last = None # A different frame size is always written.
+        if self.table is not None:
+            frame = self.table[frame] # A new array. Faster than take() into a buffer at LED strip sizes.
+        if self.last is None:
+            return(frame)
+        if self.threshold > 0: # |frame - last| without leaving uint8: max - min.
+            np.maximum(frame, self.last, out=self.high)
+            np.minimum(frame, self.last, out=self.difference)
+            np.subtract(self.high, self.difference, out=self.difference)
+            unchanged = self.difference.max() <= self.threshold
+        else:
+            unchanged = np.array_equal(frame, self.last)
+        if not unchanged:
+            return(frame)
+        if (monotonic() if now is None else now) - self.last_write >= self.keepalive:
+            self.stats.keepalives += 1
+            return(frame)
+        self.stats.skipped += 1
+        self.stats.bytes_skipped += size
+        return(None)
+
+    def write(self, frame, now=None):
+        start = monotonic()
+        try:
+            self.stick.set_led_data(0, frame.tobytes()) # bytes index faster than an array in set_led_data's per-byte loop.
+        except Exception as e:
+            self.stats.errors += 1
+            self.last = None # Unknown what the device shows now. Write the next frame whatever it is.
+            print('ERROR - Blinkstick {} communication error - {}'.format(self.serial, e))
+            self.reconnect() # Pending frames keep coalescing while we're away, so we resume on the newest one.
+            return
+        elapsed = monotonic() - start
+        metrics.record('device_write', elapsed)
+        if self.last is None or len(self.last) != len(frame):
+            self.last = frame.copy()
+        else:
+            self.last[:] = frame
+        self.last_write = start if now is None else now
+        self.stats.writes += 1
+        self.stats.bytes_written += len(frame)
+        self.stats.write_time_total += elapsed
+        self.stats.write_time_max = max(self.stats.write_time_max, elapsed)
+
+    # Try to re-init Blinkstick communication when failures occur. This is due to bugs in pyusb library.
+    def reconnect(self):
+        from blinkstick import blinkstick # Imported here, so the sinks below work without the blinkstick package installed.
+        while self.running:
+            try:
+                stick = blinkstick.find_by_serial(self.serial)
+            except Exception:
+                stick = None
+            if stick is not None:
+                self.stick = stick
+                self.stats.reconnects += 1
+                print('Blinkstick {} reconnected.'.format(self.serial))
+                return
+            sleep(self.reconnect_interval)
+
+
+# Utilize multiple Blinksticks on the same parent device. Returns (sticks, LED count to render for).
+def find_blinksticks():
+    from blinkstick import blinkstick # Imported here, so the sinks below work without the blinkstick package installed.
+    found_blinksticks = []
+    led_counts = []
+    blinksticks = blinkstick.find_all() # Discover multiple Blinksticks.
+    for stick in blinksticks:
+        led_counts.append(stick.get_led_count())
+        found_blinksticks.append(stick)
+
+    # Render for the longest strip. Shorter ones get the frame resampled by their layout (see layout.py).
+    if len(led_counts) == 0:
+        print('ERROR - No Blinksticks found. Use Input Only mode (--inputonly) to run without one.')
+        sys.exit(1)
+    led_count = int(max(led_counts))
+    if len(set(led_counts)) > 1:
+        print('Blinkstick LED counts differ: {} - Rendering for {} LEDs and resampling per device.'.format(led_counts, led_count))
+    return(found_blinksticks, led_count)
+
+
+# led_count is the canonical frame size the visualizations render. Devices with a different LED count, or with options in
+# layouts ({serial: options}, see layout.read_layouts()), get the frame through their own DeviceLayout.
+# brightness, gamma, threshold, and keepalive apply to every device (see DeviceWorker). The defaults write frames as rendered.
+class DeviceOutput:
+    def __init__(self, sticks, led_count=None, layouts=None, brightness=1.0, gamma=1.0, threshold=0, keepalive=1.0):
+        layouts = layouts or {}
+        table = correction_table(brightness, gamma) # Read only, so shared by every worker.
+        self.workers = []
+        for stick in sticks:
+            worker = DeviceWorker(stick, table=table, threshold=threshold, keepalive=keepalive)
+            if led_count is not None:
+                device_layout = DeviceLayout(led_count, stick.get_led_count(), **layouts.get(worker.serial, {}))
+                if not device_layout.identity:
+                    worker.layout = device_layout
+                    print('Blinkstick {} layout: {}'.format(worker.serial, device_layout))
+            self.workers.append(worker)
+        for worker in self.workers:
+            worker.start()
+
+    def send(self, data):
+        shared = None
+        coalesced = False
+        for worker in self.workers:
+            if worker.layout is not None:
+                frame = worker.layout.apply(data)
+            else:
+                if shared is None:
+                    shared = bytes(data) # One immutable copy shared by every worker without a layout. Renderers reuse their output buffers.
+                frame = shared
+            coalesced = worker.submit(frame) or coalesced
+        return(coalesced) # True if any device still had the previous frame pending.
+
+    def stats(self):
+        return({worker.serial: worker.stats.snapshot() for worker in self.workers})
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+# Sinks with the same interface as DeviceOutput, for running without a Blinkstick attached.
+class NullSink:
+    def __init__(self):
+        self.frames = 0
+
+    def send(self, data):
+        self.frames += 1
+        return(False)
+
+    def stats(self):
+        return({'null': {'writes': self.frames}})
+
+    def stop(self):
+        pass
+
+
+# Keeps a copy of every frame sent (up to limit), e.g. to check what a visualization produced.
+class RecordingSink:
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.frames = []
+
+    def send(self, data):
+        if self.limit is None or len(self.frames) < self.limit:
+            self.frames.append(bytes(data))
+        return(False)
+
+    def stats(self):
+        return({'recording': {'writes': len(self.frames)}})
+
+    def stop(self):
+        pass
@@ -0,0 +1,101 @@
+# 2020/06 BuRnCycL
+# Deadline based frame scheduler. Replaces the fixed 20ms sleep in the visualizations.
+# Waits for the next frame deadline *before* audio is read, so frames render against fresh audio. Deadlines are monotonic and
+# don't drift by however long processing took. When behind, frames are skipped (the next one starts now) rather than queued,
+# and if deadlines keep being missed or the device can't keep up, the rate adapts down (and back up when there's headroom).
+# Time a frame spends blocked on its input (see blocked()) isn't held against it: a frame that's late only because audio hadn't
+# arrived yet follows the audio, rather than counting as a miss.
+
+from time import monotonic, sleep
+
+
+class SchedulerStats:
+    def __init__(self):
+        self.frames = 0
+        self.misses = 0 # Frames that started after their deadline had passed.
+        self.skipped = 0 # Whole frame intervals skipped to catch up.
+        self.congestion = 0 # Times the output reported it couldn't keep up.
+        self.achieved_fps = 0.0 # Smoothed, from actual frame intervals.
+
+
+class FrameScheduler:
+    def __init__(self, fps=50, min_fps=10, adapt=True, window=50):
+        self.target_fps = float(fps)
+        self.min_fps = min(float(min_fps), self.target_fps)
+        self.fps = self.target_fps # Current rate. Equal to the target unless adapted down.
+        self.adapt = adapt
+        self.window = window # Frames between rate adaptations.
+        self.deadline = None
+        self.last_frame = None
+        self.window_misses = 0
+        self.window_frames = 0
+        self.blocked_time = 0.0 # Seconds the current frame waited on its input.
+        self.stats = SchedulerStats()
+
+    # Start over from the next frame, e.g. when a new visualization starts. Keeps the adapted rate.
+    def reset(self):
+        self.deadline = None
+        self.last_frame = None
+        self.blocked_time = 0.0
+
+    def interval(self):
+        return(1.0/self.fps)
+
+    # Time spent waiting on input (e.g. a blocking audio read) since the last wait().
+    def blocked(self, seconds):
+        self.blocked_time += seconds
+
+    # Call at the top of each frame. Sleeps until the frame's deadline, or returns immediately if it's already passed.
+    def wait(self):
+        now = monotonic()
+        blocked, self.blocked_time = self.blocked_time, 0.0
+        if self.deadline is None:
+            self.deadline = now
+        elif now < self.deadline:
+            sleep(self.deadline - now)
+            now = monotonic()
+        elif now - self.deadline <= blocked: # Late only by waiting on input. The input sets the pace, so start from here.
+            self.deadline = now
+        elif now - self.deadline - blocked > self.interval(): # Late by more than a frame. Skip ahead instead of bursting to catch up.
+            skipped = int((now - self.deadline - blocked)/self.interval())
+            self.stats.misses += 1
+            self.stats.skipped += skipped
+            self.window_misses += 1
+            self.deadline = now
+        elif now > self.deadline:
+            self.stats.misses += 1
+            self.window_misses += 1
+        if self.last_frame is not None and now > self.last_frame:
+            self.stats.achieved_fps = self.stats.achieved_fps*.9 + .1/(now - self.last_frame)
+        self.last_frame = now
+        self.deadline += self.interval()
+        self.stats.frames += 1
+        self.window_frames += 1
+        if self.adapt and self.window_frames >= self.window:
+            self.adapt_rate()
+
+    # The output couldn't keep up (e.g. a Blinkstick still had a frame pending). Counts as a miss for adaptation.
+    def congested(self):
+        self.stats.congestion += 1
+        self.window_misses += 1
+
+    def adapt_rate(self):
+        miss_ratio = self.window_misses/self.window_frames
+        if miss_ratio > .2 and self.fps > self.min_fps:
+            self.fps = max(self.min_fps, self.fps*.8)
+            print('Frame Scheduler - Falling behind, lowering rate to {:.1f} FPS (Target: {:.1f})'.format(self.fps, self.target_fps))
+        elif miss_ratio == 0 and self.fps < self.target_fps:
+            self.fps = min(self.target_fps, self.fps*1.1)
+            if self.fps == self.target_fps:
+                print('Frame Scheduler - Back at target rate: {:.1f} FPS'.format(self.fps))
+        self.window_misses = 0
+        self.window_frames = 0
+
+    def snapshot(self):
+        stats = dict(vars(self.stats))
+        stats['target_fps'] = self.target_fps
+        stats['current_fps'] = self.fps
+        return(stats)
+
+    def __str__(self):
+        return('Target: {target_fps:.1f} FPS, Current: {current_fps:.1f} FPS, Achieved: {achieved_fps:.1f} FPS, Deadline misses: {misses}, Skipped: {skipped}'.format(**self.snapshot()))
@@ -0,0 +1,74 @@
+# 2020/06 BuRnCycL
+# Per-device LED layouts. Visualizations render one canonical frame, and each Blinkstick gets it through a precomputed index table:
+# resampled to the device's LED count, and optionally mirrored, reversed, or offset (rotated). Applying it is a single NumPy gather,
+# so mixing 8, 32, and 64 LED strips costs almost nothing and needs no extra render passes.
+# Layout options are read from ./layouts.list, one device per line: SERIAL [mirror] [reverse] [offset=N]
+
+import numpy as np
+from os import path
+
+
+LAYOUTS_FILE = './layouts.list'
+
+
+class DeviceLayout:
+    def __init__(self, source_count, target_count, mirror=False, reverse=False, offset=0):
+        self.source_count = int(source_count)
+        self.target_count = int(target_count)
+        self.mirror = mirror
+        self.reverse = reverse
+        self.offset = int(offset)
+        if mirror: # Canonical frame runs outward from the middle in both directions.
+            half = (self.target_count + 1)//2
+            right = self.resample(half)
+            index = np.concatenate((right[::-1][:self.target_count - half], right))
+        else:
+            index = self.resample(self.target_count)
+        if reverse:
+            index = index[::-1]
+        if self.offset:
+            index = np.roll(index, self.offset)
+        self.index = index
+        self.identity = self.source_count == self.target_count and np.array_equal(index, np.arange(self.target_count))
+        # Expanded from LEDs to GRB bytes, so the gather works directly on the flat uint8 frame.
+        self.byte_index = (index[:, None]*3 + np.arange(3)).reshape(-1)
+
+    # Nearest canonical LED for each of count evenly spaced positions.
+    def resample(self, count):
+        return(np.minimum(((np.arange(count) + .5)*self.source_count/count).astype(np.intp), self.source_count - 1))
+
+    def apply(self, frame):
+        frame = np.asarray(frame, dtype=np.uint8).reshape(-1)
+        if len(frame) < self.source_count*3: # Short frame (can happen with flash). Pad with off LEDs.
+            padded = np.zeros(self.source_count*3, dtype=np.uint8)
+            padded[:len(frame)] = frame
+            frame = padded
+        return(frame.take(self.byte_index)) # New array every frame. Device workers may still be writing the previous one.
+
+    def __str__(self):
+        options = [name for name in ('mirror', 'reverse') if getattr(self, name)]
+        if self.offset:
+            options.append('offset={}'.format(self.offset))
+        return('{} -> {} LEDs{}'.format(self.source_count, self.target_count, ' ({})'.format(', '.join(options)) if options else ''))
+
+
+# {serial: {'mirror': bool, 'reverse': bool, 'offset': int}} from LAYOUTS_FILE. Empty if there isn't one.
+def read_layouts(filename=LAYOUTS_FILE):
+    layouts = {}
+    if not path.isfile(filename):
+        return(layouts)
+    with open(filename, 'r') as f:
+        for line in f.readlines():
+            fields = line.split('#')[0].split() # Allow comments.
+            if not fields:
+                continue
+            options = {'mirror': False, 'reverse': False, 'offset': 0}
+            for field in fields[1:]:
+                if field in ('mirror', 'reverse'):
+                    options[field] = True
+                elif field.startswith('offset='):
+                    options['offset'] = int(field.split('=', 1)[1])
+                else:
+                    print('ERROR - Unknown layout option for {}: {}'.format(fields[0], field))
+            layouts[fields[0]] = options
+    return(layouts)
@@ -0,0 +1,256 @@
+# 2020/06 BuRnCycL
+# Hot path instrumentation. Per-stage timing histograms, frame rate, and counters, exposed over HTTP in Prometheus text format
+# (http://host:port/metrics) and/or as a periodic JSON stats line.
+# Disabled by default. Until enable() is called, clock()/observe()/record()/count()/frame() do nothing beyond one None check.
+# Other processes (e.g. --processes mode) keep their own registries. Their state() is merged in when scraped, see collect().
+
+import json
+from bisect import bisect_left
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep
+
+
+PREFIX = 'blinkstickviz'
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25) # Seconds. Plus +Inf.
+STAGES = ('audio_read', 'spectrum', 'render', 'network_send', 'device_write') # Documented stages. Others are accepted too.
+ROLLING = 256 # Samples kept per stage for the rolling percentiles.
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0]*(len(BUCKETS)+1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = [0.0]*ROLLING # Rolling window of the latest samples.
+        self.position = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.recent[self.position] = value
+        self.position = (self.position + 1) % ROLLING
+
+    def rolling(self):
+        recent = sorted(self.recent[:min(self.count, ROLLING)])
+        if not recent:
+            return({'p50': 0.0, 'p99': 0.0, 'max': 0.0})
+        return({'p50': recent[len(recent)//2], 'p99': recent[min(len(recent)-1, int(len(recent)*.99))], 'max': recent[-1]})
+
+
+class Registry:
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {} # name -> function returning a number or {label: number}. Read at scrape time, so they cost nothing per frame.
+        self.frame_times = [0.0]*64
+        self.frames = 0
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def frame(self):
+        with self.lock:
+            self.frame_times[self.frames % len(self.frame_times)] = monotonic()
+            self.frames += 1
+
+    def fps(self):
+        with self.lock:
+            kept = min(self.frames, len(self.frame_times))
+            if kept < 2:
+                return(0.0)
+            newest = self.frame_times[(self.frames-1) % len(self.frame_times)]
+            oldest = self.frame_times[(self.frames-kept) % len(self.frame_times)]
+            return((kept-1)/(newest-oldest) if newest > oldest else 0.0)
+
+    def read_gauges(self):
+        values = {}
+        for name, function in list(self.gauges.items()):
+            try:
+                values[name] = function()
+            except Exception as e:
+                print('ERROR - Metrics gauge {} failed - {}'.format(name, e))
+        return(values)
+
+    # Everything needed to merge this registry into another process's, as JSON friendly values. Gauges are read now.
+    def state(self):
+        with self.lock:
+            histograms = {stage: [h.buckets, h.count, h.total, [h.recent[(h.position - i - 1) % ROLLING] for i in range(min(h.count, ROLLING))][::-1]]
+                          for stage, h in self.histograms.items()}
+            state = {'histograms': histograms, 'counters': dict(self.counters), 'frames': self.frames, 'frame_times': list(self.frame_times)}
+        state['gauges'] = self.read_gauges()
+        return(state)
+
+    # Adds another registry's state() into this one. Gauges are prefixed, so the same gauge from several processes stays apart.
+    def merge(self, state, prefix=''):
+        with self.lock:
+            for stage, (buckets, count, total, recent) in state['histograms'].items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram()
+                histogram.buckets = [a + b for a, b in zip(histogram.buckets, buckets)]
+                histogram.count += count
+                histogram.total += total
+                for value in recent:
+                    histogram.recent[histogram.position] = value
+                    histogram.position = (histogram.position + 1) % ROLLING
+            for name, value in state['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            if state['frames'] > self.frames: # Frame rate from whichever process counts the most frames (the one rendering them).
+                self.frames, self.frame_times = state['frames'], list(state['frame_times'])
+        for name, value in state['gauges'].items():
+            self.gauges[prefix + name] = lambda value=value: value
+
+    def snapshot(self):
+        with self.lock:
+            stages = {stage: dict(h.rolling(), count=h.count, avg=h.total/h.count if h.count else 0.0) for stage, h in self.histograms.items()}
+            counters = dict(self.counters)
+            frames = self.frames
+        return({'fps': self.fps(), 'frames': frames, 'stages': stages, 'counters': counters, 'gauges': self.read_gauges()})
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append('# TYPE {}_stage_seconds histogram'.format(PREFIX))
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ('+Inf',), h.buckets):
+                    cumulative += bucket
+                    lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(PREFIX, stage, bound, cumulative))
+                lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(PREFIX, stage, h.total))
+                lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(PREFIX, stage, h.count))
+            lines.append('# TYPE {}_stage_seconds_rolling gauge'.format(PREFIX))
+            for stage, h in sorted(self.histograms.items()):
+                for quantile, value in h.rolling().items():
+                    lines.append('{}_stage_seconds_rolling{{stage="{}",quantile="{}"}} {}'.format(PREFIX, stage, quantile, value))
+            lines.append('# TYPE {}_frames_total counter'.format(PREFIX))
+            lines.append('{}_frames_total {}'.format(PREFIX, self.frames))
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE {}_{}_total counter'.format(PREFIX, name))
+                lines.append('{}_{}_total {}'.format(PREFIX, name, value))
+        lines.append('# TYPE {}_fps gauge'.format(PREFIX))
+        lines.append('{}_fps {}'.format(PREFIX, self.fps()))
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append('# TYPE {}_{} gauge'.format(PREFIX, name))
+            if isinstance(value, dict): # Labelled, e.g. per device.
+                for label, labelled in sorted(value.items()):
+                    lines.append('{}_{}{{id="{}"}} {}'.format(PREFIX, name, label, labelled))
+            else:
+                lines.append('{}_{} {}'.format(PREFIX, name, value))
+        return('\n'.join(lines) + '\n')
+
+
+_registry = None # The active Registry, or None while disabled.
+_gauges = {} # Registered before enable() is called are kept here.
+_collectors = {} # prefix -> function returning another process's Registry.state(), or None if it has none yet.
+
+
+def enable(port=None, json_interval=None, address='127.0.0.1'):
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+        _registry.gauges = _gauges
+    if port is not None:
+        serve(port, address)
+    if json_interval:
+        Thread(target=json_stats, args=(json_interval,), daemon=True).start()
+    return(_registry)
+
+# In a forked child process. Starts over with a fresh registry, as the parent's lock may have been held when it forked.
+def forked():
+    global _registry
+    if _registry is not None:
+        _registry = Registry()
+        _registry.gauges = _gauges
+    _collectors.clear()
+
+# Another process's metrics, merged in when scraped. Its gauges are named prefix + gauge name.
+def collect(prefix, function):
+    _collectors[prefix] = function
+
+# This process's registry, with any collected processes merged in.
+def current():
+    if not _collectors:
+        return(_registry)
+    merged = Registry()
+    merged.merge(_registry.state())
+    for prefix, function in list(_collectors.items()):
+        try:
+            state = function()
+        except Exception as e:
+            print('ERROR - Metrics from {} failed - {}'.format(prefix, e))
+            continue
+        if state is not None:
+            merged.merge(state, prefix)
+    return(merged)
+
+def enabled():
+    return(_registry is not None)
+
+def registry():
+    return(_registry)
+
+# Hot path helpers. Usage: start = metrics.clock(); ...; metrics.observe('render', start)
+def clock():
+    return(perf_counter() if _registry is not None else 0.0)
+
+def observe(stage, start):
+    if _registry is not None:
+        _registry.observe(stage, perf_counter() - start)
+
+def record(stage, seconds): # For durations the caller already measured.
+    if _registry is not None:
+        _registry.observe(stage, seconds)
+
+def count(name, amount=1):
+    if _registry is not None:
+        _registry.count(name, amount)
+
+def frame():
+    if _registry is not None:
+        _registry.frame()
+
+def gauge(name, function):
+    _gauges[name] = function
+
+
+def serve(port, address='127.0.0.1'):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # Imported here. Most of metrics' import time, and unused until served.
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = current().prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/stats':
+                body, content_type = json.dumps(current().snapshot()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # Scrapes every few seconds would otherwise flood the console.
+            pass
+
+    server = ThreadingHTTPServer((address, int(port)), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    print('Metrics - Prometheus endpoint: http://{}:{}/metrics'.format(address, port))
+    return(server)
+
+def json_stats(interval):
+    while True:
+        sleep(float(interval))
+        print(json.dumps(current().snapshot()))
@@ -0,0 +1,274 @@
+# 2020/06 BuRnCycL
+# Multi-process mode (--processes). Splits the visualizer over three processes so it isn't stuck on one core under the GIL:
+#   capture  - audio input + spectrum processing, publishes spectra
+#   render   - visualizations (same modes and switching as single process), publishes LED frames
+#   output   - Blinkstick writes and/or UDP transmit
+# Processes exchange data through multiprocessing.shared_memory ring slots with sequence counters, not pickled queues.
+# Readers always take the newest slot, so a slow stage skips stale data rather than building a backlog. A pipe wakes the reader
+# when a slot is published, so it doesn't poll.
+# Worth it when a stage's work per frame is large next to the cost of handing data between processes (tens of microseconds),
+# e.g. long strips with --scale, large --fft-size, or slow USB writes, on a multi-core device. See benchmark.py multiprocess.
+# Uses the fork start method (Linux, e.g. Raspberry Pi), so the audio source object can be handed to the capture process as is.
+# With metrics enabled, each process keeps its own and publishes them as JSON to a ring of its own every second. The parent serves
+# them merged (see metrics.collect()).
+
+import json, os, select, zlib
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from threading import Thread
+from time import monotonic, sleep
+from device_output import NullSink
+import metrics
+
+
+POLL_INTERVAL = .0005 # Seconds between checks for a new slot, for rings without a notifier.
+WAKE_INTERVAL = .1 # Longest a notified reader blocks before checking whether it should stop.
+METRICS_BYTES = 262144 # Room for one process's metrics state as JSON. Histograms keep at most metrics.ROLLING recent samples each.
+METRICS_INTERVAL = 1 # Seconds between metrics publishes.
+
+
+# Wakes a ring's reader when a slot is published. A pipe made before forking: the writer adds a byte per publish without ever blocking
+# (a full pipe means wake ups are already pending), and the reader blocks in select() until there's one, then drains it.
+class RingNotifier:
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def notify(self):
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            pass
+
+    # True if woken, False after timeout seconds.
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.read_fd], [], [], timeout)
+        if ready:
+            try:
+                os.read(self.read_fd, 65536)
+            except BlockingIOError:
+                pass
+        return(bool(ready))
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+# Seqlock style ring of fixed size slots. Header (int64): latest sequence, then per slot sequence and length, then per slot timestamp
+# (float64), then per slot CRC32. A slot's sequence is -1 while it's being written, and its CRC32 (of the data, seeded with the sequence)
+# is checked after the copy. The stores aren't fenced, and e.g. ARM (Raspberry Pi) may make them visible out of order, so the CRC is what
+# rejects a torn read, or one that sees the new sequence before the data. Rejected reads are retried.
+# notifier (a RingNotifier, shared by writer and reader) wakes the reader on publish. Without one, the reader polls.
+class SharedRing:
+    def __init__(self, capacity, dtype=np.float64, slots=4, name=None, notifier=None):
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        header = 8*(1 + slots*4)
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=header + slots*self.capacity*self.dtype.itemsize)
+        self.owner = create
+        self.notifier = notifier
+        self.header = np.ndarray((1 + slots*2,), dtype=np.int64, buffer=self.shm.buf)
+        self.timestamps = np.ndarray((slots,), dtype=np.float64, buffer=self.shm.buf, offset=8*(1 + slots*2))
+        self.checksums = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf, offset=8*(1 + slots*3))
+        self.data = np.ndarray((slots, self.capacity), dtype=self.dtype, buffer=self.shm.buf, offset=header)
+        if create:
+            self.header[:] = 0
+
+    def latest(self):
+        return(int(self.header[0]))
+
+    # Writer side. Single writer per ring. Longer arrays are truncated to capacity.
+    def publish(self, array, timestamp=None):
+        array = np.asarray(array).reshape(-1)
+        length = min(len(array), self.capacity)
+        sequence = self.latest() + 1
+        slot = sequence % self.slots
+        self.header[1 + slot] = -1
+        self.data[slot, :length] = array[:length]
+        self.header[1 + self.slots + slot] = length
+        self.timestamps[slot] = monotonic() if timestamp is None else timestamp
+        self.checksums[slot] = zlib.crc32(self.data[slot, :length], sequence & 0xFFFFFFFF)
+        self.header[1 + slot] = sequence
+        self.header[0] = sequence
+        if self.notifier is not None:
+            self.notifier.notify()
+        return(sequence)
+
+    # Copy the newest slot into out. Returns (sequence, length, timestamp), or None if it was overwritten mid-read.
+    def read(self, out):
+        sequence = self.latest()
+        slot = sequence % self.slots
+        if self.header[1 + slot] != sequence:
+            return(None)
+        length = int(self.header[1 + self.slots + slot])
+        if not 0 <= length <= self.capacity:
+            return(None)
+        out[:length] = self.data[slot, :length]
+        timestamp = float(self.timestamps[slot])
+        checksum = int(self.checksums[slot])
+        if self.header[1 + slot] != sequence: # Writer lapped us.
+            return(None)
+        if zlib.crc32(out[:length], sequence & 0xFFFFFFFF) != checksum: # Torn, or its stores were seen out of order.
+            return(None)
+        return(sequence, length, timestamp)
+
+    # Generator of (array view, timestamp) for every new slot, newest only. Counts skipped slots in self.skipped.
+    # Note: The same output array is reused for every item.
+    def reader(self, stop=None, timeout=None):
+        out = np.zeros(self.capacity, dtype=self.dtype)
+        seen = 0
+        self.skipped = 0
+        waited = monotonic()
+        while stop is None or not stop.is_set():
+            if self.latest() <= seen:
+                if timeout is not None and monotonic() - waited > timeout:
+                    return
+                if self.notifier is not None:
+                    self.notifier.wait(WAKE_INTERVAL if timeout is None else min(WAKE_INTERVAL, timeout))
+                else:
+                    sleep(POLL_INTERVAL)
+                continue
+            result = self.read(out)
+            if result is None:
+                continue
+            sequence, length, timestamp = result
+            self.skipped += sequence - seen - 1
+            seen = sequence
+            waited = monotonic()
+            yield out[:length], timestamp
+
+    def close(self):
+        del self.header, self.timestamps, self.checksums, self.data # Views must go before the buffer can be released.
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            if self.notifier is not None:
+                self.notifier.close()
+
+
+# Sink for the render process. Same interface as DeviceOutput, publishes frames to a SharedRing instead.
+class SharedFrameSink:
+    def __init__(self, ring):
+        self.ring = ring
+        self.frames = 0
+        self.timestamp = None # Capture time of the spectrum being rendered, carried through to the output process.
+
+    def send(self, data):
+        self.frames += 1
+        self.ring.publish(np.frombuffer(bytes(data), dtype=np.uint8), self.timestamp)
+        return(False)
+
+    def stats(self):
+        return({'shared': {'writes': self.frames}})
+
+    def stop(self):
+        pass
+
+
+# Child side. This process's metrics, published every interval until stop.
+def publish_metrics(metrics_name, stop, interval=METRICS_INTERVAL):
+    metrics.forked()
+    ring = SharedRing(METRICS_BYTES, dtype=np.uint8, slots=2, name=metrics_name)
+    def publish():
+        while not stop.is_set():
+            data = json.dumps(metrics.registry().state(), default=float).encode()
+            if len(data) <= ring.capacity:
+                ring.publish(np.frombuffer(data, dtype=np.uint8))
+            else:
+                print('ERROR - Metrics state is {} bytes, more than the {} shared for it. Not published.'.format(len(data), ring.capacity))
+            sleep(interval)
+    Thread(target=publish, daemon=True).start()
+
+# Parent side. The newest state published to ring, or None if there's none yet.
+def read_metrics(ring):
+    out = np.zeros(ring.capacity, dtype=np.uint8) # Per call, as scrapes can overlap.
+    while ring.latest() > 0:
+        result = ring.read(out)
+        if result is not None:
+            return(json.loads(out[:result[1]].tobytes().decode()))
+    return(None)
+
+def capture_process(viz_class, kwargs, spectra_name, led_count, stop, metrics_name=None, spectra_notifier=None):
+    if metrics_name is not None:
+        publish_metrics(metrics_name, stop)
+    spectra = SharedRing(led_count, name=spectra_name, notifier=spectra_notifier)
+    viz = viz_class(**dict(kwargs, led_count=led_count, transmit=False, receive=False, inputonly=False, sink=NullSink(), record=None))
+    for frame in viz.led_data():
+        spectra.publish(frame)
+        if stop.is_set():
+            break
+
+def render_process(viz_class, kwargs, spectra_name, frames_name, led_count, modes, stop, metrics_name=None, spectra_notifier=None, frames_notifier=None):
+    if metrics_name is not None:
+        publish_metrics(metrics_name, stop)
+    spectra = SharedRing(led_count, name=spectra_name, notifier=spectra_notifier)
+    frames = SharedRing(led_count*3, dtype=np.uint8, name=frames_name, notifier=frames_notifier)
+    sink = SharedFrameSink(frames)
+    def spectrum_stream(): # Carries each spectrum's capture timestamp through to the frame rendered from it.
+        for spectrum, timestamp in spectra.reader(stop):
+            sink.timestamp = timestamp
+            yield spectrum
+    viz = viz_class(**dict(kwargs, led_count=led_count, transmit=False, receive=False, inputonly=False, sink=sink, audio_input=False, spectra=spectrum_stream(), record=None))
+    viz.main(modes=modes)
+
+def output_process(viz_class, kwargs, connection, stop, metrics_name=None, frames_notifier=None):
+    if metrics_name is not None:
+        publish_metrics(metrics_name, stop)
+    viz = viz_class(**dict(kwargs, audio_input=False)) # Discovers Blinksticks (which sets the LED count) and receive nodes. Records, if asked to.
+    led_count = int(viz.led_count) # Rings are sized from it, so never a string (e.g. straight from the command line).
+    connection.send(led_count)
+    frames_name = connection.recv() # Created by the parent once the LED count is known.
+    frames = SharedRing(led_count*3, dtype=np.uint8, name=frames_name, notifier=frames_notifier)
+    try:
+        for frame, timestamp in frames.reader(stop):
+            viz.send_to_stick(frame)
+    finally:
+        viz.close() # Forked processes exit without atexit handlers, so the show file is closed here.
+
+def run(viz_class, kwargs, modes):
+    context = mp.get_context('fork')
+    resource_tracker.ensure_running() # Before forking, so every process shares ours. Otherwise the output process (forked before any ring
+                                      # exists) starts its own, which unlinks the frame ring under us when that process exits.
+    stop = context.Event()
+    parent_connection, child_connection = context.Pipe()
+    metrics_rings = {}
+    if metrics.enabled(): # Created before any process starts, so each one has its ring from the start.
+        for role in ('capture', 'render', 'output'):
+            ring = metrics_rings[role] = SharedRing(METRICS_BYTES, dtype=np.uint8, slots=2)
+            metrics.collect(role + '_', lambda ring=ring: read_metrics(ring))
+    names = {role: ring.shm.name for role, ring in metrics_rings.items()}
+    spectra_notifier, frames_notifier = RingNotifier(), RingNotifier() # Made now, as the output process is forked before the rings are.
+    output = context.Process(target=output_process, args=(viz_class, kwargs, child_connection, stop, names.get('output'), frames_notifier), daemon=True)
+    output.start()
+    led_count = int(parent_connection.recv())
+    spectra = SharedRing(led_count, notifier=spectra_notifier)
+    frames = SharedRing(led_count*3, dtype=np.uint8, notifier=frames_notifier)
+    parent_connection.send(frames.shm.name)
+    processes = [
+        output,
+        context.Process(target=render_process, args=(viz_class, kwargs, spectra.shm.name, frames.shm.name, led_count, modes, stop, names.get('render'), spectra_notifier, frames_notifier), daemon=True),
+        context.Process(target=capture_process, args=(viz_class, kwargs, spectra.shm.name, led_count, stop, names.get('capture'), spectra_notifier), daemon=True),
+        ]
+    for process in processes[1:]:
+        process.start()
+    print('Multi-process mode: capture (pid {}), render (pid {}), output (pid {}).'.format(processes[2].pid, processes[1].pid, output.pid))
+    try:
+        while all(process.is_alive() for process in processes):
+            sleep(1)
+        print('ERROR - A pipeline process exited. Stopping.')
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for process in processes:
+        process.join(timeout=2)
+        if process.is_alive():
+            process.terminate()
+    spectra.close()
+    frames.close()
+    for ring in metrics_rings.values():
+        ring.close()
@@ -0,0 +1,98 @@
+# 2020/06 BuRnCycL
+# Receive nodes known to a transmit node, keyed by node ID. Auto discovered nodes are evicted once their announcements stop
+# for longer than the TTL, so frames only go to live nodes. Nodes from receive_nodes.list are static and never evicted.
+# Writers (discovery, clock sync) take the lock. The transmit loop reads addresses(), an immutable tuple that's only rebuilt
+# when the set of nodes changes, without locking.
+
+from threading import Lock
+from time import monotonic
+
+
+DEFAULT_TTL = 35 # Seconds. A bit over three of a discovered node's 10s announcements.
+ACK_INTERVAL = 1 # Seconds. At most one acknowledgement per node per interval, however often it announces.
+
+
+class Node:
+    def __init__(self, node_id, address, led_count=0, capabilities=(), static=False):
+        self.node_id = node_id
+        self.address = address
+        self.led_count = led_count
+        self.capabilities = tuple(capabilities) # e.g. ('frame', 'spectrum').
+        self.static = static
+        self.last_seen = monotonic()
+        self.last_acknowledged = None
+        self.clock = None # (offset ms, jitter ms, expired frames) from the node's clock sync requests.
+
+    def __str__(self):
+        return('{} ({}, {} LEDs{})'.format(self.node_id, self.address, self.led_count or '?', ', ' + ', '.join(self.capabilities) if self.capabilities else ''))
+
+
+class NodeRegistry:
+    def __init__(self, ttl=DEFAULT_TTL, ack_interval=ACK_INTERVAL):
+        self.ttl = ttl
+        self.ack_interval = ack_interval
+        self.lock = Lock()
+        self.nodes = {}
+        self.by_address = {}
+        self.snapshot = ()
+
+    def rebuild(self): # Call with the lock held.
+        self.by_address = {node.address: node for node in self.nodes.values()}
+        self.snapshot = tuple(self.by_address)
+
+    # Addresses of live nodes. Same tuple object until a node is added, moves, or is evicted.
+    def addresses(self):
+        return(self.snapshot)
+
+    def add_static(self, address):
+        with self.lock:
+            node = self.nodes[address] = Node(address, address, static=True)
+            self.rebuild()
+            return(node)
+
+    # An announcement. Returns (node, new), where new is True for a node we didn't know or one that changed address.
+    # node_id must be unique per node (receive nodes send hostname and MAC, see transport.node_id), as a known ID from another address is taken as that node having moved.
+    def seen(self, node_id, address, led_count=0, capabilities=()):
+        with self.lock:
+            node = self.nodes.get(node_id)
+            new = node is None or node.address != address
+            if node is None:
+                node = self.nodes[node_id] = Node(node_id, address, led_count, capabilities)
+            else:
+                node.last_seen = monotonic()
+                node.address, node.led_count, node.capabilities = address, led_count, tuple(capabilities)
+            if new:
+                self.rebuild()
+            return(node, new)
+
+    # True if node should be acknowledged now. Records the acknowledgement.
+    def acknowledge(self, node):
+        now = monotonic()
+        with self.lock:
+            if node.last_acknowledged is not None and now - node.last_acknowledged < self.ack_interval:
+                return(False)
+            node.last_acknowledged = now
+            return(True)
+
+    # Nodes not seen within the TTL. Removes and returns them.
+    def evict(self):
+        now = monotonic()
+        with self.lock:
+            expired = [node for node in self.nodes.values() if not node.static and now - node.last_seen > self.ttl]
+            for node in expired:
+                del self.nodes[node.node_id]
+            if expired:
+                self.rebuild()
+        return(expired)
+
+    def report_clock(self, address, report):
+        node = self.by_address.get(address)
+        if node is not None:
+            node.clock = report
+
+    def list(self):
+        with self.lock:
+            return(list(self.nodes.values()))
+
+    def __len__(self):
+        return(len(self.nodes))
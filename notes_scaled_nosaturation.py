@@ -55,6 +55,56 @@ def human_hearing_multiplier(freq):
         decibels = ((x2-freq)*y1 + (freq-x1)*y2)/(x2-x1)
         return 10.0**(decibels/10.0)
 
+# Vectorized human_hearing_multiplier for an array of frequencies. Clamps above 20kHz instead of failing.
+HEARING_POINTS = ((0, -3), (50, -2), (100, -1), (200, 2), (500, 3), (1000, 6), (2000, 4), (5000, 2), (10000, -1), (15000, 0), (20000, -2))
+
+def human_hearing_multipliers(freqs):
+        points, decibels = zip(*HEARING_POINTS)
+        return 10.0**(np.interp(freqs, points, decibels)/10.0)
+
+def hz_to_mel(freq):
+        return 2595.0*np.log10(1.0 + np.asarray(freq)/700.0)
+
+def mel_to_hz(mel):
+        return 700.0*(10.0**(np.asarray(mel)/2595.0) - 1.0)
+
+# Band edges (num_leds + 2 points) from min_freq to max_freq, spaced on the given scale: linear, log, or mel.
+def band_edges(num_leds, min_freq, max_freq, scale):
+        if scale == 'linear':
+                return np.linspace(min_freq, max_freq, num_leds + 2)
+        elif scale == 'log':
+                return np.geomspace(min_freq, max_freq, num_leds + 2)
+        elif scale == 'mel':
+                return mel_to_hz(np.linspace(hz_to_mel(min_freq), hz_to_mel(max_freq), num_leds + 2))
+        raise ValueError('Unknown band scale: {} (Options: linear, log, mel)'.format(scale))
+
+# [num_leds x num_bins] weight matrix mapping FFT magnitude bins to LEDs. Built once, applied per frame with one matrix-vector product.
+# Each LED is a triangular filter between its neighbours' center frequencies, normalized to an average so LED counts don't change levels.
+# Bands narrower than one FFT bin (low end of log/mel at small windows) interpolate between the two nearest bins instead.
+# The ear curve is folded in at each band's center frequency.
+def band_weights(num_leds, num_samples, sample_rate, scale='mel', min_freq=40, max_freq=16000):
+        num_bins = num_samples//2
+        bin_freqs = np.arange(num_bins)*float(sample_rate)/num_samples
+        max_freq = min(float(max_freq), bin_freqs[-1])
+        min_freq = max(float(min_freq), bin_freqs[1] if scale != 'linear' else 0.0)
+        edges = band_edges(num_leds, min_freq, max_freq, scale)
+        lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+        rising = (bin_freqs - lower)/(center - lower)
+        falling = (upper - bin_freqs)/(upper - center)
+        weights = np.maximum(0, np.minimum(rising, falling))
+        position = edges[1:-1]*num_samples/float(sample_rate) # Center frequency as a fractional bin index.
+        below = np.clip(np.floor(position).astype(int), 0, num_bins-1)
+        above = np.clip(below + 1, 0, num_bins-1)
+        fraction = position - below
+        interpolated = np.zeros_like(weights)
+        rows = np.arange(num_leds)
+        interpolated[rows, below] += 1 - fraction
+        interpolated[rows, above] += fraction
+        narrow = weights.sum(axis=1) < 1 # Fewer than one bin's worth of triangle.
+        weights[narrow] = interpolated[narrow]
+        weights /= weights.sum(axis=1, keepdims=True)
+        return weights * human_hearing_multipliers(edges[1:-1])[:, None]
+
 def schur(array_stream, multipliers):
         for array in array_stream:
                 yield array*multipliers
@@ -73,17 +123,103 @@ def rolling_scale_to_max(stream, falloff):
                 else:
                         yield array / avg_peak
 
+# Stateful equivalent of the generator chain above. Does one real FFT over both channels per frame,
+# with the ear weighting and noise floor precomputed, writing every stage into preallocated buffers.
+# Note: The same output buffer is returned every frame (just like rolling_smooth yields the same array).
+# scale=None keeps the original mapping (LED i is FFT bin i). linear, log, or mel spread num_leds bands from min_freq to max_freq via band_weights().
+# hann=True tapers each window with a precomputed Hann window (less leakage between bins, which overlapping windows make up for in time).
+# It's normalized to an average of 1, so levels stay comparable to the noise floor. The default (no taper) is the original output.
+class SpectrumEngine:
+        def __init__(self, num_leds, num_samples, sample_rate, sensitivity, noise_amount=2000, scale_falloff=1, smooth_falloff=.6, scale=None, min_freq=40, max_freq=16000, hann=False):
+                self.num_leds = int(num_leds)
+                self.num_samples = int(num_samples)
+                sample_rate = float(sample_rate)
+                if scale is None:
+                        # LED i is bin i. Like the original, LEDs past the last bin (num_samples//2) get nothing, so they stay dark.
+                        self.num_bins = min(self.num_leds, self.num_samples//2)
+                        self.multipliers = np.zeros(self.num_leds)
+                        self.multipliers[:self.num_bins] = human_hearing_multipliers(np.arange(self.num_bins)*sample_rate/self.num_samples)
+                        self.noise_floor = self.multipliers * noise_amount # (notes + amount) * multipliers, distributed.
+                        self.weights = None
+                else:
+                        self.weights = band_weights(self.num_leds, self.num_samples, sample_rate, scale, min_freq, max_freq)
+                        self.noise_floor = self.weights.sum(axis=1) * noise_amount # weights @ (bins + amount), distributed. Taken before the fold-in, like the unscaled path adding amount once per bin.
+                        self.weights[:, 1:] *= 2 # Folds in the mirrored half of the full complex FFT.
+                        self.num_bins = self.num_samples//2
+                self.sensitivity = float(sensitivity)
+                self.scale_falloff = scale_falloff
+                self.smooth_falloff = smooth_falloff
+                self.hann = np.hanning(self.num_samples)/np.hanning(self.num_samples).mean() if hann else None
+                self.avg_peak = 0.0 # rolling_scale_to_max state.
+                self.primed = False # rolling_smooth state. False until the first frame has been seen.
+                # Preallocated buffers.
+                self.window = np.zeros((2, self.num_samples)) # Left and right channels, so both go through one rfft call.
+                self.magnitudes = np.zeros((2, self.num_bins))
+                self.bins = np.zeros(self.num_bins)
+                self.notes = np.zeros(self.num_leds)
+                self.smooth = np.zeros(self.num_leds)
+
+        def reset(self):
+                self.avg_peak = 0.0
+                self.primed = False
+
+        def update(self, l, r):
+                self.window[0] = l
+                self.window[1] = r
+                if self.hann is not None:
+                        self.window *= self.hann
+                spectrum = np.fft.rfft(self.window, axis=1)
+                np.abs(spectrum[:, :self.num_bins], out=self.magnitudes)
+                notes = self.notes
+                if self.weights is None:
+                        np.add(self.magnitudes[0], self.magnitudes[1], out=notes[:self.num_bins]) # Past the last bin stays 0.
+                        notes[1:] *= 2 # Folds in the mirrored half of the full complex FFT.
+                        # add_white_noise + schur
+                        nonzero = notes.any()
+                        notes *= self.multipliers
+                else:
+                        np.add(self.magnitudes[0], self.magnitudes[1], out=self.bins)
+                        nonzero = self.bins.any()
+                        np.dot(self.weights, self.bins, out=notes) # Band mapping and ear weighting in one BLAS call.
+                if nonzero:
+                        notes += self.noise_floor
+                # rolling_scale_to_max
+                peak = notes.max()
+                if peak > self.avg_peak:
+                        self.avg_peak = peak
+                else:
+                        self.avg_peak *= self.scale_falloff
+                        self.avg_peak += peak * (1-self.scale_falloff)
+                if self.avg_peak != 0:
+                        notes /= self.avg_peak
+                # exaggerate
+                np.power(notes, self.sensitivity, out=notes)
+                # rolling_smooth
+                if self.primed:
+                        self.smooth *= self.smooth_falloff
+                        notes *= (1 - self.smooth_falloff)
+                        self.smooth += notes
+                else:
+                        self.smooth[:] = notes
+                        self.primed = True
+                return self.smooth
+
+        def stream(self, audio_stream):
+                for l, r in audio_stream:
+                        yield self.update(l, r)
+
+# Resample a spectrum to count bands, e.g. from the transmitted band count to a receive node's LED count.
+# Averages groups of bands when shrinking, interpolates between bands when growing.
+def resample_bands(values, count):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == count:
+                return values
+        if count < len(values):
+                starts = (np.arange(count)*len(values))//count
+                return np.add.reduceat(values, starts)/np.diff(np.append(starts, len(values)))
+        return np.interp(np.linspace(0, len(values)-1, count), np.arange(len(values)), values)
+
 # [[Float 0.0-1.0 x 32]]
 def process(audio_stream, num_leds, num_samples, sample_rate, sensitivity):
-        frequencies = [float(sample_rate*i)/num_samples for i in range(num_leds)]
-        human_ear_multipliers = np.array([human_hearing_multiplier(f) for f in frequencies])
-        notes = fft(audio_stream)
-        notes = scale_samples(notes, num_leds)
-        notes = add_white_noise(notes, amount=2000)
-        notes = schur(notes, human_ear_multipliers)
-        #notes = rolling_scale_to_max(notes, falloff=.98) # Range: 0-1
-        notes = rolling_scale_to_max(notes, falloff=1) # Range: 0-1
-        notes = exaggerate(notes, exponent=sensitivity)
-        notes = rolling_smooth(notes, falloff=.6)
-        return notes
+        return SpectrumEngine(num_leds, num_samples, sample_rate, sensitivity).stream(audio_stream)
 
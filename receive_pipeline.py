@@ -0,0 +1,147 @@
+# 2020/06 BuRnCycL
+# Latest-frame-wins receive pipeline. The network thread keeps only the newest frame by sequence number,
+# the output thread pushes it to the Blinksticks at its own pace. A slow USB write no longer backs up the socket,
+# and late or reordered packets are thrown away instead of being displayed out of order.
+# Frames with a presentation time (TIMED) are held until then instead, so every node shows them together, and dropped if they miss it.
+
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic, time
+import metrics
+
+
+SEQUENCE_MODULO = 2**32 # Sequence numbers are uint32 on the wire and wrap around.
+RESYNC_WINDOW = 500 # A jump further than this many frames (either way) means the transmitter restarted. Start over from it.
+PLAYOUT_TOLERANCE = .02 # Seconds past its presentation time a frame may still be shown. About a frame at 50 FPS.
+PLAYOUT_DEPTH = 64 # Most timed frames held at once. More than a second at 50 FPS.
+
+
+# Serial number arithmetic: how far ahead sequence is of previous. Negative when older (late or duplicated).
+def sequence_distance(sequence, previous):
+    distance = (sequence - previous) % SEQUENCE_MODULO
+    if distance >= SEQUENCE_MODULO//2:
+        distance -= SEQUENCE_MODULO
+    return(distance)
+
+
+class ReceiveStats:
+    def __init__(self):
+        self.received = 0 # Frames accepted from the network.
+        self.lost = 0 # Sequence numbers never seen (gaps).
+        self.late = 0 # Arrived after a newer frame. Discarded.
+        self.dropped = 0 # Replaced by a newer frame before the output thread got to it.
+        self.expired = 0 # Missed their presentation time. Discarded.
+        self.buffered = 0 # Timed frames waiting for their presentation time.
+        self.displayed = 0 # Written to the Blinksticks.
+        self.latency_total = 0.0 # Receive to display, in seconds.
+        self.latency_max = 0.0
+
+    def snapshot(self):
+        stats = dict(vars(self))
+        stats['latency_avg'] = self.latency_total/self.displayed if self.displayed else 0.0
+        del stats['latency_total']
+        return(stats)
+
+    def __str__(self):
+        stats = self.snapshot()
+        return('Received: {received}, Displayed: {displayed}, Lost: {lost}, Late: {late}, Dropped: {dropped}, Expired: {expired}, Buffered: {buffered}, Latency avg/max: {:.1f}/{:.1f}ms'.format(
+            stats['latency_avg']*1000, stats['latency_max']*1000, **stats))
+
+
+class FrameMailbox:
+    def __init__(self, tolerance=PLAYOUT_TOLERANCE, depth=PLAYOUT_DEPTH):
+        self.condition = Condition()
+        self.frames = deque() # (frame, received at, due). due is None for untimed frames, and then it's the only one held.
+        self.tolerance = tolerance
+        self.depth = depth
+        self.last_sequence = None
+        self.stats = ReceiveStats()
+
+    # Network side. Returns False if the frame was older than one we've already accepted.
+    def offer(self, sequence):
+        with self.condition:
+            if self.last_sequence is not None:
+                distance = sequence_distance(sequence, self.last_sequence)
+                if -RESYNC_WINDOW <= distance <= 0:
+                    self.stats.late += 1
+                    return(False)
+                elif 0 < distance <= RESYNC_WINDOW:
+                    self.stats.lost += distance - 1
+            self.last_sequence = sequence
+            return(True)
+
+    # presentation_time is when to show the frame, on our wall clock (see ClockSync.local_time). None shows the newest frame as soon as possible.
+    def put(self, frame, presentation_time=None):
+        received_at = monotonic()
+        with self.condition:
+            self.stats.received += 1
+            if presentation_time is None:
+                self.stats.dropped += len(self.frames)
+                self.frames.clear()
+                self.frames.append((frame, received_at, None))
+            else:
+                due = received_at + presentation_time - time()
+                if received_at - due > self.tolerance: # Arrived too late to be shown in time.
+                    self.stats.expired += 1
+                    return
+                if self.frames and self.frames[-1][2] is None: # Switching from untimed frames.
+                    self.stats.dropped += len(self.frames)
+                    self.frames.clear()
+                if len(self.frames) >= self.depth:
+                    self.frames.popleft()
+                    self.stats.dropped += 1
+                self.frames.append((frame, received_at, due))
+            self.stats.buffered = len(self.frames)
+            self.condition.notify()
+
+    # Output side. Blocks until a frame newer than the last one taken is due, or timeout (frame is None).
+    def take(self, timeout=None):
+        end = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while True:
+                now = monotonic()
+                wait = None if end is None else end - now
+                if self.frames:
+                    frame, received_at, due = self.frames[0]
+                    if due is None or now >= due:
+                        self.frames.popleft()
+                        self.stats.buffered = len(self.frames)
+                        if due is not None and now - due > self.tolerance: # Output thread fell behind.
+                            self.stats.expired += 1
+                            continue
+                        return(frame, received_at)
+                    wait = due - now if wait is None else min(wait, due - now)
+                if wait is not None and wait <= 0:
+                    return(None, 0.0)
+                self.condition.wait(wait) # Woken early by put(), e.g. for an untimed frame.
+
+    def displayed(self, received_at):
+        latency = monotonic() - received_at
+        with self.condition:
+            self.stats.displayed += 1
+            self.stats.latency_total += latency
+            self.stats.latency_max = max(self.stats.latency_max, latency)
+
+
+class OutputWorker:
+    def __init__(self, mailbox, output, report_interval=10):
+        self.mailbox = mailbox
+        self.output = output # Callable taking one frame, e.g. BlinkStickViz.send_to_stick.
+        self.report_interval = report_interval # Seconds between stats lines. 0 disables.
+        self.running = False
+
+    def start(self):
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        reported = monotonic()
+        while self.running:
+            frame, received_at = self.mailbox.take(timeout=1)
+            if frame is not None:
+                self.output(frame)
+                self.mailbox.displayed(received_at)
+                metrics.frame()
+            if self.report_interval and monotonic() - reported >= self.report_interval:
+                print('UDP Receive Stats - {}'.format(self.mailbox.stats))
+                reported = monotonic()
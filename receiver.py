@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# 2020/06 BuRnCycL
+# Receive node runtime. ReceiveNode is the network side of receive mode: UDP frames/spectra, announcements, and clock sync.
+# visualizer.py --receive uses it too. Run directly, this is a fast start receive node for e.g. Pi Zeros, showing LED data from
+# a transmit node: no audio, spectrum, or visualization code is imported, and netifaces/blinkstick/http.server only when used.
+# Usage: python3 receiver.py [--interface eth0] [--multicast [GROUP]] [--metrics-port PORT] [--brightness 0.5 --gamma 2.2]
+
+import sys, struct, argparse
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_RCVBUF
+from threading import Thread
+from time import sleep, time, monotonic
+import wire_protocol
+import metrics
+from receive_pipeline import FrameMailbox, OutputWorker
+from clock_sync import ClockSync
+from transport import multicast_receive_socket, interface_address, node_id, DEFAULT_GROUP
+from device_output import DeviceOutput, find_blinksticks
+from layout import read_layouts
+
+
+RECEIVE_PORT = 12000 # UDP frames, acknowledgements, and clock sync replies.
+DISCOVERY_PORT = 50000 # UDP broadcast announcements.
+IDENTIFIER = 'blinkstickviz' # Identifier to insure we only talk to compatible devices.
+
+
+class ReceiveNode:
+    def __init__(self, led_count, network_interface='eth0', multicast=None, spectrum=False, address='0.0.0.0', port=RECEIVE_PORT, discovery_port=DISCOVERY_PORT, identifier=IDENTIFIER):
+        self.led_count = led_count # Announced, so the transmit node knows what we have.
+        self.network_interface = network_interface
+        self.multicast = multicast # Multicast group to join. None receives unicast only.
+        self.spectrum = spectrum # True when this node renders a received spectrum itself, False to show received LED data.
+        self.address = address
+        self.port = port
+        self.discovery_port = discovery_port
+        self.identifier = identifier
+        self.mailbox = FrameMailbox() # Newest frame (or timed frames) for the output thread.
+        self.decoder = wire_protocol.FrameDecoder()
+        self.clock = ClockSync() # Transmit node's clock, for frames with a presentation time.
+        self.transmitter_address = None # Where timed frames come from. Clock sync requests go there.
+        self.acknowledged = False # By default we haven't been acknowledged, as a discovered device.
+        self.mismatch_reported = False # Frames and spectra are each only useful in one receive mode. Say so once.
+        self.receive_socket = None
+
+    def capabilities(self):
+        return(['spectrum' if self.spectrum else 'frame', 'sync'] + (['multicast'] if self.multicast is not None else []))
+
+    def start(self):
+        metrics.gauge('receive', lambda: self.mailbox.stats.snapshot()) # Lost, late, dropped, expired, displayed, latency.
+        metrics.gauge('clock', lambda: self.clock.snapshot()) # Offset from the transmit node's clock, delay, jitter.
+        Thread(target=self.receive).start() # UDP Receive Mode data on separate thread.
+        Thread(target=self.announce).start() # UDP Broadcast announce we're on the network and ready to receive data via separate thread.
+
+    def receive(self):
+        print('UDP Receive Mode. Listening on: {}, Port: {}'.format(self.address, self.port))
+        try:
+            if self.multicast is not None: # Join the group. Unicast frames and acknowledgements arrive on the same socket.
+                receive_socket = multicast_receive_socket(self.port, group=self.multicast, interface=interface_address(self.network_interface))
+                print('UDP Receive Mode. Joined Multicast Group: {}'.format(self.multicast))
+            else:
+                receive_socket = socket(AF_INET, SOCK_DGRAM) # Create UDP socket.
+                receive_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 262144) # Room for bursts. Lag is handled by only ever displaying the newest frame.
+                receive_socket.bind((self.address, self.port))
+        except Exception as e:
+            print('ERROR - Unable to bind to address - {}'.format(e))
+            sys.exit(1)
+        self.receive_socket = receive_socket # Clock sync requests go out on it too.
+
+        while 1:
+            data, addr = receive_socket.recvfrom(wire_protocol.MAX_DATAGRAM)
+            received_at = time()
+            try:
+                message = wire_protocol.unpack(data)
+                presentation_time = None
+                if message.flags & wire_protocol.TIMED: # Show at the transmit node's presentation time, once we know its clock.
+                    if self.transmitter_address != addr:
+                        print('Clock Sync - Timed frames from {}. Syncing clocks.'.format(addr[0]))
+                        self.clock = ClockSync() # New (or restarted) transmit node.
+                        first = self.transmitter_address is None
+                        self.transmitter_address = addr
+                        if first:
+                            Thread(target=self.clock_sync, daemon=True).start()
+                    if self.clock.synced():
+                        presentation_time = self.clock.local_time(message.timestamp/1000000)
+                if message.type == wire_protocol.ACKNOWLEDGE:
+                    self.acknowledged = True
+                elif message.type == wire_protocol.SYNC_REPLY:
+                    self.clock.update(message, received_at)
+                elif (message.type == wire_protocol.FRAME and self.spectrum) or (message.type == wire_protocol.SPECTRUM and not self.spectrum):
+                    if self.mismatch_reported == False:
+                        print('ERROR - Received {} data, but this node is set up for {}. Use --modes on receive nodes with --transmit-spectrum, and only then.'.format(
+                            'LED' if message.type == wire_protocol.FRAME else 'spectrum', 'spectrum' if self.spectrum else 'LED data'))
+                        self.mismatch_reported = True
+                elif message.type == wire_protocol.FRAME and self.mailbox.offer(message.sequence): # Late and reordered frames are discarded.
+                    leds = self.decoder.decode(message) # Raw frames are a view over the datagram, not a copy.
+                    if leds is not None: # None when a delta frame arrives without its base frame.
+                        self.mailbox.put(leds, presentation_time) # Hand the newest frame to the output thread.
+                elif message.type == wire_protocol.SPECTRUM and self.mailbox.offer(message.sequence):
+                    beat = bool(message.flags & wire_protocol.BEAT) # The transmit node's beat, so every node switches and accents together.
+                    self.mailbox.put((wire_protocol.decode_spectrum(message), beat), presentation_time) # Rendered by this node's own visualizations.
+            except (wire_protocol.ProtocolError, struct.error, ValueError) as e: # ValueError is a backstop for anything the protocol checks miss.
+                print('ERROR - Malformed packet - {}'.format(e))
+
+    # Announcement: identifier, node ID, LED count, capabilities, IP. The IP stays last, so older transmit nodes can still find it.
+    def announce(self):
+        try:
+            announce_socket = socket(AF_INET, SOCK_DGRAM) # Create UDP socket.
+            announce_socket.bind(('', 0))
+            announce_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1) # Broadcast socket.
+        except Exception as e:
+            print('ERROR - Unable to bind to address - {}'.format(e))
+            sys.exit(1)
+        my_ip = interface_address(self.network_interface, default=None)
+        if my_ip is None:
+            print('ERROR - Problem with Network Interface. Perhaps you did not define the proper NIC? (Default: eth0)')
+            sys.exit(1)
+        identity = node_id(self.network_interface, my_ip) # Hostname and MAC. Stays the same if our IP changes (e.g. a new DHCP lease).
+        capabilities = ','.join(self.capabilities())
+
+        # Time between announcements based on whether we've been acknowledged.
+        short_announce_interval = 1
+        long_announce_interval = 10
+
+        while 1:
+            if self.acknowledged == True: # If we've been acknowledged, stop announcing.
+                print('Auto Discovery - Discovered! Announcing to network every {}s...'.format(long_announce_interval))
+                sleep(long_announce_interval)
+            elif self.acknowledged == False:
+                print('Auto Discovery - Announcing to network every {}s...'.format(short_announce_interval))
+                sleep(short_announce_interval)
+            address = interface_address(self.network_interface, default=None) # Re-resolve, in case our address changed.
+            if address is None:
+                print('ERROR - Problem with Network Interface {}. Announcing last known address: {}'.format(self.network_interface, my_ip))
+            else:
+                my_ip = address
+            # Perform Announcement.
+            data = wire_protocol.announce('{} {} {} {} {}'.format(self.identifier, identity, self.led_count, capabilities, my_ip))
+            announce_socket.sendto(data, ('<broadcast>', self.discovery_port))
+
+    # A burst of exchanges to sync quickly, then one every few seconds to follow drift.
+    def clock_sync(self, burst=8, interval=2, report_interval=10):
+        reported = monotonic()
+        while 1:
+            request = wire_protocol.sync_request((self.clock.offset or 0.0)*1000, self.clock.jitter*1000, self.mailbox.stats.expired)
+            try:
+                self.receive_socket.sendto(request, self.transmitter_address)
+            except Exception as e:
+                print('ERROR - Unable to send clock sync request to {} - {}'.format(self.transmitter_address[0], e))
+            sleep(.25 if self.clock.exchanges < burst else interval)
+            if monotonic() - reported >= report_interval:
+                print('Clock Sync - {}'.format(self.clock))
+                reported = monotonic()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fast start receive node. Shows LED data from a transmit node (visualizer.py --transmit).')
+    parser.add_argument('-if', '--interface', help='Network Interface for receiving data (Default: eth0)', default='eth0')
+    parser.add_argument('-mc', '--multicast', help='Multicast group for frames (Default: disabled, {} if no group is given)'.format(DEFAULT_GROUP), default=None, nargs='?', const=DEFAULT_GROUP)
+    parser.add_argument('-mp', '--metrics-port', help='Prometheus metrics port (Default: disabled)', default=None, type=int)
+    parser.add_argument('-js', '--json-stats', help='Print JSON stats every N seconds (Default: disabled)', default=None, type=float)
+    parser.add_argument('-br', '--brightness', help='Blinkstick brightness, 0-1 (Default: 1)', default=1.0, type=float)
+    parser.add_argument('-gm', '--gamma', help='Blinkstick gamma correction (Default: 1, i.e. none)', default=1.0, type=float)
+    parser.add_argument('-ct', '--change-threshold', help='Skip Blinkstick writes that change no channel by more than this (Default: 0, identical frames only)', default=0, type=int)
+    parser.add_argument('-ka', '--keepalive', help='Write unchanged frames at least every this many seconds, 0 for every frame (Default: 1)', default=1.0, type=float)
+    args = parser.parse_args()
+    if args.metrics_port is not None or args.json_stats is not None:
+        metrics.enable(port=args.metrics_port, json_interval=args.json_stats)
+    sticks, led_count = find_blinksticks()
+    outputs = DeviceOutput(sticks, led_count, read_layouts(), brightness=args.brightness, gamma=args.gamma, threshold=args.change_threshold, keepalive=args.keepalive) # One output worker per Blinkstick, so they're written in parallel.
+    for stat in ('writes', 'skipped', 'bytes_written', 'bytes_skipped', 'errors', 'reconnects'): # Written vs skipped (unchanged) frames.
+        metrics.gauge('device_{}'.format(stat), lambda stat=stat: {device: stats[stat] for device, stats in outputs.stats().items()})
+    node = ReceiveNode(led_count, network_interface=args.interface, multicast=args.multicast)
+    OutputWorker(node.mailbox, outputs.send).start() # Blinkstick writes on their own thread, so a slow USB write never stalls the socket.
+    node.start()
@@ -0,0 +1,107 @@
+# 2020/06 BuRnCycL
+# NumPy-backed frame renderers for the Blinkstick Audio LED Visualizer.
+# Each renderer turns one processed audio frame ([Float 0.0-1.0 x led_count]) into GRB uint8 LED data.
+# Output is byte-identical to the original list-based pulse/flash loops, but without per-LED Python work.
+
+import numpy as np
+from colorsys import hsv_to_rgb
+
+
+# Per-index GRB multipliers for a fully saturated hue at value 1.0.
+# hsv_to_rgb(h, 1, v) is v times one of (1, 1-f, 1-(1-f), 0) per channel, so v * table[i] matches hsv_to_rgb(hue(i), 1, v) exactly.
+def grb_lookup_table(count, hue):
+    table = np.zeros((count, 3))
+    for i in range(count):
+        r, g, b = hsv_to_rgb(hue(i), 1, 1.0)
+        table[i] = (g, r, b)
+    return(table)
+
+
+class PulseRenderer:
+    def __init__(self, led_count, loop=False):
+        self.led_count = int(led_count)
+        self.loop = loop
+        # Pulse from both ends of the strip meets in the middle, so each half is half the strip.
+        self.length = int(self.led_count/2) if loop else self.led_count
+        self.colors = grb_lookup_table(self.led_count, lambda i: i/48.0) # Hue is picked by the brightest bin.
+        # Ring buffer of colors, written twice so [head:head+length] is always a contiguous newest-first view.
+        self.ring = np.zeros((self.length*2, 3), dtype=np.uint8)
+        self.head = 0
+        self.color = np.zeros(3)
+        self.frame = np.zeros((self.length*2 if loop else self.length, 3), dtype=np.uint8)
+        self.accent = False # Set by beat(). The next pulse goes out at full brightness.
+
+    # Beat effect (--beat-effects). Called before render() on frames that are on a beat.
+    def beat(self, bpm):
+        self.accent = True
+
+    def render(self, frame):
+        brightest = np.argmax(frame[:self.led_count])
+        np.multiply(self.colors[brightest], 1 if self.accent else min(frame[brightest]*1.2, 1), out=self.color)
+        self.accent = False
+        self.color *= 255
+        self.head = (self.head - 1) % self.length
+        self.ring[self.head] = self.color # Float to uint8 assignment truncates, like int().
+        self.ring[self.head + self.length] = self.ring[self.head]
+        view = self.ring[self.head:self.head + self.length]
+        if self.loop:
+            self.frame[:self.length] = view
+            self.frame[self.length:] = view[::-1]
+        else:
+            self.frame[:] = view
+        return(self.frame.reshape(-1))
+
+
+class FlashRenderer:
+    def __init__(self, led_count):
+        self.led_count = int(led_count)
+        self.colors = grb_lookup_table(self.led_count, lambda i: i/(self.led_count*1.75))
+        self.last_frame = np.zeros(self.led_count) # For smooth transitions, we need to know what things looked like last frame.
+        self.running_total = np.zeros(self.led_count)
+        self.value = np.zeros(self.led_count)
+        self.scratch = np.zeros(self.led_count)
+        self.size = np.zeros(self.led_count, dtype=np.intp)
+        self.grb = np.zeros((self.led_count, 3))
+        self.leds = np.zeros((self.led_count, 3), dtype=np.uint8)
+
+    def render(self, frame):
+        n = self.led_count
+        frame = frame[:n] if len(frame) > n else frame
+        # How loud things are. Summed left to right, same as the original loop, so section sizes truncate identically.
+        brightness = np.cumsum(frame, out=self.running_total)[-1]
+        if brightness == 0:
+            frame[:] = 1 # Note: Writes through to the caller's frame, which the original relied on.
+            self.size[:] = 1
+        else:
+            np.divide(frame, brightness, out=self.scratch)
+            self.scratch *= n
+            self.size[:] = self.scratch # Float to int assignment truncates, like int().
+            deficit = n - int(self.size.sum())
+            if deficit > 0: # Grow every non-empty section round robin until the strip is full.
+                growing = np.flatnonzero(self.size)
+                if len(growing) > 0:
+                    rounds, remainder = divmod(deficit, len(growing))
+                    self.size[growing] += rounds
+                    self.size[growing[:remainder]] += 1
+                else: # Every section truncated to 0 (e.g. a flat frame, like the first one after silence). One LED each keeps the strip full.
+                    self.size[:] = 1
+
+        np.multiply(self.last_frame, 2.6, out=self.value)
+        np.multiply(frame, 1.3, out=self.scratch)
+        self.value += self.scratch
+        self.value /= 3
+        np.minimum(self.value, 1, out=self.value)
+        np.multiply(self.colors, self.value[:, None], out=self.grb)
+        self.grb *= 255
+        self.leds[:] = self.grb
+        # The processed audio stream reuses one array for every frame, so this aliases it (as it always has).
+        self.last_frame = frame
+        return(np.repeat(self.leds, self.size, axis=0).reshape(-1))
+
+
+# Visualizations by name. To add one, write a class with render(frame) -> GRB uint8 data and register a factory here.
+# Factories take (led_count, loop). Visualizations that don't use loop ignore it. An optional beat(bpm) method is called on beats.
+VISUALIZATIONS = {
+    'pulse': lambda led_count, loop: PulseRenderer(led_count, loop=loop),
+    'flash': lambda led_count, loop: FlashRenderer(led_count),
+    }
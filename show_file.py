@@ -0,0 +1,113 @@
+# 2020/06 BuRnCycL
+# Show files. Record the LED frames that were displayed and play them back later, e.g. for repeatable shows or to load test receive nodes.
+# A fixed header, then fixed size records: a uint64 timestamp (microseconds since recording started) and led_count GRB bytes.
+# Fixed size records mean frame i is at a known offset, so the replayer memory maps the file and only the pages it plays are read.
+# The frame rate isn't steady (the scheduler adapts its rate, receive mode records as frames arrive, streams have gaps), so a timestamp
+# is found by binary search over the mapped timestamps: O(log n), and only the few pages it probes are read. No index to build.
+
+import struct
+import numpy as np
+from os import path
+from time import monotonic, sleep
+from threading import Lock
+
+
+MAGIC = b'BSVS'
+VERSION = 1
+HEADER = struct.Struct('!4sBBHI') # Magic, version, reserved, LED count, frame rate (milli-FPS, informational).
+
+
+class ShowFileError(Exception):
+    pass
+
+
+class ShowRecorder:
+    def __init__(self, filename, led_count, fps=50, flush_interval=50):
+        self.led_count = int(led_count)
+        self.flush_interval = flush_interval # Frames between flushes, so a killed recording loses at most this many.
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, self.led_count, int(fps*1000)))
+        self.record = bytearray(8 + self.led_count*3) # Reused for every frame. Shorter frames are zero padded, longer ones truncated.
+        self.leds = memoryview(self.record)[8:]
+        self.start = None
+        self.frames = 0
+        self.lock = Lock() # The render thread can still be writing when the main thread closes the file on shutdown.
+
+    # timestamp is seconds into the show. None uses the time since the first frame was written.
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            now = monotonic()
+            if self.start is None:
+                self.start = now
+            timestamp = now - self.start
+        data = bytes(data)[:len(self.leds)]
+        with self.lock:
+            if self.file.closed: # Frames after close (e.g. a render thread finishing its frame at shutdown) aren't recorded.
+                return
+            struct.pack_into('!Q', self.record, 0, int(round(timestamp*1000000)))
+            self.leds[:len(data)] = data
+            self.leds[len(data):] = bytes(len(self.leds) - len(data))
+            self.file.write(self.record)
+            self.frames += 1
+            if self.frames % self.flush_interval == 0:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ShowFile:
+    def __init__(self, filename):
+        with open(filename, 'rb') as show:
+            header = show.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ShowFileError('{} is not a show file. Too short.'.format(filename))
+        magic, version, reserved, self.led_count, fps = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ShowFileError('{} is not a show file.'.format(filename))
+        if version != VERSION:
+            raise ShowFileError('Unsupported show file version: {}'.format(version))
+        self.fps = fps/1000
+        self.dtype = np.dtype([('time', '>u8'), ('leds', np.uint8, (self.led_count*3,))])
+        count = (path.getsize(filename) - HEADER.size)//self.dtype.itemsize # A partly written last record (e.g. the recorder was killed) is left out.
+        if count > 0: # Mapped, not read.
+            self.records = np.memmap(filename, dtype=self.dtype, mode='r', offset=HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+        self.times = self.records['time'] # Also a view over the mapping.
+
+    def __len__(self):
+        return(len(self.records))
+
+    def duration(self):
+        return(self.times[-1]/1000000 if len(self) else 0.0)
+
+    def time(self, index):
+        return(self.times[index]/1000000)
+
+    def frame(self, index): # GRB bytes, as a view over the mapping.
+        return(self.records['leds'][index])
+
+    # Index of the frame showing at seconds into the show: the last one at or before it.
+    def seek(self, seconds):
+        if len(self) == 0:
+            return(0)
+        index = int(np.searchsorted(self.times, max(int(seconds*1000000), 0), side='right')) - 1
+        return(max(index, 0)) # Before the first frame shows the first frame.
+
+    # (index, frame) from start (seconds) to the end, paced by the recorded timestamps. speed 2 plays twice as fast, 0 as fast as possible.
+    def play(self, start=0.0, speed=1.0, loop=False):
+        index = self.seek(start)
+        while len(self):
+            begin = monotonic()
+            offset = self.times[index]
+            for index in range(index, len(self)):
+                if speed > 0:
+                    delay = begin + (self.times[index] - offset)/1000000/speed - monotonic()
+                    if delay > 0:
+                        sleep(delay)
+                yield index, self.frame(index)
+            if not loop:
+                return
+            index = 0
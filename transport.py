@@ -0,0 +1,92 @@
+# 2020/06 BuRnCycL
+# UDP frame transports for transmit mode. Both keep one socket open for the life of the process.
+#   MulticastTransport - One send per frame to a multicast group, no matter how many receive nodes are listening.
+#   UnicastTransport   - Fallback for networks without multicast. One copy per node, all sent from the same socket.
+# Receive nodes join the group with multicast_receive_socket(). Unicast frames and acknowledgements still reach that socket.
+# Transport sockets are bound up front, so receive nodes can reply to the address frames come from (clock sync requests).
+
+import struct
+from socket import socket, gethostname, inet_aton, AF_INET, SOCK_DGRAM, IPPROTO_IP, IP_MULTICAST_TTL, IP_MULTICAST_IF, IP_MULTICAST_LOOP, IP_ADD_MEMBERSHIP, SOL_SOCKET, SO_REUSEADDR, SO_RCVBUF
+
+
+DEFAULT_GROUP = '239.255.50.50' # Organization-local scope (239.255.0.0/16).
+DEFAULT_TTL = 1 # Stay on the local subnet. Raise it if receive nodes are behind a multicast router.
+RECEIVE_BUFFER = 262144 # Room for bursts. Lag is handled by only ever displaying the newest frame.
+
+
+# IPv4 address of network_interface (e.g. eth0). default if it can't be found (None to check for that).
+def interface_address(network_interface, default='0.0.0.0'):
+    try:
+        import netifaces as ni # Imported here, so transport works (e.g. in benchmark.py) without the netifaces package installed.
+        return(ni.ifaddresses(network_interface)[ni.AF_INET][0]['addr'])
+    except Exception as e:
+        if default is not None:
+            print('ERROR - Problem with Network Interface {}. Using: {} - {}'.format(network_interface, default, e))
+        return(default)
+
+
+# MAC address of network_interface, or None if it can't be found (e.g. no netifaces package).
+def interface_mac(network_interface):
+    try:
+        import netifaces as ni
+        return(ni.ifaddresses(network_interface)[ni.AF_LINK][0]['addr'])
+    except Exception:
+        return(None)
+
+
+# ID a receive node announces itself by. Pis flashed from one image share a hostname (e.g. raspberrypi), so the NIC's MAC is added to
+# tell them apart. Without a MAC, the address is used instead: still unique, but a node that changes address is then seen as a new one.
+def node_id(network_interface, address):
+    unique = interface_mac(network_interface) or address
+    return('{}-{}'.format(gethostname(), unique).replace(' ', '_'))
+
+
+class UnicastTransport:
+    def __init__(self, port):
+        self.port = port
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.bind(('', 0))
+        self.addresses = ()
+        self.nodes = None
+
+    # nodes is the receive node address tuple from NodeRegistry.addresses(). A new tuple means the nodes changed, so addresses are rebuilt.
+    def send(self, data, nodes):
+        if nodes is not self.nodes:
+            self.nodes = nodes
+            self.addresses = tuple((node, self.port) for node in self.nodes)
+        sendto = self.socket.sendto
+        for address in self.addresses:
+            sendto(data, address)
+        return(len(self.addresses))
+
+    def close(self):
+        self.socket.close()
+
+
+class MulticastTransport:
+    def __init__(self, port, group=DEFAULT_GROUP, ttl=DEFAULT_TTL, interface='0.0.0.0', loop=False):
+        self.port = port
+        self.address = (group, port)
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.bind(('', 0))
+        self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, int(ttl))
+        self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_IF, inet_aton(interface)) # 0.0.0.0 lets the routing table pick.
+        self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, 1 if loop else 0) # Loop back to receivers on this host too.
+
+    def send(self, data, nodes=None): # nodes is ignored. Every group member gets the one copy.
+        self.socket.sendto(data, self.address)
+        return(1)
+
+    def close(self):
+        self.socket.close()
+
+
+# Receive socket bound to port on all addresses, joined to group on interface. Unicast datagrams to port are received as well.
+def multicast_receive_socket(port, group=DEFAULT_GROUP, interface='0.0.0.0', buffer_size=RECEIVE_BUFFER):
+    receive_socket = socket(AF_INET, SOCK_DGRAM)
+    receive_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1) # Several receivers (e.g. for testing) on one host.
+    receive_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, buffer_size)
+    receive_socket.bind(('', port))
+    membership = struct.pack('4s4s', inet_aton(group), inet_aton(interface))
+    receive_socket.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, membership)
+    return(receive_socket)
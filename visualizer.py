@@ -21,22 +21,32 @@
 # Package Managed - apt install -y python3 python3-pip python3-virtualenv virtualenv portaudio19-dev pulseaudio libatlas-base-dev
 
 
-import pyaudio as pa
 import numpy as np
-from blinkstick import blinkstick
 import notes_scaled_nosaturation
-from time import sleep, time
-from colorsys import hsv_to_rgb
-import argparse, sys, random, pickle
+from renderers import VISUALIZATIONS
+from analysis_stream import AnalysisStream
+from beat_detector import BeatDetector, history_for
+from node_registry import NodeRegistry
+from transport import UnicastTransport, MulticastTransport, interface_address, DEFAULT_GROUP, DEFAULT_TTL
+import wire_protocol
+from receive_pipeline import OutputWorker
+from receiver import ReceiveNode
+from device_output import DeviceOutput, find_blinksticks
+from layout import read_layouts
+from show_file import ShowRecorder, ShowFile, ShowFileError
+from audio_capture import PyAudioSource, WavSource, SyntheticSource
+import metrics
+import multiprocess_pipeline
+from frame_scheduler import FrameScheduler
+from time import time, monotonic
+import argparse, sys, random, struct, atexit
 from os import path
 from threading import Thread
 from socket import *
-import argparse, sys, random, pickle
-import netifaces as ni
 
 
 class BlinkStickViz:
-    def __init__(self, sensitivity, rate, chunk, channels, max_int, min_int, transmit, receive, network_interface, inputonly, led_count, device=None):
+    def __init__(self, sensitivity, rate, chunk, channels, max_int, min_int, transmit, receive, network_interface, inputonly, led_count, device=None, compression='raw', callback=False, source=None, sink=None, fps=None, scale=None, min_freq=40, max_freq=16000, audio_input=True, spectra=None, multicast=None, ttl=DEFAULT_TTL, transmit_spectrum=False, bands=32, spectrum_format='float16', latency=None, record=None, fft_size=1024, hop=None, hann=False, switch_on='timer', beat_effects=False, brightness=1.0, gamma=1.0, change_threshold=0, keepalive=1.0):
         # Declare variables, not war.        
 
         # Network modes for remote Blinkstick communication. By default, both transmit and receive modes set to False.
@@ -46,97 +56,114 @@ class BlinkStickViz:
         self.inputonly = inputonly # Facilitates bypassing Blinkstick device, and handling input only device. Default to False.            
         self.transmit = transmit
         self.receive = receive
-        self.acknowledged = False # By default we haven't been acknowledged, as a discovered device.        
-        if inputonly == True:
+        self.transmit_spectrum = transmit_spectrum # Transmit the analyzed spectrum instead of rendered LED data. Receive nodes render it locally.
+        if inputonly == True or transmit_spectrum == True:
             self.transmit = True        
         self.receive_address = '0.0.0.0' # Hard-coded bind to 0.0.0.0 interface. This may need to be adjusted?
         self.receive_port = 12000 # Hard-coded UDP receive/listener port. Adjust this if needed. Didn't bother to make it configurable.
         self.receive_nodes_file = './receive_nodes.list' # Hard-coded filename of receive nodes (IP Addresses) if in transmit mode. List each IP Address on it's own line.  
+        self.encoder = wire_protocol.FrameEncoder(encoding=wire_protocol.ENCODINGS[compression]) # Transmit side. Optional run-length/delta compression for long strips.
+        self.spectrum_encoder = wire_protocol.SpectrumEncoder(encoding=wire_protocol.SPECTRUM_ENCODINGS[spectrum_format]) # Transmit side, with --transmit-spectrum.
+        self.bands = int(bands) # Bands per transmitted spectrum. Receive nodes resample them to their own LED count.
+        self.latency = latency # Transmit side. Seconds from sending a frame to every node showing it. None shows frames on arrival.
+        self.multicast = multicast # Multicast group for frames (both sides). None sends a unicast copy to each receive node.
         if self.transmit == True:            
-            self.receive_nodes = [] # Empty list of receive nodes updated by self.get_receive_nodes(). Either updated by hard-coded list or auto-discovery (self.udp_discovery())
+            self.nodes = NodeRegistry() # Receive nodes. Either from the hard-coded list or auto-discovery (self.udp_discovery()), which also evicts nodes that go quiet.
+            self.acknowledge_socket = socket(AF_INET, SOCK_DGRAM) # One socket for every acknowledgement.
+            if self.multicast is not None: # One send per frame, however many receive nodes there are.
+                self.transport = MulticastTransport(self.receive_port, group=self.multicast, ttl=ttl, interface=interface_address(self.network_interface))
+            else:
+                self.transport = UnicastTransport(self.receive_port) # One socket for every node, kept open.
+            Thread(target=self.udp_sync_server, daemon=True).start() # Answers receive nodes' clock sync requests.
             self.get_receive_nodes()
             
-        # PyAudio Variables.
+        # Audio source. Defaults to PyAudio (i.e. Microphone). Any object with a rate and windows(num_samples) works, e.g. WavSource or SyntheticSource.
+        self.source = source
         self.device = device
-        self.paud = pa.PyAudio()
-        self.format = pa.paInt16
-        self.channels = channels # This may need to be lowered depending on the device used.
-        self.rate = rate # This may need to be tuned to 48000Hz
-        self.chunk = chunk # This may need to be tuned to 512, 2048, or 4096.
+        self.channels = int(channels) # This may need to be lowered depending on the device used.
+        self.rate = int(rate) # This may need to be tuned to 48000Hz
+        self.chunk = int(chunk) # This may need to be tuned to 512, 2048, or 4096.
+        self.sample_rate = int(fft_size) # FFT window in samples. Longer windows resolve bass better.
+        self.hop = int(hop) if hop else self.sample_rate # New samples per analyzed window. Windows overlap when it's less than the FFT window.
+        self.hann = hann # Taper windows with a precomputed Hann window. Default off, the original spectrum.
+        if self.hop < self.chunk: # Audio arrives a chunk at a time, so a bigger chunk would hold back every hop.
+            print('Lowering audio chunk size from {} to the hop size ({}).'.format(self.chunk, self.hop))
+            self.chunk = self.hop
+        self.callback = callback # Callback mode capture into a ring buffer (see audio_capture.py), instead of blocking reads.
 
         # Visualization Variables.
         self.loop = None # Pulse from both ends of the strip. Default None, self.main() sets this.
         self.sensitivity = sensitivity # Sensitivity to sound.
-        self.sample_rate = 1024 # Haven't seen this tuned. But perhaps?
+        self.scale = scale # How FFT bins map to LEDs. None is one bin per LED from 0Hz. linear, log, or mel spread the LEDs from min_freq to max_freq.
+        self.min_freq = min_freq
+        self.max_freq = max_freq
         self.wait_interval_max = int(max_int) # Max time in seconds visualization will run before switching.
         self.wait_interval_min = int(min_int) # Minimum time in seconds visualization will run before switching.
-        self.stop = False  # Tells visualization to stop running. Facilitates switching to another visualization. Default to False.
-
+        self.spectra = spectra # Already processed audio (e.g. from another process in --processes mode). Replaces audio input and spectrum processing.
+        self.stop = False  # Tells the render loop to stop running. Visualizations are switched by swapping self.renderer, not by stopping.
+        self.renderer = None # Current visualization. Swapped between frames (see renderers.VISUALIZATIONS).
+        self.switch_on = switch_on # When a new visualization takes over: timer (right away), beat (the next beat), or phrase (the next phrase).
+        self.next_renderer = None # Built, and waiting for its beat or phrase.
+        self.switch_requested = None
+        self.beat_effects = beat_effects # Tell renderers about beats (renderers with a beat(bpm) method use them).
         # Init Blinkstick, Audio input, and Analyze/Read Audio. Create leds object, so we can loop over in the visualization methods.
+        self.device_options = dict(brightness=brightness, gamma=gamma, threshold=change_threshold, keepalive=keepalive) # See DeviceOutput.
         self.led_count = led_count # LED count defaults to 32. Will be determined by self.get_blinksticks() if otherwise. Tune when using Input Only mode.  
-        if self.inputonly == False: # Facilitates bypassing Blinkstick device, and handling input only device.    
+        if sink is not None: # Output somewhere other than Blinksticks, e.g. NullSink or RecordingSink.
+            self.outputs = sink
+        elif self.inputonly == False: # Facilitates bypassing Blinkstick device, and handling input only device.    
             self.sticks = self.get_blinksticks() # Discover Blinkstick Device.
+            self.outputs = DeviceOutput(self.sticks, self.led_count, read_layouts(), **self.device_options) # One output worker per Blinkstick, so they're written in parallel.
         elif inputonly== True:
             print('Input Only Mode. Bypassing Blinkstick Discovery (i.e. this device is just a microphone).')
-        if self.receive == False: # If not in UDP receive mode, go ahead an Init the audio device and read the stream. 
-            self.audio_stream = self.input_device() # Init microphone as input source/stream.
-            self.audio = self.read_audio(self.audio_stream, num_samples=self.sample_rate) # Read the audio stream.
+        if self.receive == False and audio_input == True: # If not in UDP receive mode, go ahead an Init the audio device and read the stream. 
+            if self.source is None:
+                self.source = PyAudioSource(self.rate, self.channels, self.chunk, device=self.device, callback=self.callback) # Init microphone as input source/stream.
+            self.rate = self.source.rate # e.g. a WAV file's own sample rate.
+            self.audio = self.source.windows(num_samples=self.sample_rate, hop=self.hop if self.hop != self.sample_rate else None) # Read the audio stream.
+        if fps is None: # One frame per hop, as audio arrives: e.g. 43 FPS for 1024 sample windows, 200 FPS for a 220 sample hop, at 44100Hz.
+            fps = self.rate/self.hop
+        self.scheduler = FrameScheduler(fps=fps) # Paces frames to a target FPS. Adapts down when we can't keep up.
+        self.recorder = None # Records every displayed/transmitted frame to a show file (see show_file.py). None doesn't record.
+        if record is not None:
+            self.recorder = ShowRecorder(record, self.led_count, fps=self.scheduler.target_fps)
+            atexit.register(self.close) # e.g. receive mode, where the main thread returns once the receive threads are started.
+            print('Recording frames to show file: {}'.format(record))
+        self.analysis = AnalysisStream(self.led_data()) # One long lived spectrum stream. Its state carries across visualization switches.
+        self.beats = BeatDetector(history=history_for(self.scheduler.target_fps))
+        self.received_beat = None # Receive mode with --modes. The transmit node's beat flag for the current spectrum.
+        self.analysis.add_listener(self.detect_beat) # First, so later listeners see this frame's beat.
+        if self.transmit_spectrum == True:
+            self.analysis.add_listener(self.udp_transmit_spectrum)
+        self.register_metrics()
         if self.transmit == True: # Tell us if we're in transmit mode after audio init. Looks better.
-            print('UDP Transmit Mode to {}, on Port: {}'.format(self.receive_nodes, self.receive_port))
-            if len(self.receive_nodes) == 0:
+            if self.multicast is not None:
+                print('UDP Transmit Mode to Multicast Group: {}, on Port: {}, TTL: {}'.format(self.multicast, self.receive_port, ttl))
+            else:
+                print('UDP Transmit Mode to {}, on Port: {}'.format(list(self.nodes.addresses()), self.receive_port))
+            if len(self.nodes) == 0:
                 print('Auto Discovery - Awaiting Announcement from network attached Blinkstick devices.')
         
-    # Utilize multiple Blinksticks on the same parent device. Note: This won't run well on Raspberry Pi. Beefer CPU required.
+    # Counters that already live elsewhere are read when metrics are scraped, not copied every frame.
+    def register_metrics(self):
+        if hasattr(self, 'outputs'):
+            for stat in ('writes', 'skipped', 'keepalives', 'bytes_written', 'bytes_skipped', 'coalesced', 'errors', 'reconnects', 'write_time_avg', 'write_time_max'):
+                metrics.gauge('device_{}'.format(stat), lambda stat=stat: {device: stats[stat] for device, stats in self.outputs.stats().items() if stat in stats})
+        metrics.gauge('scheduler', self.scheduler.snapshot) # Target vs achieved FPS, deadline misses.
+        metrics.gauge('beat', self.beats.snapshot) # BPM, beat and onset counts.
+        if self.transmit == True:
+            metrics.gauge('nodes', lambda: len(self.nodes)) # Live receive nodes.
+            for index, stat in enumerate(('clock_offset_ms', 'clock_jitter_ms', 'expired')):
+                metrics.gauge('node_{}'.format(stat), lambda index=index: {node.node_id: node.clock[index] for node in self.nodes.list() if node.clock is not None})
+        capture = getattr(self.source, 'capture', None)
+        if capture is not None: # Callback mode.
+            metrics.gauge('audio', lambda: vars(capture.stats))
+
+    # Utilize multiple Blinksticks on the same parent device. Each one gets its own output worker (see device_output.py).
     def get_blinksticks(self):
-        found_blinksticks = []
-        led_counts = []
-        blinksticks = blinkstick.find_all() # Discover multiple Blinksticks.        
-        for stick in blinksticks:
-            count = stick.get_led_count()
-            led_counts.append(count)       
-            found_blinksticks.append(stick)
-        
-        # Verify we're addressing the same number of LEDs for both sticks.
-        led_count = set(led_counts) # Set will deduplicate.
-        if len(led_count) == 1: # Should be left with one, if everything is equal.
-            for count in led_count:
-                self.led_count = int(count)
-        else:
-            print('ERROR - LED Count is NOT equal between Blinksticks: {} - Values should match.'.format(led_count))
-            sys.exit(1)
+        found_blinksticks, self.led_count = find_blinksticks()
         return(found_blinksticks)
 
-    def input_device(self): # i.e. Microphone
-        if self.device is not None: # Use non-default device.
-            audio_stream = self.paud.open(
-                format=self.format,
-                channels=self.channels,
-                rate=self.rate,
-                frames_per_buffer=self.chunk,
-                input= True,
-                input_device_index=self.device,
-                )
-        else: # Otherwise, use the default.
-            audio_stream = self.paud.open(
-                format=self.format,
-                channels=self.channels,
-                rate=self.rate,
-                frames_per_buffer=self.chunk,
-                input= True,
-                )
-        return(audio_stream)
-
-    # Convert the audio data to numbers, num_samples at a time.
-    def read_audio(self, audio_stream, num_samples):
-        while True:
-            # Read all the input data.
-            samples = audio_stream.read(num_samples, exception_on_overflow=False)
-            # Convert input data to numbers
-            samples = np.frombuffer(samples, dtype=np.int16).astype(np.float)
-            samples_l = samples[::2]
-            samples_r = samples[1::2]
-            yield samples_l, samples_r
-
     def get_receive_nodes(self):
         if path.isfile(self.receive_nodes_file):
             with open(self.receive_nodes_file, 'r+') as f:
@@ -144,256 +171,283 @@ class BlinkStickViz:
                 for ip_address in ip_addresses:
                     if '.' in ip_address: # Chuck any line that doesn't have a dot in it (i.e. an IP address format 10.9.9.X). 
                         ip_address = ip_address.rstrip('\n')
-                        self.receive_nodes.append(ip_address) # Append IP to list of receive nodes. Remove newline.
-                        self.udp_acknowledge(ip_address)                
+                        self.udp_acknowledge(self.nodes.add_static(ip_address)) # Add IP to receive nodes. Remove newline.
                     else:
                         continue # Skip lines without dots.              
         else: # If no hard coded IP list is specified, use auto discovery mechanism.
             print('No Hard-coded IP list provided, Starting Auto Discovery...')
-            Thread(target=self.udp_discovery).start() # Threaded Start UDP Discovery.             
+            Thread(target=self.udp_discovery, daemon=True).start() # Threaded Start UDP Discovery.             
           
-    def udp_announce(self):                
-        try:        
-            announce_socket = socket(AF_INET, SOCK_DGRAM) # Create UDP socket.
-            announce_socket.bind(('', 0))
-            announce_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1) # Broadcast socket.
-        except Exception as e:
-            print('ERROR - Unable to bind to address - {}'.format(e))
-            sys.exit(1)
-        try:
-            my_ip = ni.ifaddresses(self.network_interface)[ni.AF_INET][0]['addr']
-        except Exception as e:
-            print('ERROR - Problem with Network Interface. Perhaps you did not define the proper NIC? (Default: eth0)')
-            sys.exit(1)        
-        
-        # Time between announcements based on whether we've been acknowledged.
-        short_announce_interval = 1
-        long_announce_interval = 10
-
-        while 1:
-            if self.acknowledged == True: # If we've been acknowledged, stop announcing.
-                print('Auto Discovery - Discovered! Announcing to network every {}s...'.format(long_announce_interval))
-                sleep(long_announce_interval)
-            elif self.acknowledged == False:
-                print('Auto Discovery - Announcing to network every {}s...'.format(short_announce_interval))
-                sleep(short_announce_interval)
-            # Perform Announcement.
-            data = '{} {}'.format(self.net_identifier, my_ip)
-            data = pickle.dumps(data) # Serialize the data for transmission.
-            announce_socket.sendto(data, ('<broadcast>', self.auto_discovery_port))          
-
-    def udp_discovery(self):
+    def udp_discovery(self, evict_interval=1):
         discovery_socket = socket(AF_INET, SOCK_DGRAM) # Create UDP socket.
         discovery_socket.bind(('', self.auto_discovery_port))
+        discovery_socket.settimeout(evict_interval) # Evict quiet nodes even when nobody is announcing.
+        evicted = monotonic()
         while 1:
-            data, addr = discovery_socket.recvfrom(1024) # Wait for a packet
-            decoded_data = pickle.loads(data) # De-Serialize the received data.
-            if decoded_data.startswith(self.net_identifier):
-                receive_node_ip = decoded_data.rsplit(' ', 1)[1]
-                if receive_node_ip not in self.receive_nodes: # Update the self.receive_nodes with newly discovered nodes.
-                    print('Auto Discovery - Found: {}, on Port: {}'.format(receive_node_ip, self.receive_port))
-                    self.receive_nodes.append(receive_node_ip) # Add node to our list of discovered/known receiving nodes. 
-                self.udp_acknowledge(receive_node_ip)
-
-    def udp_acknowledge(self, receive_node_ip): # Tell the receiving node, that we have discovered them, and thus stop broadcasting.                        
-            data = pickle.dumps('acknowledged') # Serialize the data for transmission.
-            acknowledge_socket = socket(AF_INET, SOCK_DGRAM)
-            acknowledge_socket.sendto(data,(receive_node_ip, self.receive_port))
+            if monotonic() - evicted >= evict_interval:
+                for node in self.nodes.evict():
+                    print('Auto Discovery - Lost: {}, not seen for {}s'.format(node, self.nodes.ttl))
+                evicted = monotonic()
+            try:
+                data, addr = discovery_socket.recvfrom(1024) # Wait for a packet
+                message = wire_protocol.unpack(data)
+                fields = bytes(message.payload).decode().split()
+            except timeout:
+                continue
+            except (wire_protocol.ProtocolError, UnicodeDecodeError):
+                continue # Not one of ours.
+            if message.type == wire_protocol.ANNOUNCE and len(fields) >= 2 and fields[0] == self.net_identifier:
+                receive_node_ip = fields[-1]
+                node_id, led_count, capabilities = receive_node_ip, 0, ()
+                if len(fields) == 5: # Older receive nodes only send their IP.
+                    node_id, led_count, capabilities = fields[1], int(fields[2]) if fields[2].isdigit() else 0, fields[3].split(',')
+                node, new = self.nodes.seen(node_id, receive_node_ip, led_count, capabilities)
+                if new:
+                    print('Auto Discovery - Found: {}, on Port: {}'.format(node, self.receive_port))
+                self.udp_acknowledge(node)
+
+    def udp_acknowledge(self, node): # Tell the receiving node, that we have discovered them, and thus stop broadcasting. Rate limited per node.
+        if self.nodes.acknowledge(node):
+            self.acknowledge_socket.sendto(wire_protocol.acknowledge(), (node.address, self.receive_port))
         
     def udp_transmit(self, data):
-        data = pickle.dumps(data) # Serialize the data for transmission.
-        for receive_node in self.receive_nodes: # Loop over the list of hosts.
+        start = metrics.clock()
+        self.udp_send(self.encoder.encode(data, self.presentation_time())) # Serialize the data for transmission.
+        metrics.observe('network_send', start)
+
+    # Analysis stream listener. Sends every spectrum, whether or not (or whatever) this node renders.
+    def udp_transmit_spectrum(self, spectrum, sequence):
+        start = metrics.clock()
+        self.udp_send(self.spectrum_encoder.encode(notes_scaled_nosaturation.resample_bands(spectrum, self.bands), beat=self.beats.beat, presentation_time=self.presentation_time()))
+        metrics.observe('network_send', start)
+
+    def presentation_time(self):
+        return(time() + self.latency if self.latency else None)
+
+    # Transmit side. Receive nodes send clock sync requests to the transport socket frames come from. Each carries the node's own sync report.
+    def udp_sync_server(self, report_interval=10):
+        sync_socket = self.transport.socket
+        reported = monotonic()
+        while 1:
+            data, addr = sync_socket.recvfrom(1024)
+            received_at = wire_protocol.now()
             try:
-                transmit_socket = socket(AF_INET, SOCK_DGRAM)
-                transmit_socket.sendto(data,(receive_node, self.receive_port))
-            except Exception as e:
-                print('ERROR - Unable to communicate to Receive Node: {} - {}'.format(receive_node, e))
-                sys.exit(1)
-
-    def udp_receive_handler(self):
-        Thread(target=self.udp_receive).start() # UDP Receive Mode data on separate thread.
-        Thread(target=self.udp_announce).start() # UDP Broadcast announce we're on the network and ready to receive data via separate thread.        
-
-    def udp_receive(self):               
-        print('UDP Receive Mode. Listening on: {}, Port: {}'.format(self.receive_address, self.receive_port))
-        try:    
-            receive_socket = socket(AF_INET, SOCK_DGRAM) # Create UDP socket.
-            receive_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, self.chunk) # Set receive buffer size to self.chunk. Prevents visual lag.
-            receive_socket.bind((self.receive_address, self.receive_port))
+                message = wire_protocol.unpack(data)
+                if message.type != wire_protocol.SYNC_REQUEST:
+                    continue
+                sync_socket.sendto(wire_protocol.sync_reply(message, received_at), addr)
+                self.nodes.report_clock(addr[0], wire_protocol.SYNC_REPORT.unpack_from(message.payload))
+            except (wire_protocol.ProtocolError, struct.error) as e:
+                print('ERROR - Malformed clock sync request from {} - {}'.format(addr[0], e))
+            if monotonic() - reported >= report_interval:
+                for node in self.nodes.list():
+                    if node.clock is not None:
+                        print('Clock Sync - {}: Offset: {:.1f}ms, Jitter: {:.1f}ms, Expired: {}'.format(node.node_id, *node.clock))
+                reported = monotonic()
+
+    def udp_send(self, data):
+        try:
+            self.transport.send(data, self.nodes.addresses()) # Multicast ignores the node list.
         except Exception as e:
-            print('ERROR - Unable to bind to address - {}'.format(e))
+            print('ERROR - Unable to communicate to Receive Nodes: {} - {}'.format(self.multicast or list(self.nodes.addresses()), e))
             sys.exit(1)
-             
-        while 1:
-            data = receive_socket.recv(self.chunk)
-            decoded_data = pickle.loads(data) # De-Serialize the received data.
-            if 'acknowledged' in decoded_data:  
-                self.acknowledged = True
-            else:
-                self.send_to_stick(decoded_data) # Send the data to our Blinksticks.
-  
+
+    # With modes, the transmit node's spectrum is rendered here (--transmit-spectrum on the transmit node). Otherwise its LED data is displayed as is.
+    # The network side (frames, announcements, clock sync) is receiver.ReceiveNode, shared with the fast start receiver.
+    def udp_receive_handler(self, modes=None):
+        self.receiver = ReceiveNode(self.led_count, network_interface=self.network_interface, multicast=self.multicast, spectrum=modes is not None,
+                                    address=self.receive_address, port=self.receive_port, discovery_port=self.auto_discovery_port, identifier=self.net_identifier)
+        self.mailbox = self.receiver.mailbox
+        if modes is not None:
+            self.spectra = self.network_spectra() # Read lazily by self.analysis, so it replaces audio input from here on.
+        else:
+            OutputWorker(self.mailbox, self.send_to_stick).start() # Blinkstick writes on their own thread, so a slow USB write never stalls the socket.
+        self.receiver.start()
+        if modes is not None:
+            print('UDP Receive Mode. Rendering received spectrum locally for {} LEDs.'.format(self.led_count))
+            self.main(modes=modes)
+
+    # Newest received spectrum, resampled to our LED count. Same buffer every frame, like SpectrumEngine.
+    def network_spectra(self, report_interval=10):
+        spectrum = np.zeros(int(self.led_count))
+        reported = monotonic()
+        while True:
+            received, received_at = self.mailbox.take(timeout=1)
+            if received is not None:
+                bands, self.received_beat = received
+                spectrum[:] = notes_scaled_nosaturation.resample_bands(bands, len(spectrum))
+                self.mailbox.displayed(received_at)
+                yield spectrum
+            if monotonic() - reported >= report_interval:
+                print('UDP Receive Stats - {}'.format(self.mailbox.stats))
+                reported = monotonic()
+
     def send_to_stick(self, data):
-        if self.transmit == True: # If we're in transmit mode send the led data via UDP.
+        if self.recorder is not None:
+            self.recorder.write(data)
+        if self.transmit == True and self.transmit_spectrum == False: # If we're in transmit mode send the led data via UDP. Spectra are sent by udp_transmit_spectrum.
             self.udp_transmit(data)        
         if self.inputonly == False: # If input only is False, we'll send data to multiple connected Blinkstick Devices.
-            for stick in self.sticks: # Loop over one of more Blinkstick devices sending visualization processed LED data.
-                try:
-                    stick.set_led_data(0, data)
-                except Exception as e:
-                    print('ERROR - Blinkstick communication error - {}'.format(e))
-                    self.get_blinksticks() # Try to re-init Blinkstick communication when failures occur. This is due to bugs in pyusb library.
+            if self.outputs.send(data): # Hands the frame to each device's worker. Failing devices reconnect in the background.
+                self.scheduler.congested() # A device still hadn't written the previous frame.
                           
     def main(self, modes):
         # Start with more complex conditional for the mode and move to simpler.
-        if 'all' in modes:
-            print('All - Pulse, Flash, and Loop (randomly).')
-            self.random_visualization_handler(loop='random')
-        elif 'pulse' in modes and 'flash' in modes and 'loop' in modes:
-            print('Pulse with Loop (static) and Flash.')
-            self.random_visualization_handler(loop=True)
-        elif 'pulse' in modes and 'flash' in modes:
-            print('Pulse and Flash')
-            self.random_visualization_handler(loop=False)
-        elif 'pulse' in modes and 'loop' in modes:
-            print('Pulse with Loop.')
-            self.loop = True
-            self.pulse_visualization()
-        elif 'flash' in modes and 'loop' in modes: # Note: flash visualization doesn't use loop. So even if it's specified, it won't matter.
-            print('Flash only. Loop has no affect.')
-            self.flash_visualization()
-        elif 'pulse' in modes:
-            print('Pulse only.')
-            self.pulse_visualization()
-        elif 'flash' in modes:
-            print('Flash only.')
-            self.flash_visualization()
-
+        try:
+            if self.inputonly == True and self.transmit_spectrum == True: # Nothing to render here. Receive nodes render the spectrum.
+                print('Input Only. Transmitting spectrum, receive nodes pick their own visualization.')
+                self.run_visualization()
+            elif 'all' in modes:
+                print('All - Pulse, Flash, and Loop (randomly).')
+                self.random_visualization_handler(loop='random')
+            elif 'pulse' in modes and 'flash' in modes and 'loop' in modes:
+                print('Pulse with Loop (static) and Flash.')
+                self.random_visualization_handler(loop=True)
+            elif 'pulse' in modes and 'flash' in modes:
+                print('Pulse and Flash')
+                self.random_visualization_handler(loop=False)
+            elif 'pulse' in modes and 'loop' in modes:
+                print('Pulse with Loop.')
+                self.switch_visualization('pulse', loop=True)
+                self.run_visualization()
+            elif 'flash' in modes and 'loop' in modes: # Note: flash visualization doesn't use loop. So even if it's specified, it won't matter.
+                print('Flash only. Loop has no affect.')
+                self.switch_visualization('flash', loop=False)
+                self.run_visualization()
+            elif 'pulse' in modes:
+                print('Pulse only.')
+                self.switch_visualization('pulse', loop=False)
+                self.run_visualization()
+            elif 'flash' in modes:
+                print('Flash only.')
+                self.switch_visualization('flash', loop=False)
+                self.run_visualization()
+        finally:
+            self.close() # Also on Ctrl-C, so the show file keeps every frame that was displayed.
+
+    # Plays a recorded show file (see show_file.py) to local Blinksticks and/or receive nodes, paced by its timestamps.
+    def replay(self, filename, start=0.0, speed=1.0, loop=False, report_interval=10):
+        try:
+            show = ShowFile(filename)
+        except (ShowFileError, OSError) as e:
+            print('ERROR - Unable to open show file - {}'.format(e))
+            sys.exit(1)
+        if hasattr(self, 'sticks') and show.led_count != self.led_count: # Resample the recorded frames to these Blinksticks.
+            self.outputs.stop()
+            self.outputs = DeviceOutput(self.sticks, show.led_count, read_layouts(), **self.device_options)
+        print('Replaying show file: {} - {} frames, {} LEDs, {:.1f}s, from {:.1f}s at {}'.format(
+            filename, len(show), show.led_count, show.duration(), start, '{}x speed'.format(speed) if speed > 0 else 'full speed'))
+        reported = monotonic()
+        try:
+            for index, data in show.play(start=start, speed=speed, loop=loop):
+                self.send_to_stick(data)
+                metrics.frame()
+                if monotonic() - reported >= report_interval:
+                    print('Replay - Frame {}/{}, {:.1f}s'.format(index + 1, len(show), show.time(index)))
+                    reported = monotonic()
+        finally:
+            self.close()
+        print('Replay - Done.')
+
+    # Stops the render loop and closes the show file being recorded, if any. Safe to call more than once, and while a render thread still sends.
+    def close(self):
+        self.stop = True
+        if self.recorder is not None:
+            self.recorder.close()
+
+    # One render thread runs for the whole session. Switching only swaps the renderer it uses, so there's no thread churn, the
+    # spectrum stream keeps its smoothing/scaling state, and a switch never waits on a frame (or a stalled audio read) to finish.
     def random_visualization_handler(self, loop):
-        visualizations = [self.pulse_visualization, self.flash_visualization] # If you create more visualization functions, add them to this list.
-        wait_interval = random.randint(self.wait_interval_min, self.wait_interval_max)
+        visualizations = list(VISUALIZATIONS) # If you create more visualizations, register them in renderers.VISUALIZATIONS.
+        t = None
         while True:
-            self.stop = False # Always start the loop with stop Default to False
-            # Loop Handler
-            if loop == True:
-                self.loop = True
-            elif loop == False:
-                self.loop = False
-            elif loop == 'random':
-                self.loop = random.choice([True, False])
-            visualization_picked = random.choice(visualizations)
-            print('Waiting: {}s, Loop: {}, Visualization: {}'.format(wait_interval, self.loop, visualization_picked))
-            t = Thread(target=visualization_picked) # Threading facilitates addressing multiple Blinksticks on the same parent device. 
-            t.start()
-            sleep(wait_interval)
-            self.stop = True
-            t.do_run = False
-            t.join()
             wait_interval = random.randint(self.wait_interval_min, self.wait_interval_max)
-
-    def led_data(self):        
-        return(notes_scaled_nosaturation.process(self.audio, num_leds=self.led_count, num_samples=self.sample_rate, sample_rate=self.rate, sensitivity=self.sensitivity)) # Return the processed audio stream to the visualizer functions.
-
-    def pulse_visualization(self):
-        leds = self.led_data()
-        
-        if self.loop:
-            data = [0]*int(self.led_count/2)*3
-            data2 = [0]*int(self.led_count/2)*3
+            name = random.choice(visualizations)
+            self.switch_visualization(name, loop)
+            print('Waiting: {}s, Loop: {}, Visualization: {}'.format(wait_interval, self.loop, name))
+            if t is None:
+                t = Thread(target=self.run_visualization, daemon=True) # Threading facilitates addressing multiple Blinksticks on the same parent device.
+                t.start()
+            t.join(wait_interval) # Returns early if the audio source ends.
+            if not t.is_alive():
+                break
+            print('Frame Scheduler - {}'.format(self.scheduler))
+            print('Beat Detector - {}'.format(self.beats))
+
+    # Builds the renderer here (LUTs and buffers) and swaps it in with a single assignment. The render loop picks it up on its next frame,
+    # or with --switch beat/phrase, on the next beat or phrase boundary.
+    def switch_visualization(self, name, loop):
+        if loop == 'random':
+            self.loop = random.choice([True, False])
         else:
-            data = [0]*self.led_count*3
-
-        sent = 0
-        for frame in leds:
-            brightest = 0
-            for i, led in enumerate(frame):
-                if led > frame[brightest]:
-                    brightest = i
-
-            hue = brightest/48.0
-            color = hsv_to_rgb(hue, 1, min(frame[brightest]*1.2, 1))
-
-            del data[-1]
-            del data[-1]
-            del data[-1] # I feel dirty having written this.
-            if self.loop:
-                del data2[0]
-                del data2[0]
-                del data2[0]
-
-            color = [int(color[1]*255), int(color[0]*255), int(color[2]*255)]
-            data = color + data
-
-            if self.loop: # finaldata exists because if I try to do the seemingly sane thing it breaks.
-                data2 = data2 + color
-                finaldata = data+data2
-            else:
-                finaldata = data
+            self.loop = loop
+        renderer = VISUALIZATIONS[name](self.led_count, self.loop)
+        if self.switch_on == 'timer' or self.renderer is None:
+            self.renderer = renderer
+        else:
+            self.switch_requested = monotonic()
+            self.next_renderer = renderer
 
-            now = time()
-            if now-sent < .02:
-                sleep(max(0, .02-(now-sent)))
+    # Analysis stream listener. Beats from the spectrum, or the transmit node's beats when rendering a received spectrum.
+    def detect_beat(self, spectrum, sequence):
+        self.beats.update(spectrum, beat=self.received_beat)
 
-            sent = time()
-            self.send_to_stick(finaldata)
-            if self.stop == True: # Handle stopping the thread, so another visualization can be executed.
+    # Render thread. Swaps in a waiting visualization on its beat or phrase boundary, or after switch_timeout if the beat never comes.
+    def beat_switch(self, switch_timeout=8):
+        if self.switch_on == 'phrase':
+            due = self.beats.phrase_boundary()
+        else:
+            due = self.beats.beat
+        if due or monotonic() - self.switch_requested > switch_timeout:
+            self.renderer, self.next_renderer = self.next_renderer, None
+
+    def led_data(self): # Same as notes_scaled_nosaturation.process(), with audio read and spectrum processing timed separately.
+        if self.spectra is not None:
+            spectra = iter(self.spectra)
+            while True:
+                waited = monotonic()
+                spectrum = next(spectra, None)
+                self.scheduler.blocked(monotonic() - waited) # Waiting for the next spectrum (e.g. from the capture process) isn't a missed deadline.
+                if spectrum is None:
+                    return
+                yield spectrum
+        engine = notes_scaled_nosaturation.SpectrumEngine(num_leds=self.led_count, num_samples=self.sample_rate, sample_rate=self.rate, sensitivity=self.sensitivity,
+                                                          scale=self.scale, min_freq=self.min_freq, max_freq=self.max_freq, hann=self.hann)
+        while True:
+            start = metrics.clock()
+            waited = monotonic()
+            try:
+                l, r = next(self.audio)
+            except StopIteration: # End of a WAV file.
+                return
+            self.scheduler.blocked(monotonic() - waited) # Blocking reads wait for audio to arrive. That's the audio setting the pace, not a missed deadline.
+            metrics.observe('audio_read', start)
+            start = metrics.clock()
+            frame = engine.update(l, r)
+            metrics.observe('spectrum', start)
+            yield frame # Return the processed audio stream to the visualizer functions.
+
+    def run_visualization(self):
+        self.scheduler.reset()
+        while self.stop == False:
+            self.scheduler.wait() # Wait for the frame deadline first, so the audio read next is as fresh as possible.
+            frame = self.analysis.next()
+            if frame is None: # Audio source ended.
                 break
-
-    def flash_visualization(self):
-        leds = self.led_data()
-        
-        last_frame = [0]*self.led_count # For smooth transitions, we need to know what things looked like last frame.
-        sent = 0
-        for frame in leds:
-            data = []
-            size = []
-
-            brightness = 0
-            brightest = 0
-            totalsize = 0
-
-            for i in range(self.led_count): # First pass, let's get an idea of how loud things are.
-                brightness = brightness + frame[i]
-                if frame[i] > frame[brightest]:
-                    brightest = i
-
-            for i in range(self.led_count): # Second pass, let's try and figure out the rough size of each section.
-                if brightness == 0:
-                    frame[i] = 1
-                    size.append(1)
-                    totalsize = totalsize + 1
-                    continue
-                try:
-                    size.append(int(frame[i]/brightness*self.led_count))
-                    totalsize = totalsize+size[-1]
-                except ValueError:
-                    pass
-
-            if brightness == 0:
-                brightness = self.led_count
-
-            while totalsize < self.led_count:
-                for i in range(self.led_count):
-                    if totalsize < self.led_count and size[i] > 0:
-                        size[i] = size[i] + 1
-                        totalsize = totalsize + 1
-                    elif totalsize == self.led_count:
-                        break
-
-            for i in range(self.led_count):
-                hue = i/(self.led_count*1.75)
-                r, g, b = hsv_to_rgb(hue, 1, min((last_frame[i]*2.6+frame[i]*1.3)/3, 1))
-                data = data+[int(g*255), int(r*255), int(b*255)]*int(size[i])
-
-            now = time()
-            if now-sent < .02:
-                sleep(max(0, .02-(now-sent)))
-
-            sent = time()
+            if self.next_renderer is not None:
+                self.beat_switch()
+            renderer = self.renderer # Read once per frame, so a switch always lands between frames.
+            if renderer is None: # Input only spectrum transmit. Sent by the analysis stream listener.
+                continue
+            if self.beat_effects == True and self.beats.beat == True:
+                on_beat = getattr(renderer, 'beat', None)
+                if on_beat is not None:
+                    on_beat(self.beats.bpm)
+            start = metrics.clock()
+            data = renderer.render(frame)
+            metrics.observe('render', start)
             self.send_to_stick(data)
-            last_frame = frame
-            if self.stop == True: # Handle stopping the thread, so another visualization can be executed.
-                break
-
+            metrics.frame()
 
 
 def readme():
@@ -407,6 +461,9 @@ Blinkstick Audio LED Visualizer
         -r, --rate           Input Device Hz Rate (Default: 44100). Alternatively set to: 48000
         -c, --chunk          Input Device Frames per buffer Chunk Size (Default: 1024).        
         -ch, --channels      Input Device Number of Channels (Default: 2). Likely Alternative set to: 1
+        -cb, --callback      Callback mode audio capture into a ring buffer (Default: False). Audio keeps being captured while a frame renders, and overflows are counted.
+        -w, --wav            Play a 16-bit PCM WAV file instead of listening to the input device (Default: None). Loops until stopped.
+        -sy, --synthetic     Use a generated test signal instead of the input device (Default: None). Options: sweep, noise, kick, click, mix.
         -mx, --max           Maximum time (in seconds) between visualization transition (Default: 15s). # Note: Max and Min can be equal (thus setting a static transition interval).
         -mn, --min           Minimum time (in seconds) between visualization transition (Default: 5s).  #       However, Max cannot be less than Min.
         -tx, --transmit      Transmit Mode via UDP (Default: False). Uses file based (./receive_nodes.list) list of each IP Addresses on own line to send Blinkstick data.
@@ -414,6 +471,34 @@ Blinkstick Audio LED Visualizer
         -if, --interface     Network Interface for receiving data. Facilitates Auto-discovery mechanism (Default: eth0).          
         -io, --inputonly     Input Only Mode. Assumes Transmit Mode via UDP. Facilitates device that only listens to input without Blinkstick attached and transmits to other devices. (Default: False).    
         -lc, --ledcount      Used in conjunction with Input Only, as you need to specify the LED count for the remote devices (Default: 32).
+        -mp, --metrics-port  Serve per-stage timing, frame rate, and counters in Prometheus format on http://127.0.0.1:PORT/metrics (Default: disabled).
+        -js, --json-stats    Print the same stats as a JSON line every N seconds (Default: disabled).
+        -sc, --scale         Map frequencies to LEDs on a linear, log, or mel scale between --min-freq and --max-freq (Default: one FFT bin per LED, 0Hz up). log/mel work well for long strips.
+        -fmin, --min-freq    Lowest frequency shown with --scale (Default: 40Hz).
+        -fmax, --max-freq    Highest frequency shown with --scale (Default: 16000Hz).
+        -f, --fps            Target frames per second (Default: one frame per --hop, e.g. 43 for 1024 sample windows at 44100Hz). Lowered automatically while the device can't keep up.
+        -fs, --fft-size      FFT window in samples (Default: 1024). Longer windows resolve bass better.
+        -hp, --hop           Samples between analyzed windows (Default: the FFT size, i.e. no overlap). e.g. 220 updates every 5ms at 44100Hz, over overlapping windows.
+        -hn, --hann          Taper windows with a Hann window (Default: False). Less smearing between frequencies, useful with long overlapping windows.
+        -sw, --switch        When switching visualizations takes effect. Options: timer (as soon as the interval is up), beat (on the next beat), phrase (on the next 16 beat phrase) (Default: timer).
+        -be, --beat-effects  Beat effects in visualizations that support them, e.g. pulse accents each beat (Default: False).
+        -br, --brightness    Blinkstick brightness, 0-1 (Default: 1).
+        -gm, --gamma         Blinkstick gamma correction, e.g. 2.2 for more even fades (Default: 1, i.e. none).
+        -ct, --change-threshold   Skip Blinkstick writes that change no channel by more than this, out of 255 (Default: 0, i.e. only skip identical frames).
+        -ka, --keepalive     Write unchanged frames to the Blinksticks at least every this many seconds (Default: 1). 0 writes every frame.
+        -p, --processes      Multi-process mode (Default: False). Audio capture/processing, visualization, and output (Blinksticks/UDP) each run in their own process, using more than one CPU core.
+        -z, --compression    Transmit Mode frame compression. Options: raw, rle, delta (Default: raw). rle/delta help long strips with large runs of the same color.
+        -mc, --multicast     Send/receive frames via a multicast group instead of a copy per receive node (Default: disabled, or 239.255.50.50 if no group is given). Use on both transmit and receive nodes.
+        -ttl, --ttl          Multicast TTL (Default: 1). 1 keeps frames on the local subnet.
+        -ts, --transmit-spectrum  Transmit the analyzed spectrum instead of LED data (Default: False). Assumes Transmit Mode. Receive nodes given --modes render it for their own LED count.
+        -b, --bands          Bands per transmitted spectrum (Default: 32).
+        -sf, --spectrum-format    Transmitted spectrum precision. Options: float16, uint8 (Default: float16).
+        -lt, --latency       Transmit Mode latency budget in ms (Default: disabled). Receive nodes sync clocks with the transmit node and all show each frame this long after it's sent. Frames that miss it are dropped.
+        -rec, --record       Record every displayed/transmitted frame to a show file (Default: disabled). Works in local, transmit, input only, and receive modes.
+        -rp, --replay        Play a show file to the Blinksticks and/or receive nodes (with --transmit or --inputonly) instead of listening to the input device (Default: disabled).
+        -sp, --speed         Replay speed (Default: 1). 2 plays twice as fast, 0 as fast as possible (e.g. to load test receive nodes).
+        -st, --start         Replay from this many seconds into the show (Default: 0).
+        -lp, --loop-replay   Replay the show file until stopped (Default: False).
 
 
     Command Examples:
@@ -424,7 +509,17 @@ Blinkstick Audio LED Visualizer
         python3 visualizer.py --modes pulse loop --sensitivity 1                                 # Example of non-default sound sensitivity adjustment.
         python3 visualizer.py --modes pulse loop --dev 1 --rate 48000 --chunk 4096 --channels 1  # Example of non-default device, Input Device Hz rate, chunk size, and channels.
         python3 visualizer.py --modes pulse loop --transmit                                      # Example of transmit mode.        
+        python3 visualizer.py --modes flash --scale mel --ledcount 300 --inputonly               # Example of mel scale frequency mapping for a long strip.
+        python3 visualizer.py --modes all --wav song.wav                                         # Example of WAV file input instead of a microphone.
         python3 visualizer.py --modes pulse loop --inputonly                                     # Example of input only mode.
+        python3 visualizer.py --modes pulse loop --transmit --compression delta                  # Example of transmit mode with delta compressed frames.
+        python3 visualizer.py --modes pulse loop --transmit --multicast                          # Example of multicast transmit mode. Receive nodes use: --receive --multicast
+        python3 visualizer.py --modes pulse --inputonly --transmit-spectrum                      # Example of spectrum transmit. Receive nodes use e.g.: --receive --modes flash
+        python3 visualizer.py --modes pulse loop --transmit --latency 100                        # Example of transmit mode with receive nodes in sync, 100ms behind.
+        python3 visualizer.py --modes pulse --fft-size 4096 --hop 220 --hann                     # Example of 5ms updates over long overlapping windows, for tight bass response.
+        python3 visualizer.py --modes all --switch phrase --beat-effects                         # Example of switching visualizations on the beat, with beat accents.
+        python3 visualizer.py --modes all --record show.bsv                                      # Example of recording a show.
+        python3 visualizer.py --replay show.bsv --inputonly --speed 0                            # Example of replaying a show to receive nodes as fast as possible.
         python3 visualizer.py --modes pulse loop --inputonly --ledcount                          # Example of input only mode with custom LED count for receiving device.        
     ''')
     sys.exit(0)
@@ -440,40 +535,107 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--rate', help='Input Device Hz Rate (Default: 44100)', default=44100)
     parser.add_argument('-c', '--chunk', help='Input Device Frames per buffer Chunk Size (Default: 1024)', default=1024)
     parser.add_argument('-ch', '--channels', help='Input Device Number of Channels (Default: 2)', default=2)
+    parser.add_argument('-cb', '--callback', help='Callback mode audio capture (Default: False)', default=False, action='store_true')
+    parser.add_argument('-w', '--wav', help='16-bit PCM WAV file input (Default: None)', default=None)
+    parser.add_argument('-sy', '--synthetic', help='Synthetic test signal input (Default: None)', default=None, choices=['sweep', 'noise', 'kick', 'click', 'mix'])
     parser.add_argument('-mx', '--max', help='Maximum time between transition (Default: 15s)', default=15)
     parser.add_argument('-mn', '--min', help='Minimum time between transition (Default: 5s)', default=5)
     parser.add_argument('-tx', '--transmit', help='Transmit Mode via UDP (Default: False)', default=False, action='store_true')
     parser.add_argument('-rx', '--receive', help='Receive Mode via UDP (Default: False)', default=False, action='store_true')    
     parser.add_argument('-if', '--interface', help='Network Interface for receiving data (Default: eth0)', default='eth0',)    
     parser.add_argument('-io', '--inputonly', help='Input Only. Bypass Blinkstick (Default: False)', default=False, action='store_true')    
-    parser.add_argument('-lc', '--ledcount', help='LED Count of Receiving Blinksticks. Used with Input Only mode (Default: 32)', default=32)
+    parser.add_argument('-lc', '--ledcount', help='LED Count of Receiving Blinksticks. Used with Input Only mode (Default: 32)', default=32, type=int)
+    parser.add_argument('-mp', '--metrics-port', help='Prometheus metrics port (Default: disabled)', default=None, type=int)
+    parser.add_argument('-js', '--json-stats', help='Print JSON stats every N seconds (Default: disabled)', default=None, type=float)
+    parser.add_argument('-sc', '--scale', help='Frequency to LED mapping (Default: one FFT bin per LED)', default=None, choices=['linear', 'log', 'mel'])
+    parser.add_argument('-fmin', '--min-freq', help='Lowest frequency shown with --scale (Default: 40)', default=40, type=float)
+    parser.add_argument('-fmax', '--max-freq', help='Highest frequency shown with --scale (Default: 16000)', default=16000, type=float)
+    parser.add_argument('-f', '--fps', help='Target frames per second (Default: one frame per --hop, as audio arrives)', default=None, type=float)
+    parser.add_argument('-fs', '--fft-size', help='FFT window in samples (Default: 1024)', default=1024, type=int)
+    parser.add_argument('-hp', '--hop', help='Samples between analyzed windows (Default: the FFT size)', default=None, type=int)
+    parser.add_argument('-hn', '--hann', help='Taper windows with a Hann window (Default: False)', default=False, action='store_true')
+    parser.add_argument('-sw', '--switch', help='When switching visualizations takes effect (Default: timer)', default='timer', choices=['timer', 'beat', 'phrase'])
+    parser.add_argument('-be', '--beat-effects', help='Beat effects in visualizations that support them (Default: False)', default=False, action='store_true')
+    parser.add_argument('-p', '--processes', help='Multi-process mode (Default: False)', default=False, action='store_true')
+    parser.add_argument('-z', '--compression', help='Transmit Mode frame compression (Default: raw)', default='raw', choices=sorted(wire_protocol.ENCODINGS))
+    parser.add_argument('-mc', '--multicast', help='Multicast group for frames (Default: disabled, {} if no group is given)'.format(DEFAULT_GROUP), default=None, nargs='?', const=DEFAULT_GROUP)
+    parser.add_argument('-ttl', '--ttl', help='Multicast TTL (Default: {})'.format(DEFAULT_TTL), default=DEFAULT_TTL, type=int)
+    parser.add_argument('-ts', '--transmit-spectrum', help='Transmit the analyzed spectrum instead of LED data (Default: False)', default=False, action='store_true')
+    parser.add_argument('-b', '--bands', help='Bands per transmitted spectrum (Default: 32)', default=32, type=int)
+    parser.add_argument('-sf', '--spectrum-format', help='Transmitted spectrum precision (Default: float16)', default='float16', choices=sorted(wire_protocol.SPECTRUM_ENCODINGS))
+    parser.add_argument('-lt', '--latency', help='Transmit Mode latency budget in ms, for synchronized playout (Default: disabled)', default=None, type=float)
+    parser.add_argument('-br', '--brightness', help='Blinkstick brightness, 0-1 (Default: 1)', default=1.0, type=float)
+    parser.add_argument('-gm', '--gamma', help='Blinkstick gamma correction (Default: 1, i.e. none)', default=1.0, type=float)
+    parser.add_argument('-ct', '--change-threshold', help='Skip Blinkstick writes that change no channel by more than this (Default: 0, identical frames only)', default=0, type=int)
+    parser.add_argument('-ka', '--keepalive', help='Write unchanged frames at least every this many seconds, 0 for every frame (Default: 1)', default=1.0, type=float)
+    parser.add_argument('-rec', '--record', help='Record frames to a show file (Default: disabled)', default=None)
+    parser.add_argument('-rp', '--replay', help='Play a show file instead of listening to the input device (Default: disabled)', default=None)
+    parser.add_argument('-sp', '--speed', help='Replay speed, 0 for as fast as possible (Default: 1)', default=1.0, type=float)
+    parser.add_argument('-st', '--start', help='Replay from this many seconds into the show (Default: 0)', default=0.0, type=float)
+    parser.add_argument('-lp', '--loop-replay', help='Replay the show file until stopped (Default: False)', default=False, action='store_true')
     args = parser.parse_args()
+    if args.metrics_port is not None or args.json_stats is not None:
+        metrics.enable(port=args.metrics_port, json_interval=args.json_stats)
+    source = None
+    if args.wav is not None:
+        source = WavSource(args.wav, loop=True, realtime=True)
+    elif args.synthetic is not None:
+        source = SyntheticSource(rate=args.rate, kind=args.synthetic, realtime=True)
+    kwargs = dict(sensitivity=args.sensitivity, rate=args.rate, chunk=args.chunk, channels=args.channels, max_int=args.max, min_int=args.min, transmit=args.transmit, 
+                  receive=args.receive, network_interface=args.interface, inputonly=args.inputonly, led_count=args.ledcount, device=args.dev, compression=args.compression, 
+                  callback=args.callback, source=source, fps=args.fps, scale=args.scale, min_freq=args.min_freq, max_freq=args.max_freq,
+                  multicast=args.multicast, ttl=args.ttl,
+                  transmit_spectrum=args.transmit_spectrum, bands=args.bands, spectrum_format=args.spectrum_format,
+                  latency=args.latency/1000 if args.latency else None, record=args.record,
+                  fft_size=args.fft_size, hop=args.hop, hann=args.hann, switch_on=args.switch, beat_effects=args.beat_effects,
+                  brightness=args.brightness, gamma=args.gamma, change_threshold=args.change_threshold, keepalive=args.keepalive)
 
     ## Command line argument handlers
     if args.readme: 
         readme()
     # Handle error scenarios. 
-    elif args.transmit == True and args.receive == True:
+    elif (args.transmit == True or args.transmit_spectrum == True) and args.receive == True:
         print('ERROR - Cannot both Transmit and Receive. Please pick one or the other.')
         sys.exit(1)
+    elif args.hop is not None and not 0 < args.hop <= args.fft_size:
+        print('ERROR - Hop ({}) must be between 1 and the FFT size ({}).'.format(args.hop, args.fft_size))
+        sys.exit(1)
+    elif not 0 <= args.min_freq < args.max_freq:
+        print('ERROR - Minimum frequency ({}Hz) must be at least 0 and below the Maximum frequency ({}Hz).'.format(args.min_freq, args.max_freq))
+        sys.exit(1)
+    elif not 0 <= args.brightness <= 1 or args.gamma <= 0 or not 0 <= args.change_threshold <= 255:
+        print('ERROR - Brightness must be between 0 and 1, gamma above 0, and the change threshold between 0 and 255.')
+        sys.exit(1)
     elif int(args.max) < int(args.min): 
         print('ERROR - Maximum visualization transition interval ({}s) cannot be less than Minimum transition interval ({}s).'.format(args.max, args.min))
         sys.exit(1)
     elif args.receive == True and args.inputonly == True: 
         print('ERROR - Input Only does not work in conjunction with Receive mode. Input only is for listening to audio without a Blinkstick attached in Transmit Mode.')
         sys.exit(1)        
+    elif args.receive == True and args.processes == True: 
+        print('ERROR - Multi-process mode does not apply to Receive mode. Receive mode already writes to Blinksticks on its own thread.')
+        sys.exit(1)        
+    elif args.transmit_spectrum == True and args.processes == True: 
+        print('ERROR - Multi-process mode does not support Transmit Spectrum. Spectra are sent straight from the audio analysis.')
+        sys.exit(1)        
+    elif args.replay is not None and (args.receive == True or args.transmit_spectrum == True or args.processes == True): 
+        print('ERROR - Replay plays recorded LED frames locally and/or with --transmit/--inputonly. It does not work with Receive, Transmit Spectrum, or Multi-process mode.')
+        sys.exit(1)        
+    # Handle Replay mode (local, transmit, or input only).
+    elif args.replay is not None:
+        BlinkStickViz(**dict(kwargs, audio_input=False)).replay(args.replay, start=args.start, speed=args.speed, loop=args.loop_replay)
+    # Handle Multi-process mode (local, transmit, or input only).
+    elif args.processes == True and args.modes is not None:
+        multiprocess_pipeline.run(BlinkStickViz, kwargs, modes=args.modes)
     # Handle Input Only mode, which turns on Transmit capabilities.
     elif args.inputonly == True and args.modes is not None:
-        BlinkStickViz(sensitivity=args.sensitivity, rate=args.rate, chunk=args.chunk, channels=args.channels, max_int=args.max, min_int=args.min, transmit=args.transmit, 
-                      receive=args.receive, network_interface=args.interface, inputonly=args.inputonly, led_count=args.ledcount, device=args.dev).main(modes=args.modes)
+        BlinkStickViz(**kwargs).main(modes=args.modes)
     # Handle Receive mode.
     elif args.receive == True:
-        BlinkStickViz(sensitivity=args.sensitivity, rate=args.rate, chunk=args.chunk, channels=args.channels, max_int=args.max, min_int=args.min, transmit=args.transmit, 
-                      receive=args.receive, network_interface=args.interface, inputonly=args.inputonly, led_count=args.ledcount, device=args.dev).udp_receive_handler()
+        BlinkStickViz(**kwargs).udp_receive_handler(modes=args.modes) # With --modes, renders the transmit node's spectrum locally.
     # Handle Main
     elif args.modes is not None:
-        BlinkStickViz(sensitivity=args.sensitivity, rate=args.rate, chunk=args.chunk, channels=args.channels, max_int=args.max, min_int=args.min, transmit=args.transmit, 
-                      receive=args.receive, network_interface=args.interface, inputonly=args.inputonly, led_count=args.ledcount, device=args.dev).main(modes=args.modes)
+        BlinkStickViz(**kwargs).main(modes=args.modes)
     else:
         print('README: python3 visualizer.py -readme')
         sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,201 @@
+# 2020/06 BuRnCycL
+# Binary wire protocol for UDP transmit/receive. Replaces pickle, which was slow and unsafe on network input.
+# Every datagram is a fixed header followed by a payload:
+#   magic (4s) | version (B) | message type (B) | encoding (B) | flags (B) | sequence (I) | led count (H) | timestamp in microseconds (Q)
+# Frame payloads are raw GRB uint8 bytes, optionally run-length encoded or XOR-delta encoded against the previous frame.
+# Spectrum payloads are the analyzed audio (one value per band, 0.0-1.0) as float16 or uint8, for receive nodes that render locally.
+# For spectrum messages, the led count field holds the band count.
+# Timestamps are the sender's wall clock. With the TIMED flag, a frame's timestamp is when to show it, and receive nodes map it to their
+# own clock with NTP-style SYNC_REQUEST/SYNC_REPLY exchanges (see clock_sync.py).
+
+import struct
+import numpy as np
+from collections import namedtuple
+from time import time
+
+
+MAGIC = b'BSVZ'
+VERSION = 1
+HEADER = struct.Struct('!4sBBBBIHQ')
+MAX_DATAGRAM = 65507 # Largest UDP payload over IPv4.
+
+# Message types.
+FRAME = 1
+ANNOUNCE = 2
+ACKNOWLEDGE = 3
+SPECTRUM = 4
+SYNC_REQUEST = 5 # Receive node -> transmit node. Timestamp is the send time (t0). Payload is the node's own sync report (SYNC_REPORT).
+SYNC_REPLY = 6 # Transmit node -> receive node. Payload is t0, request received (t1), reply sent (t2) as SYNC_TIMES.
+
+# Frame encodings.
+RAW = 0
+RLE = 1 # Runs of identical LEDs: (run length uint8, G, R, B) records.
+DELTA = 2 # XOR against the previous frame (sequence - 1), then run-length encoded. Mostly zeros when little changes.
+ENCODINGS = {'raw': RAW, 'rle': RLE, 'delta': DELTA}
+
+# Spectrum encodings.
+HALF = 3 # Little-endian float16 per band.
+BYTE = 4 # uint8 per band, 0-255 for 0.0-1.0.
+SPECTRUM_ENCODINGS = {'float16': HALF, 'uint8': BYTE}
+
+# Flags.
+BEAT = 0x1 # Spectrum is on a beat.
+TIMED = 0x2 # Timestamp is a presentation time. Show the frame then, not when it arrives.
+
+SYNC_TIMES = struct.Struct('!QQQ') # Microseconds.
+SYNC_REPORT = struct.Struct('!ffI') # Clock offset (ms), jitter (ms), frames that missed their presentation time.
+
+Message = namedtuple('Message', ['type', 'encoding', 'sequence', 'led_count', 'timestamp', 'payload', 'flags'], defaults=(0,))
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def pack(message_type, payload=b'', sequence=0, led_count=0, encoding=RAW, timestamp=None, flags=0):
+    if timestamp is None:
+        timestamp = now()
+    return(HEADER.pack(MAGIC, VERSION, message_type, encoding, flags, sequence & 0xFFFFFFFF, led_count, timestamp) + bytes(payload))
+
+def unpack(datagram):
+    if len(datagram) < HEADER.size:
+        raise ProtocolError('Datagram too short: {} bytes'.format(len(datagram)))
+    magic, version, message_type, encoding, flags, sequence, led_count, timestamp = HEADER.unpack_from(datagram)
+    if magic != MAGIC:
+        raise ProtocolError('Bad magic: {}'.format(magic))
+    if version != VERSION:
+        raise ProtocolError('Unsupported protocol version: {}'.format(version))
+    return(Message(message_type, encoding, sequence, led_count, timestamp, memoryview(datagram)[HEADER.size:], flags))
+
+def now():
+    return(int(time()*1000000))
+
+def sync_request(offset=0.0, jitter=0.0, expired=0):
+    return(pack(SYNC_REQUEST, SYNC_REPORT.pack(offset, jitter, expired & 0xFFFFFFFF)))
+
+# received_at is when the request arrived, in microseconds.
+def sync_reply(request, received_at):
+    return(pack(SYNC_REPLY, SYNC_TIMES.pack(request.timestamp, received_at, now())))
+
+def announce(identifier):
+    return(pack(ANNOUNCE, identifier.encode()))
+
+def acknowledge():
+    return(pack(ACKNOWLEDGE))
+
+
+def rle_encode(leds):
+    pixels = leds.reshape(-1, 3)
+    if len(pixels) == 0:
+        return(b'')
+    changes = np.flatnonzero(np.any(pixels[1:] != pixels[:-1], axis=1)) + 1
+    starts = np.concatenate(([0], changes))
+    lengths = np.diff(np.concatenate((starts, [len(pixels)])))
+    # Runs longer than 255 LEDs are split into several records.
+    chunks = (lengths + 254) // 255
+    counts = np.full(int(chunks.sum()), 255, dtype=np.uint8)
+    last = np.cumsum(chunks) - 1
+    counts[last] = lengths - 255*(chunks - 1)
+    records = np.empty((len(counts), 4), dtype=np.uint8)
+    records[:, 0] = counts
+    records[:, 1:] = pixels[np.repeat(starts, chunks)]
+    return(records.tobytes())
+
+def rle_decode(payload, led_count):
+    if len(payload) % 4 != 0:
+        raise ProtocolError('Run-length payload is {} bytes, not a whole number of 4 byte records'.format(len(payload)))
+    records = np.frombuffer(payload, dtype=np.uint8).reshape(-1, 4)
+    leds = np.repeat(records[:, 1:], records[:, 0], axis=0)
+    if len(leds) != led_count:
+        raise ProtocolError('Run-length payload decodes to {} LEDs, expected {}'.format(len(leds), led_count))
+    return(leds.reshape(-1))
+
+
+# (timestamp, flags) for pack().
+def timing(presentation_time):
+    if presentation_time is None:
+        return(None, 0)
+    return(int(presentation_time*1000000), TIMED)
+
+
+# Stateful encoder for the transmitter. Tracks the sequence number and, for delta encoding, the previous frame.
+class FrameEncoder:
+    def __init__(self, encoding=RAW, keyframe_interval=50):
+        self.encoding = encoding
+        self.keyframe_interval = keyframe_interval # Delta frames are useless after a lost packet, so send a full frame this often.
+        self.sequence = 0
+        self.previous = None
+
+    # presentation_time (seconds, wall clock) is when receive nodes should show the frame. None shows it on arrival.
+    def encode(self, data, presentation_time=None):
+        leds = np.asarray(data, dtype=np.uint8).reshape(-1)
+        led_count = len(leds)//3
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        payload, encoding = leds, RAW
+        if self.encoding == DELTA and self.previous is not None and len(self.previous) == len(leds) and self.sequence % self.keyframe_interval != 0:
+            payload, encoding = rle_encode(np.bitwise_xor(leds, self.previous)), DELTA
+        elif self.encoding in (RLE, DELTA):
+            payload, encoding = rle_encode(leds), RLE
+        if len(payload) >= len(leds): # Never send more than the raw frame.
+            payload, encoding = leds, RAW
+        if self.encoding == DELTA:
+            self.previous = leds.copy()
+        return(pack(FRAME, payload.data if encoding == RAW else payload, self.sequence, led_count, encoding, *timing(presentation_time)))
+
+
+# Stateful decoder for receivers. Returns GRB uint8 arrays, or None for a delta frame whose base frame was lost.
+class FrameDecoder:
+    def __init__(self):
+        self.previous = None
+        self.previous_sequence = None
+
+    def decode(self, message):
+        if message.encoding == RAW:
+            if len(message.payload) != message.led_count*3:
+                raise ProtocolError('Raw payload is {} bytes, expected {}'.format(len(message.payload), message.led_count*3))
+            leds = np.frombuffer(message.payload, dtype=np.uint8)
+        elif message.encoding == RLE:
+            leds = rle_decode(message.payload, message.led_count)
+        elif message.encoding == DELTA:
+            if self.previous is None or self.previous_sequence != (message.sequence - 1) & 0xFFFFFFFF or len(self.previous) != message.led_count*3:
+                return(None) # Wait for the next keyframe.
+            leds = np.bitwise_xor(rle_decode(message.payload, message.led_count), self.previous)
+        else:
+            raise ProtocolError('Unknown frame encoding: {}'.format(message.encoding))
+        self.previous = leds
+        self.previous_sequence = message.sequence
+        return(leds)
+
+
+# Spectrum side of the transmitter. A few dozen bands instead of 3 bytes per LED, whatever the receive nodes' strip lengths.
+class SpectrumEncoder:
+    def __init__(self, encoding=HALF):
+        self.encoding = encoding
+        self.sequence = 0
+
+    def encode(self, spectrum, beat=False, presentation_time=None):
+        values = np.asarray(spectrum, dtype=np.float64)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        if self.encoding == BYTE:
+            payload = (np.clip(values, 0, 1)*255 + .5).astype(np.uint8)
+        elif self.encoding == HALF:
+            payload = values.astype('<f2')
+        else:
+            raise ProtocolError('Unknown spectrum encoding: {}'.format(self.encoding))
+        timestamp, flags = timing(presentation_time)
+        return(pack(SPECTRUM, payload.tobytes(), self.sequence, len(values), self.encoding, timestamp, flags | (BEAT if beat else 0)))
+
+# Band values (float64, 0.0-1.0) from a SPECTRUM message.
+def decode_spectrum(message):
+    if message.encoding == BYTE:
+        dtype = np.dtype(np.uint8)
+    elif message.encoding == HALF:
+        dtype = np.dtype('<f2')
+    else:
+        raise ProtocolError('Unknown spectrum encoding: {}'.format(message.encoding))
+    if len(message.payload) != message.led_count*dtype.itemsize: # Checked first, as frombuffer can't take a partial value.
+        raise ProtocolError('Spectrum payload is {} bytes, expected {} bands of {}'.format(len(message.payload), message.led_count, dtype.itemsize))
+    values = np.frombuffer(message.payload, dtype=dtype)
+    if message.encoding == BYTE:
+        return(values/255.0)
+    return(values.astype(np.float64))